@@ -2,8 +2,22 @@
 
 # Library for API calls
 import requests
+import json
+import logging
 import os
+import re
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from functools import partial
 from dotenv import load_dotenv
+
+from cache import SingleFlight, TTLCache
+from scheduler import (INTERACTIVE, HYDRATION, PREFETCH, UpstreamScheduler,
+                       UpstreamUnavailable, CircuitBreaker)
+from text_utils import normalize_query
+
 load_dotenv()
 API_KEY = os.getenv('API_KEY')
 
@@ -12,36 +26,667 @@ headers = { 'x-rapidapi-key': API_KEY,
     
            "Accept": "application/json"}
 
+# Seconds a whole search request may spend waiting on Spoonacular
+SEARCH_DEADLINE = float(os.getenv('SEARCH_DEADLINE', 6))
+
+# Bounded worker pool shared by every request in this process
+SUMMARY_WORKERS = int(os.getenv('SUMMARY_WORKERS', 10))
+summary_pool = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS)
+
+# Search page sizes. Spoonacular won't page past an offset of 900.
+DEFAULT_RESULTS = int(os.getenv('DEFAULT_RESULTS', 10))
+MAX_RESULTS = int(os.getenv('MAX_RESULTS', 20))
+MAX_OFFSET = 900
+
+# Most recipes Spoonacular's bulk information endpoint is asked for at once
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 50))
+
+# Compact search responses keep only what the search page renders, with
+# summaries cut to SUMMARY_CHARS characters of plain text
+COMPACT_FIELDS = ('id', 'title', 'image', 'summary')
+SUMMARY_CHARS = int(os.getenv('SUMMARY_CHARS', 200))
+
+# Page-level keys kept by every projection of a search results page
+PAGE_FIELDS = ('baseUri', 'offset', 'number', 'totalResults', 'has_more',
+               'source', 'facets', 'unfiltered')
+
+# Opt-in background prefetch of recipe info for the top PREFETCH_TOP_K
+# results of each search (0 turns it off). Each user may queue at most
+# PREFETCH_BUDGET recipes per PREFETCH_WINDOW seconds.
+PREFETCH_TOP_K = int(os.getenv('PREFETCH_TOP_K', 0))
+PREFETCH_BUDGET = int(os.getenv('PREFETCH_BUDGET', 30))
+PREFETCH_WINDOW = float(os.getenv('PREFETCH_WINDOW', 10 * 60))
+PREFETCH_MAX_PENDING = int(os.getenv('PREFETCH_MAX_PENDING', 20))
+
+# A single low-priority worker, so prefetches never crowd out requests
+prefetch_pool = ThreadPoolExecutor(max_workers=1)
+prefetch_budgets = {}
+prefetch_stats = {'queued': 0, 'skipped_cached': 0, 'over_budget': 0,
+                  'dropped': 0, 'pending': 0}
+prefetch_lock = threading.Lock()
+
+# Upstream statuses worth retrying: rate limiting and server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+logger = logging.getLogger(__name__)
+
+# Recipe info and summaries barely change, so keep them for a day and serve
+# stale copies for a few hours more while they are refreshed (or for as
+# long as they're kept, if Spoonacular is failing). Unknown recipe ids
+# (404s) are remembered briefly so they don't cost a call each time.
+recipe_cache = TTLCache(
+    maxsize=int(os.getenv('RECIPE_CACHE_SIZE', 2000)),
+    ttl=float(os.getenv('RECIPE_CACHE_TTL', 24 * 60 * 60)),
+    stale_ttl=float(os.getenv('RECIPE_CACHE_STALE_TTL', 6 * 60 * 60)),
+    negative_ttl=float(os.getenv('RECIPE_CACHE_NEGATIVE_TTL', 10 * 60)),
+    stale_if_error=True,
+    enabled=os.getenv('API_CACHE_ENABLED', '1') != '0')
+
+# Fully enriched search results, keyed by normalized query. Capped by the
+# size of the JSON they serialize to rather than by entry count alone.
+search_cache = TTLCache(
+    maxsize=int(os.getenv('SEARCH_CACHE_SIZE', 500)),
+    ttl=float(os.getenv('SEARCH_CACHE_TTL', 60 * 60)),
+    maxbytes=int(os.getenv('SEARCH_CACHE_BYTES', 20 * 1024 * 1024)),
+    sizeof=lambda value: len(json.dumps(value)),
+    enabled=os.getenv('API_CACHE_ENABLED', '1') != '0')
+
+# Stem search terms so "tomatoes" and "tomato" share a cache entry
+SEARCH_STEMMING = os.getenv('SEARCH_STEMMING', '0') == '1'
+
+
+class ApiClient(object):
+    """Shared HTTP client for Spoonacular. Keeps a keep-alive connection pool
+    per process, applies timeouts, retries idempotent GETs with jittered
+    backoff and records per-call latency stats. Identical concurrent GETs
+    share one upstream request. With a scheduler, every attempt waits for
+    its priority's turn at the quota and respects the circuit breaker."""
+
+    def __init__(self, base_url, headers, pool_size=10, connect_timeout=3.05,
+                 read_timeout=10, retries=2, backoff=0.25, scheduler=None):
+        self.base_url = base_url
+        self.headers = headers
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.scheduler = scheduler
+
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.flights = SingleFlight()
+
+    @property
+    def session(self):
+        """Session for this process. Rebuilt after a fork (e.g. gunicorn
+        workers) so that processes never share sockets."""
+
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    session.headers.update(self.headers)
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=self.pool_size,
+                        pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+
+                    self._session = session
+                    self._pid = os.getpid()
+                    self._stats = {}
+
+        return self._session
+
+    def get_json(self, path, params=None, endpoint=None,
+                 priority=INTERACTIVE, deadline=None):
+        """GETs base_url + path, retrying timeouts, connection errors and
+        retryable statuses. Raises requests exceptions once retries run out,
+        or UpstreamUnavailable if the scheduler won't let the call out.
+        endpoint names the call in stats; defaults to path. With a deadline
+        (a time.monotonic() timestamp), waits and timeouts are cut to the
+        time left, no retry starts after it, and requests.Timeout is raised
+        once it has passed.
+
+        Callers asking for the same path and params at the same priority
+        while a request is in flight wait for it and share its response.
+        Priorities don't share: a prefetch that may not wait for quota
+        mustn't fail an interactive caller that may."""
+
+        key = (path, tuple(sorted((params or {}).items())), priority)
+
+        return self.flights.do(key, lambda: self._get_json(path, params,
+                                                           endpoint or path,
+                                                           priority,
+                                                           deadline))
+
+    def _get_json(self, path, params, endpoint, priority, deadline):
+        """Makes the request for get_json, with retries."""
+
+        attempt = 0
+
+        while True:
+            if self.scheduler is not None:
+                self.scheduler.acquire(priority, time_left(deadline))
+
+            timeout = self.timeout
+            if deadline is not None:
+                remaining = time_left(deadline)
+                if remaining <= 0:
+                    if self.scheduler is not None:
+                        self.scheduler.cancel()
+                    raise requests.Timeout("Deadline passed before calling "
+                                           "{}".format(endpoint))
+                timeout = tuple(min(part, remaining) for part in timeout)
+
+            started = time.monotonic()
+            try:
+                response = self.session.get(self.base_url + path,
+                                            params=params,
+                                            timeout=timeout)
+                self._report(response)
+                if response.status_code in RETRY_STATUSES:
+                    response.raise_for_status()
+            except requests.RequestException as error:
+                # Every call let out must be reported, or a half-open
+                # breaker would wait on its trial call forever
+                self._record(endpoint, time.monotonic() - started, error=True)
+                if error.response is None:
+                    self._report(None)
+
+                status = getattr(error.response, 'status_code', None)
+                if status is None:
+                    retryable = isinstance(error, (requests.ConnectionError,
+                                                   requests.Timeout))
+                else:
+                    retryable = status in RETRY_STATUSES
+                # Exponential backoff with full jitter between attempts
+                pause = random.uniform(0, self.backoff * 2 ** attempt)
+                if (not retryable or attempt >= self.retries
+                        or deadline is not None
+                        and time_left(deadline) <= pause):
+                    raise
+
+                time.sleep(pause)
+                attempt += 1
+                continue
+
+            self._record(endpoint, time.monotonic() - started,
+                         error=not response.ok)
+            response.raise_for_status()
+
+            return response.json()
+
+    def _report(self, response):
+        """Tells the scheduler how a call went: rate limiting, server errors
+        and no response at all count against the circuit breaker."""
 
-def recipe_search(recipe_search):
-    """Extracts recipe search results from Spoonacular API."""
+        if self.scheduler is None:
+            return
+
+        if response is None:
+            self.scheduler.record(False)
+            return
+
+        quota_remaining = response.headers.get(
+            'x-ratelimit-requests-remaining')
+        if quota_remaining is not None:
+            quota_remaining = int(quota_remaining)
+
+        self.scheduler.record(response.status_code not in RETRY_STATUSES,
+                              quota_remaining)
+
+    def _record(self, endpoint, elapsed, error=False):
+        """Adds one call's latency to the stats of its endpoint."""
+
+        elapsed_ms = elapsed * 1000
+
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {'calls': 0,
+                                                      'errors': 0,
+                                                      'total_ms': 0.0,
+                                                      'max_ms': 0.0})
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+        logger.debug("%s took %.1fms%s", endpoint, elapsed_ms,
+                     " (error)" if error else "")
+
+    def stats(self):
+        """Returns a copy of per-endpoint latency stats for this process."""
+
+        with self._lock:
+            stats = {endpoint: dict(values)
+                     for endpoint, values in self._stats.items()}
+
+        for values in stats.values():
+            values['avg_ms'] = values['total_ms'] / values['calls']
+
+        return stats
+
+
+def time_left(deadline):
+    """Seconds until deadline (a time.monotonic() timestamp), or None if
+    there is no deadline."""
+
+    if deadline is None:
+        return None
+
+    return deadline - time.monotonic()
+
+
+client = ApiClient(
+    'https://spoonacular-recipe-food-nutrition-v1.p.rapidapi.com',
+    headers,
+    pool_size=int(os.getenv('API_POOL_SIZE', SUMMARY_WORKERS)),
+    connect_timeout=float(os.getenv('API_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=float(os.getenv('API_READ_TIMEOUT', 10)),
+    retries=int(os.getenv('API_RETRIES', 2)),
+    backoff=float(os.getenv('API_BACKOFF', 0.25)),
+    scheduler=UpstreamScheduler(
+        rate=float(os.getenv('API_RATE_PER_SECOND', 5)),
+        capacity=float(os.getenv('API_BURST', 10)),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv('API_BREAKER_FAILURES', 5)),
+            reset_timeout=float(os.getenv('API_BREAKER_RESET', 30)))))
+
+
+def recipe_search(recipe_search, number=DEFAULT_RESULTS, offset=0,
+                  filters=None, deadline=None):
+    """Extracts one page of recipe search results from Spoonacular API.
+    filters holds extra search parameters, e.g. diet or intolerances."""
 
     # Set up parameters for API call, then call Spoonacular API
-    payload = {'query': recipe_search}
-    spoonacular_endpoint = 'https://spoonacular-recipe-food-nutrition-v1.p.rapidapi.com/recipes/search'
-    response = requests.get(spoonacular_endpoint,
-                            params=payload,
-                            headers=headers)
+    payload = dict(filters or {}, query=recipe_search, number=number,
+                   offset=offset)
+
+    return client.get_json('/recipes/search', params=payload,
+                           endpoint='search', deadline=deadline)
+
 
-    return response.json()
 def summary_info(recipe_id):
     """Extracts recipe summary from Spoonacular API."""
 
     # call Spoonacular API, inserting recipe_id into endpoint
-    summary_response = (requests.get('https://spoonacular-recipe-food-nutrition-v1.p.rapidapi.com/recipes/'
-                                     + recipe_id + '/summary',
-                                     headers=headers))
+    return recipe_cache.get_or_load(
+        ('summary', recipe_id),
+        lambda: client.get_json('/recipes/' + recipe_id + '/summary',
+                                endpoint='summary'),
+        negative=is_not_found)
 
-    return summary_response.json()
 
-def recipe_info(recipe_id):
-    """Extracts detailed recipe info from Spoonacular API."""
+def recipe_info(recipe_id, priority=INTERACTIVE):
+    """Extracts detailed recipe info from Spoonacular API. priority is the
+    scheduler class the call queues in if it isn't cached."""
 
     # Get info from API, inserting recipe_id into endpoint
-    info_response = requests.get(
-        'https://spoonacular-recipe-food-nutrition-v1.p.rapidapi.com/recipes/'
-        + recipe_id + '/information', headers=headers)
+    return recipe_cache.get_or_load(
+        ('information', recipe_id),
+        lambda: client.get_json('/recipes/' + recipe_id + '/information',
+                                endpoint='information', priority=priority),
+        negative=is_not_found)
+
+
+def is_not_found(error):
+    """Checks if an API call failed because the recipe doesn't exist."""
+
+    return (isinstance(error, requests.HTTPError)
+            and getattr(error.response, 'status_code', None) == 404)
+
+
+def enriched_recipe_search(search_terms, deadline, number=DEFAULT_RESULTS,
+                           offset=0, filters=None):
+    """Searches recipes and merges each result's summary into it. Complete
+    pages are cached by normalized query, so a hit skips every call."""
+
+    for event in stream_recipe_search(search_terms, deadline, number,
+                                      offset, filters):
+        if event['event'] == 'results':
+            results_json = event['data']
+
+    return results_json
+
+
+def stream_recipe_search(search_terms, deadline, number=DEFAULT_RESULTS,
+                         offset=0, filters=None):
+    """Searches one page of recipes (number results starting at offset,
+    narrowed by the filters search parameters), yielding events as the
+    results are enriched:
+
+    {'event': 'results', 'data': results json} once, as soon as the search
+    returns (with summaries already in it on a cache hit), then
+    {'event': 'summary', 'id': recipe_id, 'summary': text} as each summary
+    arrives, then {'event': 'done', 'missing': [recipe_ids]} listing any
+    summaries that missed the deadline."""
+
+    query = normalize_query(search_terms, stem=SEARCH_STEMMING)
+    key = ('search', query, number, offset,
+           tuple(sorted((filters or {}).items())))
+
+    results_json = search_cache.get(key)
+    if results_json is not None:
+        yield {'event': 'results', 'data': results_json}
+        yield {'event': 'done', 'missing': []}
+        return
+
+    # Copy before merging summaries in; the raw response may be shared
+    # with concurrent callers of the same search
+    try:
+        response = recipe_search(query, number, offset, filters, deadline)
+    except (UpstreamUnavailable, requests.RequestException):
+        # Spoonacular is struggling; an expired copy beats an error page
+        results_json = search_cache.get_stale(key)
+        if results_json is None:
+            raise
+        yield {'event': 'results', 'data': results_json}
+        yield {'event': 'done', 'missing': []}
+        return
+
+    results_json = dict(response,
+                        results=[dict(recipe, summary=None,
+                                      summary_missing=True)
+                                 for recipe in response['results']])
+    yield {'event': 'results', 'data': results_json}
+
+    recipes = {str(recipe['id']): recipe for recipe in results_json['results']}
+
+    # Fetch all summaries concurrently instead of one after another
+    for recipe_id, summary_text in iter_summaries(list(recipes), deadline):
+        recipes[recipe_id]['summary'] = summary_text
+        recipes[recipe_id]['summary_missing'] = False
+        yield {'event': 'summary', 'id': recipe_id, 'summary': summary_text}
+
+    missing = [recipe_id for recipe_id, recipe in recipes.items()
+               if recipe['summary_missing']]
+    yield {'event': 'done', 'missing': missing}
+
+    # Partial results are not cached so the next search can fill them in
+    if not missing:
+        search_cache.set(key, results_json)
+
+
+def clamp_page(number, offset):
+    """Keeps a requested page of search results within our limits. Missing
+    or invalid values fall back to the first page of DEFAULT_RESULTS."""
+
+    try:
+        number = int(number)
+    except (TypeError, ValueError):
+        number = DEFAULT_RESULTS
+
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        offset = 0
+
+    return (min(max(number, 1), MAX_RESULTS),
+            min(max(offset, 0), MAX_OFFSET))
+
+
+def with_has_more(results_json, offset):
+    """Returns a copy of a search results page that starts at offset, with
+    has_more saying if a next page can be asked for. None can past
+    MAX_OFFSET, where clamp_page would just return this page again."""
+
+    next_offset = offset + len(results_json['results'])
+
+    return dict(results_json,
+                has_more=bool(results_json['results'])
+                and next_offset < results_json.get('totalResults', 0)
+                and next_offset <= MAX_OFFSET)
+
+
+def parse_fields(fields):
+    """Splits a comma-separated fields= parameter into a tuple of field
+    names. Returns None if no fields were given."""
+
+    names = tuple(name.strip() for name in (fields or '').split(',')
+                  if name.strip())
+
+    return names or None
+
+
+def project_results(results_json, fields=None, compact=False):
+    """Returns a copy of a search results page whose results only have the
+    given fields. Compact mode defaults fields to COMPACT_FIELDS and
+    shortens summaries. With neither, results_json is returned as is."""
+
+    if compact:
+        fields = fields or COMPACT_FIELDS
+    if fields is None:
+        return results_json
+
+    projected = {name: results_json[name] for name in PAGE_FIELDS
+                 if name in results_json}
+    projected['results'] = []
+
+    for recipe in results_json['results']:
+        result = {name: recipe[name] for name in fields if name in recipe}
+        if compact and result.get('summary'):
+            if results_json.get('source') == 'local':
+                # Local summaries highlight the query, so aren't kept
+                result['summary'] = truncate_summary(recipe['summary'])
+            else:
+                result['summary'] = short_summary(recipe['id'],
+                                                  recipe['summary'])
+        projected['results'].append(result)
+
+    return projected
+
+
+def project_search_event(event, fields=None, compact=False):
+    """Applies project_results to one stream_recipe_search event. Returns
+    None for summary events the projection leaves out."""
+
+    if event['event'] == 'results':
+        return dict(event, data=project_results(event['data'], fields,
+                                                compact))
+
+    if event['event'] == 'summary':
+        if compact:
+            fields = fields or COMPACT_FIELDS
+        if fields is not None and 'summary' not in fields:
+            return None
+        if compact and event['summary']:
+            return dict(event, summary=short_summary(event['id'],
+                                                     event['summary']))
+
+    return event
+
+
+def short_summary(recipe_id, summary):
+    """Returns summary as at most SUMMARY_CHARS characters of plain text.
+    Each recipe's summary is shortened once and then kept in
+    recipe_cache."""
+
+    return recipe_cache.get_or_load(('short_summary', str(recipe_id)),
+                                    partial(truncate_summary, summary))
+
+
+def truncate_summary(summary, limit=None):
+    """Strips the HTML from summary and cuts it at a word boundary."""
+
+    limit = limit or SUMMARY_CHARS
+
+    text = ' '.join(re.sub(r'<[^>]+>', '', summary).split())
+    if len(text) <= limit:
+        return text
+
+    return text[:limit].rsplit(' ', 1)[0] + '...'
+
+
+def prefetch_recipe_info(recipe_ids, user_key):
+    """Queues a background fetch of recipe info for the first
+    PREFETCH_TOP_K recipe_ids, so the detail page view that usually follows
+    a search hits recipe_cache. Recipes already cached are skipped, and
+    user_key's budget limits how many each user can queue."""
+
+    if PREFETCH_TOP_K <= 0:
+        return
+
+    recipe_ids = [str(recipe_id) for recipe_id in recipe_ids[:PREFETCH_TOP_K]]
+    missing = [recipe_id for recipe_id in recipe_ids
+               if recipe_cache.get(('information', recipe_id)) is None]
+
+    now = time.monotonic()
+    with prefetch_lock:
+        prefetch_stats['skipped_cached'] += len(recipe_ids) - len(missing)
+
+        # Forget budgets whose window has passed
+        for key, (started, _) in list(prefetch_budgets.items()):
+            if now - started >= PREFETCH_WINDOW:
+                del prefetch_budgets[key]
+
+        started, used = prefetch_budgets.get(user_key, (now, 0))
+        allowed = missing[:max(PREFETCH_BUDGET - used, 0)]
+        prefetch_stats['over_budget'] += len(missing) - len(allowed)
+
+        if not allowed:
+            return
+        if prefetch_stats['pending'] >= PREFETCH_MAX_PENDING:
+            prefetch_stats['dropped'] += len(allowed)
+            return
+
+        prefetch_budgets[user_key] = (started, used + len(allowed))
+        prefetch_stats['queued'] += len(allowed)
+        prefetch_stats['pending'] += 1
+
+    prefetch_pool.submit(_prefetch, allowed)
+
+
+def _prefetch(recipe_ids):
+    """Fetches recipe info into recipe_cache for prefetch_recipe_info."""
+
+    try:
+        recipe_info_bulk(recipe_ids, priority=PREFETCH)
+    except UpstreamUnavailable:
+        # Quota is for interactive traffic right now; skip this prefetch
+        logger.debug("Prefetch of %s skipped by scheduler", recipe_ids)
+    except Exception as error:
+        logger.warning("Prefetch of %s failed: %r", recipe_ids, error)
+    finally:
+        with prefetch_lock:
+            prefetch_stats['pending'] -= 1
+
+
+def stats():
+    """Returns upstream stats for this process, used by /metrics.json."""
+
+    return {'latency': client.stats(),
+            'recipe_cache': recipe_cache.stats(),
+            'search_cache': search_cache.stats(),
+            'single_flight': client.flights.stats(),
+            'prefetch': dict(prefetch_stats),
+            'scheduler': client.scheduler.stats()}
+
+
+def iter_summaries(recipe_ids, deadline):
+    """Yields (recipe_id, summary text) pairs as summaries become available,
+    until deadline. Recipes whose summary can't be fetched in time are
+    not yielded.
+
+    Cached summaries come first, then one bulk information call per
+    BULK_CHUNK_SIZE recipes; only recipes the bulk calls didn't cover fall
+    back to individual summary calls."""
+
+    missing = []
+    for recipe_id in recipe_ids:
+        cached = recipe_cache.get(('summary', recipe_id))
+        if cached is not None and cached.get('summary'):
+            yield recipe_id, cached['summary']
+        else:
+            missing.append(recipe_id)
+
+    found = set()
+    if missing:
+        for recipe_id, info in iter_recipe_info_bulk(missing, deadline):
+            if info.get('summary'):
+                found.add(recipe_id)
+                yield recipe_id, info['summary']
+
+    missing = [recipe_id for recipe_id in missing if recipe_id not in found]
+    if missing and time.monotonic() < deadline:
+        calls = {recipe_id: partial(summary_info, recipe_id)
+                 for recipe_id in missing}
+        for recipe_id, summary_json in iter_gather(calls, deadline):
+            if summary_json.get('summary'):
+                yield recipe_id, summary_json['summary']
+
+
+def recipe_info_bulk(recipe_ids, deadline=None, priority=INTERACTIVE):
+    """Fetches detailed info for many recipes using Spoonacular's bulk
+    information endpoint, BULK_CHUNK_SIZE ids per call. Returns a dictionary
+    of recipe_id: info; recipes that couldn't be fetched are left out.
+
+    Cached recipes are not fetched again, and every fetched recipe is
+    cached, along with its summary, for later single-recipe lookups."""
+
+    return dict(iter_recipe_info_bulk(recipe_ids, deadline, priority))
+
+
+def iter_recipe_info_bulk(recipe_ids, deadline=None, priority=INTERACTIVE):
+    """Yields (recipe_id, info) pairs for recipe_info_bulk, cached recipes
+    first and then each chunk as its bulk call returns."""
+
+    missing = []
+
+    for recipe_id in dict.fromkeys(str(recipe_id) for recipe_id in recipe_ids):
+        info = recipe_cache.get(('information', recipe_id))
+        if info is not None:
+            yield recipe_id, info
+        else:
+            missing.append(recipe_id)
+
+    # Chunks run in parallel when a page needs more than one
+    calls = {}
+    for start in range(0, len(missing), BULK_CHUNK_SIZE):
+        chunk = missing[start:start + BULK_CHUNK_SIZE]
+        calls[start] = partial(client.get_json, '/recipes/informationBulk',
+                               params={'ids': ','.join(chunk),
+                                       'includeNutrition': 'false'},
+                               endpoint='informationBulk',
+                               priority=priority)
+
+    for _, chunk_infos in iter_gather(calls, deadline):
+        for info in chunk_infos:
+            recipe_id = str(info['id'])
+
+            recipe_cache.set(('information', recipe_id), info)
+            if info.get('summary'):
+                recipe_cache.set(('summary', recipe_id),
+                                 {'id': info['id'],
+                                  'title': info.get('title'),
+                                  'summary': info['summary']})
+
+            yield recipe_id, info
+
+
+def iter_gather(calls, deadline=None):
+    """Runs a dictionary of key: no-argument callable on the shared worker
+    pool. Yields (key, result) as each call succeeds, until deadline;
+    failed and unfinished calls are left out."""
 
-    return info_response.json()
+    futures = {summary_pool.submit(call): key for key, call in calls.items()}
 
+    # Wait for all calls together, never past the request's deadline
+    timeout = None
+    if deadline is not None:
+        timeout = max(deadline - time.monotonic(), 0)
 
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            if future.exception() is not None:
+                logger.warning("API call %s failed: %r", futures[future],
+                               future.exception())
+            else:
+                yield futures[future], future.result()
+    except TimeoutError:
+        pass
+    finally:
+        # Too slow (or abandoned); don't hold workers once dequeued
+        for future in futures:
+            future.cancel()
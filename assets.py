@@ -0,0 +1,167 @@
+""" Static asset pipeline: bundles and minifies our JS and CSS into
+content-hashed files under static/dist, with gzip (and, if the brotli
+package is installed, brotli) copies next to them. Build before deploying:
+
+    python assets.py
+
+Templates link bundles with asset_urls(name). Without a build, it links
+the unbundled source files instead, so development needs no build step.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+
+from flask import request, send_from_directory
+
+from compression import brotli
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+
+# Bundle name: source files under static/, in load order
+BUNDLES = {'app.css': ['css/style.css'],
+           'search.js': ['js/search-result.js', 'js/search-suggest.js',
+                         'js/bookmark-recipe.js']}
+
+# Hashed files never change, so browsers may keep them for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Parsed manifest.json of the current build, loaded on first use
+manifest = None
+
+
+def minify_js(source):
+    """Drops indentation, blank lines and whole-line // comments. Lines are
+    never joined, so automatic semicolon insertion is unaffected."""
+
+    lines = (line.strip() for line in source.splitlines())
+
+    return '\n'.join(line for line in lines
+                     if line and not line.startswith('//'))
+
+
+def minify_css(source):
+    """Drops comments and whitespace that doesn't separate tokens."""
+
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.DOTALL)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};,>])\s*', r'\1', source)
+    source = re.sub(r':\s+', ':', source)
+
+    return source.replace(';}', '}').strip()
+
+
+def build(dist_dir=None):
+    """Writes every bundle to dist_dir as name.<hash>.ext, with .gz and .br
+    siblings, and a manifest.json mapping bundle names to those files.
+    Returns the manifest."""
+
+    dist_dir = dist_dir or DIST_DIR
+    if not os.path.isdir(dist_dir):
+        os.makedirs(dist_dir)
+
+    built = {}
+
+    for name, sources in sorted(BUNDLES.items()):
+        minify = minify_js if name.endswith('.js') else minify_css
+        separator = '\n;\n' if name.endswith('.js') else '\n'
+
+        contents = []
+        for source in sources:
+            with open(os.path.join(STATIC_DIR, source)) as source_file:
+                contents.append(minify(source_file.read()))
+        data = separator.join(contents).encode('utf-8')
+
+        stem, extension = os.path.splitext(name)
+        filename = '{}.{}{}'.format(stem,
+                                    hashlib.sha256(data).hexdigest()[:12],
+                                    extension)
+        path = os.path.join(dist_dir, filename)
+
+        with open(path, 'wb') as out:
+            out.write(data)
+        with open(path + '.gz', 'wb') as out:
+            out.write(gzip.compress(data, compresslevel=9))
+        if brotli is not None:
+            with open(path + '.br', 'wb') as out:
+                out.write(brotli.compress(data))
+
+        built[name] = filename
+
+    with open(os.path.join(dist_dir, 'manifest.json'), 'w') as out:
+        json.dump(built, out, indent=2, sort_keys=True)
+
+    return built
+
+
+def load_manifest():
+    """Returns the current build's manifest, or {} if nothing is built."""
+
+    global manifest
+
+    if manifest is None:
+        try:
+            with open(os.path.join(DIST_DIR, 'manifest.json')) as source:
+                manifest = json.load(source)
+        except (IOError, ValueError):
+            manifest = {}
+
+    return manifest
+
+
+def asset_urls(name):
+    """Jinja helper: returns the URLs to load bundle name from, the hashed
+    bundle if built and the source files otherwise."""
+
+    filename = load_manifest().get(name)
+    if filename is not None:
+        return ['/static/dist/' + filename]
+
+    return ['/static/' + source for source in BUNDLES[name]]
+
+
+def send_asset(filename):
+    """Sends a built file from DIST_DIR, precompressed if the client accepts
+    a coding we have a copy in, with far-future immutable caching."""
+
+    accept_encodings = request.accept_encodings
+    sent = filename
+    encoding = None
+
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if (accept_encodings.quality(candidate) > 0
+                and os.path.isfile(os.path.join(DIST_DIR,
+                                                filename + suffix))):
+            sent = filename + suffix
+            encoding = candidate
+            break
+
+    response = send_from_directory(DIST_DIR, sent,
+                                   mimetype=mimetype_for(filename))
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+
+    return response
+
+
+def mimetype_for(filename):
+    """Returns the content type of a built file, by extension."""
+
+    if filename.endswith('.css'):
+        return 'text/css'
+    if filename.endswith('.js'):
+        return 'application/javascript'
+
+    return None
+
+
+if __name__ == "__main__":
+    for name, filename in sorted(build(*sys.argv[1:]).items()):
+        print("{} -> {}".format(name, filename))
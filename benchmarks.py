@@ -0,0 +1,219 @@
+""" Benchmarks for CookEase. They run against the test database, like
+tests.py:
+
+    python benchmarks.py            # run all benchmarks
+    python benchmarks.py queries    # run one
+
+Where a benchmark has a baseline it prints both, so the before and after
+figures come from the same run.
+"""
+
+import random
+import statistics
+import sys
+import time
+
+from flask import g
+from sqlalchemy import event
+
+from model import connect_to_db, db, example_data
+import facets
+import helper_functions
+import pantry
+from server import app, fragment_cache
+import suggest
+
+
+def count_queries(client, path):
+    """Returns how many SQL statements one GET of path runs."""
+
+    statements = []
+
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', _count)
+    try:
+        client.get(path)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', _count)
+
+    return len(statements)
+
+
+def load_user_eagerly():
+    """Baseline request preamble: loads the User row on every request and
+    skips the identity cache, as before current users were loaded lazily."""
+
+    if g.user_id:
+        g.current_user._get_current_object()
+    helper_functions.identity_cache.clear()
+
+
+def count_route_queries(client, paths, baseline=False):
+    """Returns the queries per request of each path in turn, starting from
+    cold caches. baseline runs them with load_user_eagerly."""
+
+    helper_functions.identity_cache.clear()
+    helper_functions.hydration_checked_at = None
+    fragment_cache.clear()
+    if baseline:
+        app.before_request_funcs[None].append(load_user_eagerly)
+    try:
+        return [count_queries(client, path) for path in paths]
+    finally:
+        if baseline:
+            app.before_request_funcs[None].remove(load_user_eagerly)
+
+
+def benchmark_queries():
+    """Queries per request for a logged-in user, per route, with the
+    current user loaded eagerly (before) and lazily (after)."""
+
+    app.config['TESTING'] = True
+    connect_to_db(app, "postgresql:///testdb")
+    db.create_all()
+    example_data()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+
+    paths = ['/', '/dashboard', '/favorite', '/favorite',
+             '/bookmark-display.json', '/metrics.json']
+    # Bare bookmarked recipes are still looked up, but never sent upstream
+    hydrate_recipes_later = helper_functions.hydrate_recipes_later
+    helper_functions.hydrate_recipes_later = lambda recipe_ids: None
+    try:
+        before = count_route_queries(client, paths, baseline=True)
+        after = count_route_queries(client, paths)
+        print("{:<24} {:>8} {:>8}".format("route", "before", "after"))
+        for path, old, new in zip(paths, before, after):
+            print("{:<24} {:>8} {:>8}".format(path, old, new))
+    finally:
+        helper_functions.hydrate_recipes_later = hydrate_recipes_later
+        db.session.close()
+        db.drop_all()
+
+
+def synthetic_recipes(count, ingredients=2000, seed=0):
+    """Returns count made-up recipes (recipe_id: set of ingredient ids)
+    with 5 to 20 ingredients each, common ingredients far more likely."""
+
+    rng = random.Random(seed)
+    weights = [1.0 / (rank + 1) for rank in range(ingredients)]
+
+    return {str(recipe_id): set(rng.choices(range(ingredients), weights,
+                                            k=rng.randint(5, 20)))
+            for recipe_id in range(count)}
+
+
+def time_ms(fn, repeat=20):
+    """Returns the median milliseconds one call of fn takes."""
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(timings)
+
+
+def benchmark_pantry():
+    """Pantry matching over 100k synthetic recipes."""
+
+    recipes = synthetic_recipes(100000)
+
+    start = time.perf_counter()
+    index = pantry.PantryIndex()
+    index.load(recipes)
+    print("built index of {} recipes in {:.0f} ms".format(
+        len(index), (time.perf_counter() - start) * 1000))
+
+    rng = random.Random(1)
+    print("{:<16} {:>10}".format("pantry size", "median ms"))
+    for size in [3, 10, 30]:
+        # Pantries lean towards common ingredients, like real ones
+        pantry_ids = set(rng.sample(range(200), size))
+        print("{:<16} {:>10.2f}".format(
+            size, time_ms(lambda: index.match(pantry_ids))))
+
+    print("{:<16} {:>10.2f}".format(
+        "add 1 recipe", time_ms(lambda: index.load({'new': {1, 2, 3}}))))
+
+
+def benchmark_suggest():
+    """Suggestions over 50k synthetic titles from a 5k word vocabulary."""
+
+    rng = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocabulary = [''.join(rng.choice(letters)
+                          for _ in range(rng.randint(4, 10)))
+                  for _ in range(5000)]
+
+    start = time.perf_counter()
+    suggester = suggest.Suggester()
+    for _ in range(50000):
+        suggester.add(' '.join(rng.sample(vocabulary, rng.randint(2, 5))))
+    print("indexed {} phrases, {} words in {:.0f} ms".format(
+        len(suggester), suggester.words.size,
+        (time.perf_counter() - start) * 1000))
+
+    words = rng.sample(vocabulary, 50)
+    typos = [word[:2] + word[3:] for word in words]
+    print("{:<16} {:>10}".format("lookup", "median ms"))
+    for name, typed in [("prefix", [word[:3] for word in words]),
+                        ("two words", [' '.join(words[i:i + 2])
+                                       for i in range(50)]),
+                        ("typo", typos)]:
+        print("{:<16} {:>10.3f}".format(
+            name, time_ms(lambda: [suggester.suggest(text)
+                                   for text in typed]) / len(typed)))
+
+
+def benchmark_facets():
+    """Facet filters and counts over 100k synthetic recipes."""
+
+    rng = random.Random(0)
+    recipes = {str(recipe_id): (rng.randint(0, 127),
+                                {'readyInMinutes': rng.randint(5, 180),
+                                 'pricePerServing': rng.uniform(20, 900),
+                                 'healthScore': rng.randint(0, 100),
+                                 'servings': rng.randint(1, 12)})
+               for recipe_id in range(100000)}
+
+    start = time.perf_counter()
+    index = facets.FacetIndex()
+    index.load(recipes)
+    print("built index of {} recipes in {:.0f} ms".format(
+        len(index), (time.perf_counter() - start) * 1000))
+
+    everything = index.bitset_of(recipes)
+    diets = ('vegetarian', 'glutenFree')
+    ranges = {'readyInMinutes': (None, 30), 'healthScore': (50, None)}
+
+    def row_by_row():
+        return [recipe_id for recipe_id, (flags, numbers) in recipes.items()
+                if flags & 0b101 == 0b101
+                and numbers['readyInMinutes'] <= 30
+                and numbers['healthScore'] >= 50]
+
+    print("{:<16} {:>10}".format("operation", "median ms"))
+    print("{:<16} {:>10.2f}".format(
+        "filter", time_ms(lambda: index.filter(everything, diets, ranges))))
+    print("{:<16} {:>10.2f}".format("row by row", time_ms(row_by_row)))
+    print("{:<16} {:>10.2f}".format(
+        "counts", time_ms(lambda: index.counts(everything))))
+
+
+BENCHMARKS = {'queries': benchmark_queries,
+              'facets': benchmark_facets,
+              'pantry': benchmark_pantry,
+              'suggest': benchmark_suggest}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print("== {} ==".format(name))
+        BENCHMARKS[name]()
@@ -0,0 +1,273 @@
+""" In-process caches shared by the Spoonacular API calls and the server. """
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Background refreshes for stale-while-revalidate entries
+refresh_pool = ThreadPoolExecutor(max_workers=2)
+
+
+class _Entry(object):
+    """One cached value and when it stops being fresh."""
+
+    __slots__ = ('value', 'expires_at', 'negative', 'size')
+
+    def __init__(self, value, expires_at, negative=False, size=0):
+        self.value = value
+        self.expires_at = expires_at
+        self.negative = negative
+        self.size = size
+
+
+class TTLCache(object):
+    """Bounded LRU cache whose entries expire after ttl seconds.
+
+    Expired entries are still served for stale_ttl more seconds while a
+    background refresh runs. Loader errors matching get_or_load's negative
+    check are cached for negative_ttl seconds and re-raised on every hit.
+
+    With stale_if_error, an expired entry that hasn't been evicted yet is
+    returned when reloading it fails, instead of the error.
+
+    If maxbytes is set, sizeof(value) is charged against it for every entry
+    and least recently used entries are evicted to stay under the cap."""
+
+    def __init__(self, maxsize=1024, ttl=3600, stale_ttl=0, negative_ttl=0,
+                 enabled=True, clock=time.monotonic, executor=None,
+                 maxbytes=None, sizeof=None, stale_if_error=False):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.stale_if_error = stale_if_error
+        self.enabled = enabled
+        self.clock = clock
+        self.executor = executor or refresh_pool
+
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(['hits', 'misses', 'stale_hits',
+                                     'negative_hits', 'stale_on_error',
+                                     'evictions', 'refreshes',
+                                     'refresh_errors'], 0)
+
+    def get(self, key, default=None):
+        """Returns the fresh value stored under key, or default."""
+
+        if not self.enabled:
+            return default
+
+        with self._lock:
+            entry = self._data.get(key)
+            if (entry is None or entry.negative
+                    or entry.expires_at <= self.clock()):
+                self._stats['misses'] += 1
+                return default
+
+            self._data.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry.value
+
+    def get_stale(self, key, default=None):
+        """Returns the value stored under key even if it has expired, as
+        long as it hasn't been evicted. For use when reloading fails."""
+
+        if not self.enabled:
+            return default
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry.negative:
+                return default
+
+            self._stats['stale_on_error'] += 1
+            return entry.value
+
+    def set(self, key, value, ttl=None):
+        """Stores value under key, evicting the least recently used entries
+        once maxsize is reached."""
+
+        if not self.enabled:
+            return
+
+        size = self.sizeof(value) if self.sizeof else 0
+        self._store(key, _Entry(value, self.clock() + (ttl or self.ttl),
+                                size=size))
+
+    def get_or_load(self, key, loader, negative=None):
+        """Returns the cached value for key, calling loader() on a miss.
+
+        negative, if given, is called with any error loader raises; when it
+        returns True the error itself is cached for negative_ttl seconds."""
+
+        if not self.enabled:
+            return loader()
+
+        with self._lock:
+            entry = self._data.get(key)
+            now = self.clock()
+
+            if entry is not None and now < entry.expires_at:
+                self._data.move_to_end(key)
+                if entry.negative:
+                    self._stats['negative_hits'] += 1
+                    raise entry.value
+                self._stats['hits'] += 1
+                return entry.value
+
+            stale = (entry is not None and not entry.negative
+                     and now < entry.expires_at + self.stale_ttl)
+            refresh = stale and key not in self._refreshing
+
+            if stale:
+                self._stats['stale_hits'] += 1
+                self._refreshing.add(key)
+            else:
+                self._stats['misses'] += 1
+
+        if stale:
+            # Serve the stale copy and refresh it in the background
+            if refresh:
+                self.executor.submit(self._refresh, key, loader)
+            return entry.value
+
+        try:
+            value = loader()
+        except Exception as error:
+            if negative is not None and self.negative_ttl and negative(error):
+                self._store(key, _Entry(error, now + self.negative_ttl,
+                                        negative=True))
+            elif (self.stale_if_error and entry is not None
+                    and not entry.negative):
+                with self._lock:
+                    self._stats['stale_on_error'] += 1
+                return entry.value
+            raise
+
+        self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        """Drops key from the cache, if present."""
+
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def clear(self):
+        """Drops every entry and resets the counters."""
+
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+            for name in self._stats:
+                self._stats[name] = 0
+
+    def stats(self):
+        """Returns hit/miss counters and the current size."""
+
+        with self._lock:
+            stats = dict(self._stats, size=len(self._data),
+                         bytes=self._bytes)
+
+        return stats
+
+    def _store(self, key, entry):
+        """Adds entry under key and trims the cache back to maxsize."""
+
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.size
+
+            self._data[key] = entry
+            self._bytes += entry.size
+
+            while self._data and (
+                    len(self._data) > self.maxsize
+                    or (self.maxbytes and self._bytes > self.maxbytes)):
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= evicted.size
+                self._stats['evictions'] += 1
+
+    def _refresh(self, key, loader):
+        """Reloads a stale entry. On failure the stale copy is kept."""
+
+        try:
+            self.set(key, loader())
+            outcome = 'refreshes'
+        except Exception:
+            outcome = 'refresh_errors'
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+        with self._lock:
+            self._stats[outcome] += 1
+
+
+class _Call(object):
+    """An in-flight call whose result is shared with waiting callers."""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key: the first caller runs
+    the call and everyone who asks for that key meanwhile waits for and
+    shares its result (or its error)."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {'leaders': 0, 'waiters': 0}
+
+    def do(self, key, fn):
+        """Returns fn(), sharing one call between concurrent callers."""
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._stats['leaders'] += 1
+            else:
+                self._stats['waiters'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def stats(self):
+        """Returns how many calls ran and how many callers piggybacked."""
+
+        with self._lock:
+            stats = dict(self._stats, in_flight=len(self._calls))
+
+        return stats
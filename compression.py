@@ -0,0 +1,75 @@
+""" gzip / brotli compression of HTML and JSON responses. """
+
+import gzip
+import os
+
+from flask import request
+
+# brotli is optional; without it responses are only ever gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this aren't worth compressing
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 5))
+
+COMPRESSIBLE_TYPES = ('text/html', 'application/json')
+
+
+def choose_encoding(accept_encodings):
+    """Returns the best content-coding the client accepts, preferring br
+    over gzip, or None."""
+
+    if brotli is not None and accept_encodings.quality('br') > 0:
+        return 'br'
+    if accept_encodings.quality('gzip') > 0:
+        return 'gzip'
+
+    return None
+
+
+def compress_response(response):
+    """after_request hook compressing HTML and JSON bodies of at least
+    COMPRESS_MIN_SIZE bytes for clients that accept it. A strong ETag gets
+    the coding appended, since the compressed bytes differ."""
+
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag('{}-{}'.format(etag, encoding))
+
+    return response
+
+
+def strip_encoding(etag):
+    """Returns etag without a content-coding compress_response appended."""
+
+    for encoding in ('-br', '-gzip'):
+        if etag.endswith(encoding):
+            return etag[:-len(encoding)]
+
+    return etag
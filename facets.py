@@ -0,0 +1,253 @@
+""" Diet and nutrition facets of stored recipes: filtering searches by them
+and counting how many results have each.
+
+Like the pantry index, recipes get dense positions 0..n-1 and sets of
+recipes are Python int bitsets. Each recipe's diet flags are packed into
+one small integer, and the index keeps them bit-sliced: plane i is the
+bitset of recipes with flag i, so requiring several diets is a few ANDs.
+Numeric fields (ready time, price, ...) are bit-sliced too, and a range
+filter compares every recipe against the bound at once, walking the
+planes from the top bit, instead of looping over recipes. """
+
+import threading
+
+from pantry import (BULK_UPDATE, bitset_from_positions, popcount,
+                    positions_of, sliced_from_values, sliced_set)
+
+# Spoonacular's boolean diet flags, in bit order of Recipe.diet_flags
+DIET_FLAGS = ('vegetarian', 'vegan', 'glutenFree', 'dairyFree', 'ketogenic',
+              'whole30', 'lowFodmap')
+
+# Spoonacular's numeric fields, by Recipe column. Prices are in US cents.
+NUMERIC_FACETS = {'readyInMinutes': 'ready_in_minutes',
+                  'pricePerServing': 'price_per_serving',
+                  'healthScore': 'health_score',
+                  'servings': 'servings'}
+
+# Request parameter: (numeric facet, which end of its range it bounds)
+RANGE_PARAMS = {'max_ready_time': ('readyInMinutes', 'max'),
+                'max_price': ('pricePerServing', 'max'),
+                'min_health_score': ('healthScore', 'min'),
+                'min_servings': ('servings', 'min'),
+                'max_servings': ('servings', 'max')}
+
+# Counts returned for each numeric facet: recipes at most (or at least)
+# each of these values
+FACET_BUCKETS = {'readyInMinutes': ('max', (15, 30, 45, 60)),
+                 'pricePerServing': ('max', (100, 200, 300, 500)),
+                 'healthScore': ('min', (25, 50, 75)),
+                 'servings': ('min', (2, 4, 6))}
+
+# Spoonacular search takes one diet, and some flags as intolerances;
+# ketogenic, whole30, lowFodmap and numeric ranges can't be sent
+UPSTREAM_DIETS = ('vegan', 'vegetarian')
+UPSTREAM_INTOLERANCES = {'glutenFree': 'gluten', 'dairyFree': 'dairy'}
+
+
+def diet_flags_of(info):
+    """Packs the diet flags of a Spoonacular recipe info into an int."""
+
+    flags = 0
+    for bit, flag in enumerate(DIET_FLAGS):
+        if info.get(flag):
+            flags |= 1 << bit
+
+    return flags
+
+
+def sliced_at_most(planes, value, within):
+    """Returns the positions in bitset within whose value in planes is at
+    most value."""
+
+    if value < 0:
+        return 0
+    if value >> len(planes):
+        return within
+
+    below = 0
+    equal = within
+    for i in reversed(range(len(planes))):
+        if value >> i & 1:
+            below |= equal & ~planes[i]
+            equal &= planes[i]
+        else:
+            equal &= ~planes[i]
+
+    return below | equal
+
+
+def sliced_at_least(planes, value, within):
+    """Returns the positions in bitset within whose value in planes is at
+    least value."""
+
+    if value <= 0:
+        return within
+
+    return within & ~sliced_at_most(planes, value - 1, within)
+
+
+def parse_filters(args):
+    """Reads facet filters from request arguments: diet=vegan,glutenFree
+    and the RANGE_PARAMS bounds. Unknown diets and values that aren't
+    finite numbers are ignored. Returns (diet names, {facet: (min, max)}), with
+    None for an open end."""
+
+    diets = tuple(sorted(set(diet for diet in
+                             (args.get('diet') or '').split(',')
+                             if diet in DIET_FLAGS)))
+
+    ranges = {}
+    for param, (facet, end) in sorted(RANGE_PARAMS.items()):
+        try:
+            value = int(round(float(args.get(param))))
+        except (TypeError, ValueError, OverflowError):
+            continue
+        low, high = ranges.get(facet, (None, None))
+        ranges[facet] = (value, high) if end == 'min' else (low, value)
+
+    return diets, ranges
+
+
+def upstream_params(diets, ranges):
+    """Maps facet filters to Spoonacular search parameters. Returns the
+    parameters and the sorted filter names they couldn't express."""
+
+    params = {}
+    unsent = [diet for diet in diets if diet not in UPSTREAM_DIETS
+              and diet not in UPSTREAM_INTOLERANCES]
+
+    # Vegan implies vegetarian, so send the stricter one
+    for diet in UPSTREAM_DIETS:
+        if diet in diets:
+            params['diet'] = diet
+            break
+
+    intolerances = sorted(UPSTREAM_INTOLERANCES[diet] for diet in diets
+                          if diet in UPSTREAM_INTOLERANCES)
+    if intolerances:
+        params['intolerances'] = ','.join(intolerances)
+
+    unsent += list(ranges)
+
+    return params, sorted(unsent)
+
+
+class FacetIndex(object):
+    """Diet flags and numeric fields of stored recipes, bit-sliced, for
+    filtering and counting sets of recipes. Recipes missing a numeric field
+    match no range on it. Thread-safe; queries see either all of an update
+    or none of it."""
+
+    def __init__(self):
+        self.recipe_ids = []
+        self.positions = {}
+        self.flags = []
+        self.values = {facet: [] for facet in NUMERIC_FACETS}
+        self.flag_planes = []
+        self.planes = {facet: [] for facet in NUMERIC_FACETS}
+        self.known = {facet: 0 for facet in NUMERIC_FACETS}
+        # Newest Recipe.fetched_at loaded, for incremental refresh
+        self.watermark = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.recipe_ids)
+
+    def load(self, recipes):
+        """Adds or updates many recipes at once. recipes is a dictionary of
+        recipe_id: (diet flags, {numeric facet: value or None})."""
+
+        with self._lock:
+            changed = []
+
+            for recipe_id, (flags, numbers) in recipes.items():
+                position = self.positions.get(recipe_id)
+                if position is None:
+                    position = len(self.recipe_ids)
+                    self.recipe_ids.append(recipe_id)
+                    self.positions[recipe_id] = position
+                    self.flags.append(0)
+                    for facet in NUMERIC_FACETS:
+                        self.values[facet].append(None)
+
+                self.flags[position] = flags or 0
+                for facet in NUMERIC_FACETS:
+                    value = numbers.get(facet)
+                    self.values[facet][position] = (
+                        None if value is None else max(int(round(value)), 0))
+                changed.append(position)
+
+            # Small updates patch the planes; big ones rebuild them
+            if len(changed) > BULK_UPDATE:
+                self.flag_planes = sliced_from_values(self.flags)
+                for facet, values in self.values.items():
+                    self.planes[facet] = sliced_from_values(
+                        [value or 0 for value in values])
+                    self.known[facet] = bitset_from_positions(
+                        position for position, value in enumerate(values)
+                        if value is not None)
+                return
+
+            for position in changed:
+                sliced_set(self.flag_planes, position, self.flags[position])
+                for facet, values in self.values.items():
+                    sliced_set(self.planes[facet], position,
+                               values[position] or 0)
+                    if values[position] is None:
+                        self.known[facet] &= ~(1 << position)
+                    else:
+                        self.known[facet] |= 1 << position
+
+    def bitset_of(self, recipe_ids):
+        """Returns the bitset of the indexed recipes among recipe_ids."""
+
+        return bitset_from_positions(self.positions[recipe_id]
+                                     for recipe_id in recipe_ids
+                                     if recipe_id in self.positions)
+
+    def recipes_in(self, bitset):
+        """Returns the recipe ids in bitset, in position order."""
+
+        return [self.recipe_ids[position]
+                for position in positions_of(bitset)]
+
+    def filter(self, within, diets=(), ranges=None):
+        """Returns the recipes in bitset within having every diet in diets
+        and each numeric facet in ranges within its (min, max)."""
+
+        with self._lock:
+            for diet in diets:
+                bit = DIET_FLAGS.index(diet)
+                within &= (self.flag_planes[bit]
+                           if bit < len(self.flag_planes) else 0)
+
+            for facet, (low, high) in (ranges or {}).items():
+                within &= self.known[facet]
+                if low is not None:
+                    within = sliced_at_least(self.planes[facet], low, within)
+                if high is not None:
+                    within = sliced_at_most(self.planes[facet], high, within)
+
+            return within
+
+    def counts(self, within):
+        """Counts the recipes in bitset within having each diet and falling
+        in each FACET_BUCKETS bucket."""
+
+        with self._lock:
+            counts = {'diets': {}}
+            for bit, diet in enumerate(DIET_FLAGS):
+                counts['diets'][diet] = (
+                    popcount(within & self.flag_planes[bit])
+                    if bit < len(self.flag_planes) else 0)
+
+            for facet, (end, bounds) in sorted(FACET_BUCKETS.items()):
+                compare = sliced_at_most if end == 'max' else sliced_at_least
+                known = within & self.known[facet]
+                counts[facet] = [
+                    {end: bound,
+                     'count': popcount(compare(self.planes[facet], bound,
+                                               known))}
+                    for bound in bounds]
+
+            return counts
@@ -2,13 +2,254 @@
 
 # Import model.py table definitions
 from model import connect_to_db, db, User,Recipe,Bookmark
+from model import Aisle, Cuisine, Ingredient, RecipeCuisine, RecipeIngredient
+from model import PLAINTEXT_MARKER
 
 
 # Password hashing library
-from passlib.apps import custom_app_context as pwd_context
+from passlib.context import CryptContext
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+import hmac
+import html
+import logging
+import multiprocessing
+import os
+import threading
+import time
 
 # Import file with all the Spoonacular API calls
 import api_calls
+from cache import TTLCache
+import facets
+import pantry
+import suggest
+from text_utils import normalize_query
+
+from sqlalchemy import event, or_, text
+from sqlalchemy.dialects.postgresql import insert
+
+
+# Username and email of recently seen users, so pages that only show them
+# don't query the DB each time. Entries are dropped when this process
+# updates the user; other processes see changes within the TTL.
+identity_cache = TTLCache(maxsize=int(os.getenv('USER_CACHE_SIZE', 10000)),
+                          ttl=float(os.getenv('USER_CACHE_TTL', 60)))
+
+
+# Password hashing cost. New hashes use the first scheme with
+# PASSWORD_ROUNDS rounds; hashes made with other schemes or fewer rounds
+# still verify, and are rehashed the next time their user logs in.
+PASSWORD_SCHEMES = os.getenv('PASSWORD_SCHEMES',
+                             'sha512_crypt,sha256_crypt').split(',')
+PASSWORD_ROUNDS = int(os.getenv('PASSWORD_ROUNDS', 656000))
+# Schemes stored hashes may still use. They stay known to the context after
+# being dropped from PASSWORD_SCHEMES, so those hashes keep verifying
+# (and get rehashed) instead of becoming unidentifiable.
+PASSWORD_DEPRECATED_SCHEMES = [scheme for scheme in os.getenv(
+    'PASSWORD_DEPRECATED_SCHEMES', 'sha256_crypt,md5_crypt').split(',')
+    if scheme and scheme not in PASSWORD_SCHEMES]
+
+pwd_context = CryptContext(
+    schemes=PASSWORD_SCHEMES + PASSWORD_DEPRECATED_SCHEMES,
+    deprecated=PASSWORD_SCHEMES[1:] + PASSWORD_DEPRECATED_SCHEMES,
+    **{PASSWORD_SCHEMES[0] + '__default_rounds': PASSWORD_ROUNDS,
+       PASSWORD_SCHEMES[0] + '__min_rounds': PASSWORD_ROUNDS})
+
+# Adds the bookmark and, if needed, a bare recipe row for it to point to
+BOOKMARK_RECIPE_SQL = text("""
+    WITH new_recipe AS (
+        INSERT INTO recipes (recipe_id) VALUES (:recipe_id)
+        ON CONFLICT DO NOTHING
+        RETURNING recipe_id
+    )
+    INSERT INTO bookmarks (user_id, recipe_id) VALUES (:user_id, :recipe_id)
+    ON CONFLICT (user_id, recipe_id) DO NOTHING
+    RETURNING bookmark_id, (SELECT count(*) FROM new_recipe) AS new_recipe
+""")
+
+# Bulk versions for batch bookmark updates: each takes an array of ids
+BOOKMARK_RECIPES_SQL = text("""
+    WITH new_recipes AS (
+        INSERT INTO recipes (recipe_id)
+        SELECT unnest(CAST(:recipe_ids AS varchar[]))
+        ON CONFLICT DO NOTHING
+        RETURNING recipe_id
+    )
+    INSERT INTO bookmarks (user_id, recipe_id)
+    SELECT :user_id, unnest(CAST(:recipe_ids AS varchar[]))
+    ON CONFLICT (user_id, recipe_id) DO NOTHING
+    RETURNING recipe_id,
+              recipe_id IN (SELECT recipe_id FROM new_recipes) AS new_recipe
+""")
+
+UNBOOKMARK_RECIPES_SQL = text("""
+    DELETE FROM bookmarks
+    WHERE user_id = :user_id AND recipe_id = ANY(CAST(:recipe_ids AS varchar[]))
+    RETURNING recipe_id
+""")
+
+# Marks a user's bookmarks as changed
+BUMP_BOOKMARK_VERSION_SQL = text("""
+    UPDATE users SET bookmark_version = bookmark_version + 1
+    WHERE user_id = :user_id
+""")
+
+# Same, for everyone who bookmarked any of an array of recipes
+BUMP_BOOKMARKERS_VERSION_SQL = text("""
+    UPDATE users SET bookmark_version = bookmark_version + 1
+    WHERE user_id IN (
+        SELECT user_id FROM bookmarks
+        WHERE recipe_id = ANY(CAST(:recipe_ids AS varchar[]))
+    )
+""")
+
+# Rebuilds the full-text search document of an array of recipes
+INDEX_RECIPES_SQL = text("""
+    UPDATE recipes SET search_vector =
+        setweight(to_tsvector('english', coalesce(recipes.recipe_name, '')),
+                  'A') ||
+        setweight(to_tsvector('english', coalesce(names.names, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(recipes.instructions, '')),
+                  'C')
+    FROM (
+        SELECT recipes.recipe_id, string_agg(ingredients.name, ' ') AS names
+        FROM recipes
+        LEFT JOIN recipe_ingredients
+            ON recipe_ingredients.recipe_id = recipes.recipe_id
+        LEFT JOIN ingredients
+            ON ingredients.ingredient_id = recipe_ingredients.ingredient_id
+        WHERE recipes.recipe_id = ANY(CAST(:recipe_ids AS varchar[]))
+        GROUP BY recipes.recipe_id
+    ) AS names
+    WHERE recipes.recipe_id = names.recipe_id
+""")
+
+# Snippets mark matched words with these control characters rather than
+# HTML, so that snippet_html can escape the stored text around them
+SNIPPET_START = '\x02'
+SNIPPET_STOP = '\x03'
+SNIPPET_OPTIONS = ('MaxWords=35, MinWords=15, StartSel="{}", StopSel="{}"'
+                   .format(SNIPPET_START, SNIPPET_STOP))
+
+# One page of stored recipes matching every search term, best first, with
+# a highlighted snippet of the instructions as summary. Only hits ranked at
+# least :min_rank count. The snippet is only built for the page returned.
+SEARCH_RECIPES_SQL = text("""
+    SELECT hits.recipe_id, hits.recipe_name, hits.img_url, hits.total,
+           ts_headline('english', coalesce(hits.instructions, ''), query,
+                       :snippet_options) AS summary
+    FROM (
+        SELECT recipe_id, recipe_name, img_url, instructions,
+               ts_rank_cd(search_vector, query) AS rank,
+               count(*) OVER () AS total
+        FROM recipes, plainto_tsquery('english', :query) AS query
+        WHERE search_vector @@ query
+          AND ts_rank_cd(search_vector, query) >= :min_rank
+        ORDER BY rank DESC, recipe_id
+        LIMIT :number OFFSET :offset
+    ) AS hits, plainto_tsquery('english', :query) AS query
+    ORDER BY hits.rank DESC, hits.recipe_id
+""")
+
+# Every stored recipe matching every search term, best first, for
+# filtering by facets before a page is cut
+SEARCH_RECIPE_IDS_SQL = text("""
+    SELECT recipe_id
+    FROM recipes, plainto_tsquery('english', :query) AS query
+    WHERE search_vector @@ query
+      AND ts_rank_cd(search_vector, query) >= :min_rank
+    ORDER BY ts_rank_cd(search_vector, query) DESC, recipe_id
+""")
+
+# The page of recipe_ids cut from SEARCH_RECIPE_IDS_SQL, with snippets
+SEARCH_PAGE_SQL = text("""
+    SELECT recipe_id, recipe_name, img_url,
+           ts_headline('english', coalesce(instructions, ''), query,
+                       :snippet_options) AS summary
+    FROM recipes, plainto_tsquery('english', :query) AS query
+    WHERE recipe_id = ANY(CAST(:recipe_ids AS varchar[]))
+""")
+
+# Searches are answered from stored recipes, without Spoonacular, when at
+# least LOCAL_SEARCH_MIN_HITS of them rank LOCAL_SEARCH_MIN_RANK or better
+LOCAL_SEARCH = os.getenv('LOCAL_SEARCH', '1') != '0'
+LOCAL_SEARCH_MIN_HITS = int(os.getenv('LOCAL_SEARCH_MIN_HITS', 10))
+LOCAL_SEARCH_MIN_RANK = float(os.getenv('LOCAL_SEARCH_MIN_RANK', 0.1))
+
+# Stored recipes by ingredient, for pantry matching. Loaded on first use
+# and topped up with newly ingested recipes before every query.
+pantry_index = pantry.PantryIndex()
+
+# Diet flags and numeric fields of stored recipes, for filtering searches.
+# Loaded on first use and topped up with newly stored recipes before every
+# faceted search.
+facet_index = facets.FacetIndex()
+
+# Recipe.fetched_at is stamped before the recipe's transaction commits, so a
+# recipe can show up after newer ones were loaded. Incremental refreshes
+# read again the recipes fetched up to RECIPE_RESCAN_SECONDS before the
+# newest one loaded.
+RECIPE_RESCAN_SECONDS = float(os.getenv('RECIPE_RESCAN_SECONDS', 300))
+
+# Recipes given facet columns per commit when backfilling recipes stored
+# before the columns existed
+FACET_BACKFILL_BATCH = int(os.getenv('FACET_BACKFILL_BATCH', 500))
+
+# Search box suggestions from stored recipe titles, ingredient names and
+# repeated searches that found recipes. Topped up with newly stored recipes
+# at most every SUGGEST_REFRESH_SECONDS.
+suggester = suggest.Suggester()
+SUGGEST_REFRESH_SECONDS = float(os.getenv('SUGGEST_REFRESH_SECONDS', 30))
+
+# Most recipes one pantry query may return
+MAX_PANTRY_MATCHES = int(os.getenv('MAX_PANTRY_MATCHES', 50))
+
+# Row ids are handed out at insert but become visible at commit, so a slow
+# transaction can commit ids below ones already loaded. Ids skipped over
+# (among the newest PANTRY_MAX_GAPS) are looked for again until they show
+# up or are PANTRY_GAP_SECONDS old, by when they were rolled back or
+# deleted.
+PANTRY_GAP_SECONDS = float(os.getenv('PANTRY_GAP_SECONDS', 300))
+PANTRY_MAX_GAPS = int(os.getenv('PANTRY_MAX_GAPS', 1000))
+
+# Bookmarked recipes listed per page on the profile page and carousel
+BOOKMARKS_PER_PAGE = int(os.getenv('BOOKMARKS_PER_PAGE', 50))
+
+# Most recipe ids one batch bookmark request may change
+MAX_BATCH_BOOKMARKS = int(os.getenv('MAX_BATCH_BOOKMARKS', 200))
+
+# Background worker filling in recipes added by bookmarking
+hydration_pool = ThreadPoolExecutor(max_workers=1)
+
+# Bare recipes that hydration missed (Spoonacular down, out of quota, ...)
+# are tried again while bookmarks are being viewed: HYDRATION_RETRY_SECONDS
+# after the first try, backing off up to HYDRATION_MAX_RETRY_SECONDS.
+# recipe_id: (failed tries, time.monotonic() it may be tried again)
+HYDRATION_RETRY_SECONDS = float(os.getenv('HYDRATION_RETRY_SECONDS', 60))
+HYDRATION_MAX_RETRY_SECONDS = float(
+    os.getenv('HYDRATION_MAX_RETRY_SECONDS', 3600))
+hydration_retries = {}
+hydration_checked_at = None
+hydration_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+# Hashing is deliberately slow, so it runs in a few worker processes
+# rather than on the thread serving the request
+PASSWORD_WORKERS = int(os.getenv('PASSWORD_WORKERS', 2))
+password_pool = None
+password_pool_pid = None
+password_pool_lock = threading.Lock()
+
+# Workers are started from a clean server process, never forked from this
+# one: its other threads may hold locks that a forked child would inherit
+# held, and deadlock on
+PASSWORD_START_METHOD = ('forkserver'
+                         if 'forkserver'
+                         in multiprocessing.get_all_start_methods()
+                         else 'spawn')
 
 
 def check_if_user_exists(username):
@@ -19,12 +260,70 @@ def check_if_user_exists(username):
 
 
 
-def check_if_bookmark_exists(recipe_id, user_id):
-    """Check if bookmark exists in DB. If so, returns instantiated Bookmark
-    object. Returns none if bookmark not found."""
+def get_user_identity(user_id):
+    """Returns a dictionary with user_id, username and email for user_id,
+    from the identity cache when possible. Returns None if user not
+    found."""
+
+    def load_identity():
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        return {'user_id': user.user_id, 'username': user.username,
+                'email': user.email}
+
+    identity = identity_cache.get_or_load(int(user_id), load_identity)
+    if identity is None:
+        identity_cache.invalidate(int(user_id))
+
+    return identity
+
+
+@event.listens_for(User, 'after_update')
+def invalidate_user_identity(mapper, connection, user):
+    """Drops a user's cached identity whenever their row is updated."""
+
+    identity_cache.invalidate(user.user_id)
+
+
+def get_bookmark_version(user_id):
+    """Returns the version counter of user_id's bookmarks, or None if user
+    not found."""
+
+    return (db.session.query(User.bookmark_version)
+            .filter(User.user_id == user_id).scalar())
+
+
+def get_bookmarked_recipes(user_id, after=None, limit=None):
+    """Returns one page of recipes bookmarked by user_id, newest first, and
+    the cursor for the next page (None on the last page). Pass that cursor
+    back as after to get the next page.
+
+    Each recipe is a row with bookmark_id, recipe_id, recipe_name and
+    img_url, selected in a single joined query; instructions and payloads
+    are never loaded."""
+
+    limit = limit or BOOKMARKS_PER_PAGE
+
+    query = (db.session.query(Bookmark.bookmark_id, Recipe.recipe_id,
+                              Recipe.recipe_name, Recipe.img_url)
+             .join(Recipe, Bookmark.recipe_id == Recipe.recipe_id)
+             .filter(Bookmark.user_id == user_id))
+
+    # Keyset pagination: continue below the last bookmark already shown
+    if after is not None:
+        query = query.filter(Bookmark.bookmark_id < after)
+
+    recipes = (query.order_by(Bookmark.bookmark_id.desc())
+               .limit(limit + 1).all())
+
+    next_cursor = None
+    if len(recipes) > limit:
+        recipes = recipes[:limit]
+        next_cursor = recipes[-1].bookmark_id
+
+    return recipes, next_cursor
 
-    return Bookmark.query.filter((Bookmark.recipe_id == recipe_id) &
-                                 (Bookmark.user_id == user_id)).first()
 
   
 def check_if_recipe_exists(recipe_id):
@@ -40,11 +339,80 @@ def check_if_recipe_exists(recipe_id):
 
 
 
+def get_password_pool():
+    """Returns this process's password hashing pool, starting it on first
+    use (and again after a fork, e.g. in each gunicorn worker)."""
+
+    global password_pool, password_pool_pid
+
+    if password_pool_pid != os.getpid():
+        with password_pool_lock:
+            if password_pool_pid != os.getpid():
+                password_pool = ProcessPoolExecutor(
+                    max_workers=PASSWORD_WORKERS,
+                    mp_context=multiprocessing.get_context(
+                        PASSWORD_START_METHOD))
+                password_pool_pid = os.getpid()
+
+    return password_pool
+
+
+def _hash_password(password):
+    """Hashes password. Runs in the password pool."""
+
+    return pwd_context.hash(password)
+
+
+def _verify_password(password, stored_hash):
+    """Checks password against stored_hash. Returns (verified, new_hash),
+    where new_hash is set if the hash's cost settings are out of date.
+    Runs in the password pool."""
+
+    return pwd_context.verify_and_update(password, stored_hash)
+
+
+def hash_password(password):
+    """Hashes password with the configured scheme and cost."""
+
+    return get_password_pool().submit(_hash_password, password).result()
+
+
+def verify_password(user, password):
+    """Checks password against user's stored hash without hashing it anew.
+    Hashes with outdated cost settings are replaced on success, as are
+    passwords stored before hashing was added. Stored values that are
+    neither marked plaintext nor a known hash never verify."""
+
+    if user.password.startswith(PLAINTEXT_MARKER):
+        # Legacy row storing the password itself
+        stored_password = user.password[len(PLAINTEXT_MARKER):]
+        verified = hmac.compare_digest(stored_password.encode('utf-8'),
+                                       password.encode('utf-8'))
+        new_hash = hash_password(password) if verified else None
+    elif pwd_context.identify(user.password, required=False) is None:
+        logger.warning("User %s has a password of unknown scheme",
+                       user.user_id)
+        return False
+    else:
+        verified, new_hash = (get_password_pool()
+                              .submit(_verify_password, password,
+                                      user.password)
+                              .result())
+
+    if new_hash:
+        user.password = new_hash
+        db.session.commit()
+
+    return verified
+
+
+
+
 def add_user(username, email, password):
     """Adds user to Users table in DB. Returns instantiated user object."""
 
     # Hash pw
-    hash = pwd_context.hash(password)
+    hash = hash_password(password)
 
     new_user = User(username=username, email=email, password=hash)
     db.session.add(new_user)
@@ -53,46 +421,618 @@ def add_user(username, email, password):
     return new_user
 
 
+def ingest_recipe_details(infos):
+    """Writes the ingredients, aisles and cuisines of already stored
+    recipes to their tables, replacing any rows the recipes had. infos is a
+    dictionary of recipe_id: Spoonacular recipe info.
 
+    However many recipes there are, each table gets one multi-row statement.
+    Ingredients are deduplicated by Spoonacular ingredient id (per recipe
+    too, keeping the first line), and aisles and cuisines by name. Doesn't
+    commit."""
 
-def add_recipe(recipe_id):
-    """ Adds recipe to Recipes table, which also populates the following
-    tables: Ingredient, Aisle, Cuisine, RecipeIngredient. Returns new Recipe
-    object back to server."""
+    aisles = set()
+    ingredients = {}
+    recipe_ingredients = {}
+    recipe_cuisines = set()
 
-    # Get info from API and store as json
-    info_response = api_calls.recipe_info(recipe_id)
+    for recipe_id, info in infos.items():
+        for item in info.get('extendedIngredients') or []:
+            # Spoonacular gives ingredients it doesn't recognize no id
+            if not item.get('id') or item['id'] < 0:
+                continue
 
-    # Add new recipe to DB
-    new_recipe = Recipe(recipe_id=recipe_id,
-                        recipe_name=info_response['title'],
-                        img_url=info_response['image'],
-                        instructions=info_response['instructions'])
+            if item.get('aisle'):
+                aisles.add(item['aisle'])
+            ingredients.setdefault(item['id'], item)
+            recipe_ingredients.setdefault((recipe_id, item['id']),
+                                          {'recipe_id': recipe_id,
+                                           'ingredient_id': item['id'],
+                                           'amount': item.get('amount'),
+                                           'unit': item.get('unit'),
+                                           'original_string':
+                                               item.get('originalString')})
+
+        for cuisine in info.get('cuisines') or []:
+            recipe_cuisines.add((recipe_id, cuisine.lower()))
+
+    aisle_ids = add_names(Aisle, aisles)
+    cuisine_ids = add_names(Cuisine, {name for _, name in recipe_cuisines})
+
+    if ingredients:
+        db.session.execute(
+            insert(Ingredient.__table__).values(
+                [{'ingredient_id': ingredient_id,
+                  'name': item['name'].lower(),
+                  'aisle_id': aisle_ids.get(item.get('aisle')),
+                  'img_url': item.get('image')}
+                 for ingredient_id, item in ingredients.items()])
+            .on_conflict_do_nothing(index_elements=['ingredient_id']))
+
+    recipe_ids = list(infos)
+
+    RecipeIngredient.query.filter(
+        RecipeIngredient.recipe_id.in_(recipe_ids)).delete(
+            synchronize_session=False)
+    # A concurrent ingest of the same recipe may have added its rows since
+    # the delete; keep those
+    if recipe_ingredients:
+        db.session.execute(
+            insert(RecipeIngredient.__table__)
+            .values(list(recipe_ingredients.values()))
+            .on_conflict_do_nothing(
+                index_elements=['recipe_id', 'ingredient_id']))
+
+    RecipeCuisine.query.filter(
+        RecipeCuisine.recipe_id.in_(recipe_ids)).delete(
+            synchronize_session=False)
+    if recipe_cuisines:
+        db.session.execute(RecipeCuisine.__table__.insert().values(
+            [{'recipe_id': recipe_id, 'cuisine_id': cuisine_ids[name]}
+             for recipe_id, name in recipe_cuisines]))
+
+    index_recipes(recipe_ids)
+
+
+def index_recipes(recipe_ids=None):
+    """Rebuilds the full-text search document of recipe_ids (of every
+    stored recipe if None) from their stored title, ingredients and
+    instructions. Doesn't commit."""
+
+    if recipe_ids is None:
+        recipe_ids = [recipe_id for recipe_id,
+                      in db.session.query(Recipe.recipe_id)]
+
+    if recipe_ids:
+        db.session.execute(INDEX_RECIPES_SQL,
+                           {'recipe_ids': list(recipe_ids)})
+
+
+def refresh_pantry_index():
+    """Loads the recipe ingredients stored since pantry_index last looked,
+    including rows that committed late (see PANTRY_GAP_SECONDS). Recipes
+    with any new row are reloaded whole, so a re-ingest replaces them."""
+
+    now = time.monotonic()
+    gaps = pantry_index.gaps
+    for row_id, missed_at in list(gaps.items()):
+        if now - missed_at > PANTRY_GAP_SECONDS:
+            del gaps[row_id]
+
+    changed = (RecipeIngredient.recipe_ingredient_id
+               > pantry_index.watermark)
+    if gaps:
+        changed = or_(changed,
+                      RecipeIngredient.recipe_ingredient_id.in_(list(gaps)))
+
+    touched = db.session.query(RecipeIngredient.recipe_id).filter(changed)
+    rows = (db.session.query(RecipeIngredient.recipe_ingredient_id,
+                             RecipeIngredient.recipe_id,
+                             RecipeIngredient.ingredient_id)
+            .filter(RecipeIngredient.recipe_id.in_(touched.subquery()))
+            .all())
+    if not rows:
+        return
+
+    recipe_ingredients = {}
+    for _, recipe_id, ingredient_id in rows:
+        recipe_ingredients.setdefault(recipe_id, set()).add(ingredient_id)
+
+    new_ingredient_ids = {ingredient_id for _, _, ingredient_id in rows
+                          if ingredient_id not in pantry_index.names}
+    names = {}
+    if new_ingredient_ids:
+        names = dict(db.session.query(Ingredient.ingredient_id,
+                                      Ingredient.name)
+                     .filter(Ingredient.ingredient_id.in_(
+                         list(new_ingredient_ids))))
+
+    pantry_index.load(recipe_ingredients, names)
+
+    loaded = {row_id for row_id, _, _ in rows}
+    for row_id in loaded:
+        gaps.pop(row_id, None)
+
+    top = max(loaded)
+    if top > pantry_index.watermark:
+        for row_id in range(max(pantry_index.watermark + 1,
+                                top - PANTRY_MAX_GAPS), top):
+            if row_id not in loaded:
+                gaps.setdefault(row_id, now)
+        pantry_index.watermark = top
+
+
+def backfill_facets():
+    """Fills in the facet columns of recipes whose info was stored before
+    those columns existed, from the stored payload, FACET_BACKFILL_BATCH
+    recipes per commit."""
+
+    while True:
+        recipes = (Recipe.query
+                   .filter(Recipe.diet_flags.is_(None),
+                           Recipe.payload.isnot(None))
+                   .limit(FACET_BACKFILL_BATCH).all())
+        if not recipes:
+            return
+
+        for recipe in recipes:
+            fill_facets(recipe, recipe.info)
+        db.session.commit()
 
-    db.session.add(new_recipe)
-    db.session.commit()
 
-    
-    ingredients_info = info_response['extendedIngredients']
-    
+def refresh_facet_index():
+    """Loads the facets of recipes stored since facet_index last looked.
+    The first load backfills recipes stored without facets."""
 
-    
+    if facet_index.watermark is None:
+        backfill_facets()
 
-    return new_recipe
+    columns = [getattr(Recipe, column)
+               for column in facets.NUMERIC_FACETS.values()]
+    query = (db.session.query(Recipe.recipe_id, Recipe.diet_flags,
+                              Recipe.fetched_at, *columns)
+             .filter(Recipe.diet_flags.isnot(None)))
+    if facet_index.watermark is not None:
+        query = query.filter(
+            Recipe.fetched_at >= facet_index.watermark
+            - timedelta(seconds=RECIPE_RESCAN_SECONDS))
 
+    rows = query.all()
+    if not rows:
+        return
 
+    facet_index.load({row[0]: (row[1], dict(zip(facets.NUMERIC_FACETS,
+                                                row[3:])))
+                      for row in rows})
+    # Late recipes are older than the watermark, which never moves back
+    newest = max((row[2] for row in rows if row[2] is not None),
+                 default=None)
+    if newest is not None and (facet_index.watermark is None
+                               or newest > facet_index.watermark):
+        facet_index.watermark = newest
 
 
+def refresh_suggestions():
+    """Adds the recipe titles and ingredient names stored since suggester
+    last looked, at most every SUGGEST_REFRESH_SECONDS."""
 
+    now = time.monotonic()
+    if (suggester.refreshed_at is not None
+            and now - suggester.refreshed_at < SUGGEST_REFRESH_SECONDS):
+        return
+    suggester.refreshed_at = now
 
-def add_bookmark(user_id, recipe_id):
-    """Adds recipe to Bookmarks table. Returns instantiated Bookmark object."""
+    recipes = (db.session.query(Recipe.recipe_id, Recipe.recipe_name,
+                                Recipe.fetched_at)
+               .filter(Recipe.recipe_name.isnot(None)))
 
-    new_bookmark = Bookmark(user_id=user_id, recipe_id=recipe_id)
+    if suggester.watermark is None:
+        recipes = recipes.all()
+        ingredients = db.session.query(Ingredient.name).all()
+    else:
+        # Every recipe fetched lately, with or without ingredient rows
+        recipes = recipes.filter(
+            Recipe.fetched_at >= suggester.watermark
+            - timedelta(seconds=RECIPE_RESCAN_SECONDS)).all()
+        ingredients = []
+        if recipes:
+            ingredients = (
+                db.session.query(Ingredient.name)
+                .join(RecipeIngredient, RecipeIngredient.ingredient_id
+                      == Ingredient.ingredient_id)
+                .filter(RecipeIngredient.recipe_id.in_(
+                    [recipe_id for recipe_id, _, _ in recipes]))
+                .distinct().all())
 
-    db.session.add(new_bookmark)
+    phrases = ([recipe_name for _, recipe_name, _ in recipes]
+               + [name for name, in ingredients])
+    for phrase in phrases:
+        if phrase:
+            suggester.add(phrase)
+
+    # Late recipes are older than the watermark, which never moves back
+    newest = max((fetched_at for _, _, fetched_at in recipes
+                  if fetched_at is not None), default=None)
+    if newest is not None and (suggester.watermark is None
+                               or newest > suggester.watermark):
+        suggester.watermark = newest
+
+
+def match_pantry(ingredients, limit=None, max_missing=None):
+    """Ranks stored recipes by how much of their ingredient list the
+    pantry covers: fewest missing ingredients first, then most used.
+    ingredients are Spoonacular ingredient ids or names ("tomato" matches
+    every ingredient with tomato in its name). Returns up to limit
+    dictionaries with id, title, image, have, missing, total and
+    coverage."""
+
+    refresh_pantry_index()
+
+    ingredient_ids = pantry_index.ingredient_ids(ingredients)
+    matches = pantry_index.match(ingredient_ids,
+                                 limit or pantry.DEFAULT_MATCHES,
+                                 max_missing)
+    if not matches:
+        return []
+
+    recipes = {recipe.recipe_id: recipe for recipe in
+               db.session.query(Recipe.recipe_id, Recipe.recipe_name,
+                                Recipe.img_url)
+               .filter(Recipe.recipe_id.in_([match['recipe_id']
+                                             for match in matches]))}
+
+    return [{'id': match['recipe_id'],
+             'title': recipes[match['recipe_id']].recipe_name,
+             'image': recipes[match['recipe_id']].img_url,
+             'have': match['have'],
+             'missing': match['missing'],
+             'total': match['total'],
+             'coverage': round(match['have'] / match['total'], 3)}
+            for match in matches if match['recipe_id'] in recipes]
+
+
+def search_stored_recipes(recipe_search, number, offset=0, diets=(),
+                          ranges=None, facet_counts=False):
+    """Answers a recipe search from the recipes table, in the shape of a
+    Spoonacular search response with summaries filled in. Returns None
+    when local search is off or there aren't enough good hits, so the
+    caller should ask Spoonacular instead.
+
+    Hits can be narrowed to recipes with every diet in diets and numeric
+    facets within ranges ({facet: (min, max)}, see facets.parse_filters).
+    With filters or facet_counts, the response also has 'facets': counts
+    of each diet and facet bucket among the (filtered) hits."""
+
+    query = normalize_query(recipe_search)
+    if not LOCAL_SEARCH or not query:
+        return None
+
+    if diets or ranges or facet_counts:
+        return search_stored_recipes_by_facet(query, number, offset, diets,
+                                              ranges)
+
+    hits = db.session.execute(SEARCH_RECIPES_SQL,
+                              {'query': query, 'number': number,
+                               'offset': offset,
+                               'min_rank': LOCAL_SEARCH_MIN_RANK,
+                               'snippet_options': SNIPPET_OPTIONS}).fetchall()
+
+    if not hits or hits[0].total < LOCAL_SEARCH_MIN_HITS:
+        return None
+
+    return local_results_page(hits, number, offset, hits[0].total)
+
+
+def search_stored_recipes_by_facet(query, number, offset, diets, ranges):
+    """search_stored_recipes for filtered or faceted searches. All hits are
+    ranked in SQL; filters and counts run over them as bitsets in
+    facet_index, then one page of snippets is fetched."""
+
+    hit_ids = [recipe_id for recipe_id, in db.session.execute(
+        SEARCH_RECIPE_IDS_SQL, {'query': query,
+                                'min_rank': LOCAL_SEARCH_MIN_RANK})]
+
+    if len(hit_ids) < LOCAL_SEARCH_MIN_HITS:
+        return None
+
+    refresh_facet_index()
+
+    hits = facet_index.bitset_of(hit_ids)
+    if diets or ranges:
+        hits = facet_index.filter(hits, diets, ranges)
+        matched = set(facet_index.recipes_in(hits))
+        hit_ids = [recipe_id for recipe_id in hit_ids
+                   if recipe_id in matched]
+
+        # Too few stored recipes pass the filters: search upstream instead
+        if len(hit_ids) < LOCAL_SEARCH_MIN_HITS:
+            return None
+
+    page_ids = hit_ids[offset:offset + number]
+    rows = {}
+    if page_ids:
+        rows = {row.recipe_id: row for row in db.session.execute(
+            SEARCH_PAGE_SQL, {'query': query, 'recipe_ids': page_ids,
+                              'snippet_options': SNIPPET_OPTIONS})}
+
+    results_json = local_results_page(
+        [rows[recipe_id] for recipe_id in page_ids if recipe_id in rows],
+        number, offset, len(hit_ids))
+    results_json['facets'] = facet_index.counts(hits)
+
+    return results_json
+
+
+def local_results_page(hits, number, offset, total):
+    """Shapes rows of recipe_id, recipe_name, img_url and summary like a
+    Spoonacular search response."""
+
+    return {'results': [{'id': int(hit.recipe_id) if hit.recipe_id.isdigit()
+                         else hit.recipe_id,
+                         'title': hit.recipe_name,
+                         'image': hit.img_url,
+                         'summary': snippet_html(hit.summary),
+                         'summary_missing': False}
+                        for hit in hits],
+            # Stored images are full URLs already
+            'baseUri': '',
+            'offset': offset,
+            'number': number,
+            'totalResults': total,
+            'source': 'local'}
+
+
+def snippet_html(snippet):
+    """Turns a search snippet into HTML that is safe to render: the stored
+    text is escaped, and only the matched words are marked up, in bold."""
+
+    return (html.escape(html.unescape(snippet or ''), quote=False)
+            .replace(SNIPPET_START, '<b>').replace(SNIPPET_STOP, '</b>'))
+
+
+def add_names(model, names):
+    """Adds the names missing from an Aisle or Cuisine style table (one
+    with a unique name column). Returns a dictionary of name: id for all of
+    names."""
+
+    if not names:
+        return {}
+
+    table = model.__table__
+    db.session.execute(insert(table).values(
+        [{'name': name} for name in names]).on_conflict_do_nothing(
+            index_elements=['name']))
+
+    id_column = table.primary_key.columns.values()[0]
+
+    return dict(db.session.query(table.c.name, id_column)
+                .filter(table.c.name.in_(list(names))))
+
+
+def recipes_with_ingredient(ingredient, user_id=None):
+    """Returns the recipes (recipe_id, recipe_name and img_url) using
+    ingredient, given by Spoonacular ingredient id or by name. With
+    user_id, only that user's bookmarked recipes."""
+
+    query = (db.session.query(Recipe.recipe_id, Recipe.recipe_name,
+                              Recipe.img_url)
+             .join(RecipeIngredient,
+                   RecipeIngredient.recipe_id == Recipe.recipe_id))
+
+    if isinstance(ingredient, int):
+        query = query.filter(RecipeIngredient.ingredient_id == ingredient)
+    else:
+        query = (query.join(Ingredient, Ingredient.ingredient_id
+                            == RecipeIngredient.ingredient_id)
+                 .filter(Ingredient.name == ingredient.lower()))
+
+    if user_id is not None:
+        query = (query.join(Bookmark, Bookmark.recipe_id == Recipe.recipe_id)
+                 .filter(Bookmark.user_id == user_id))
+
+    return query.distinct().order_by(Recipe.recipe_id).all()
+
+
+def fill_recipe(recipe, info_response):
+    """Copies recipe info from the Spoonacular API onto a Recipe object."""
+
+    recipe.recipe_name = info_response['title']
+    recipe.img_url = info_response['image']
+    recipe.instructions = info_response['instructions']
+    recipe.info = info_response
+    fill_facets(recipe, info_response)
+
+
+def fill_facets(recipe, info_response):
+    """Copies the diet flags and numeric facets of recipe info onto a
+    Recipe object."""
+
+    recipe.diet_flags = facets.diet_flags_of(info_response)
+    for facet, column in facets.NUMERIC_FACETS.items():
+        setattr(recipe, column, info_response.get(facet))
+
+
+def hydrate_recipes(recipe_ids):
+    """Fills in Recipe rows created by bookmarking (which only know their
+    recipe_id) with info from one bulk Spoonacular call. Recipes it can't
+    fill in are backed off before being tried again."""
+
+    hydrated = ()
+    try:
+        infos = api_calls.recipe_info_bulk(recipe_ids,
+                                           priority=api_calls.HYDRATION)
+
+        stored = {}
+        for recipe in Recipe.query.filter(Recipe.recipe_id.in_(list(infos))):
+            fill_recipe(recipe, infos[recipe.recipe_id])
+            stored[recipe.recipe_id] = infos[recipe.recipe_id]
+        db.session.flush()
+        ingest_recipe_details(stored)
+
+        # Names and images changed under the bookmarks pointing here
+        db.session.execute(BUMP_BOOKMARKERS_VERSION_SQL,
+                           {'recipe_ids': list(infos)})
+        db.session.commit()
+        hydrated = infos
+    finally:
+        db.session.remove()
+        record_hydration(recipe_ids, hydrated)
+
+
+def record_hydration(recipe_ids, hydrated):
+    """Forgets the recipes among recipe_ids that were hydrated, and backs
+    off the others before they're tried again."""
+
+    now = time.monotonic()
+
+    with hydration_lock:
+        for recipe_id in recipe_ids:
+            if recipe_id in hydrated:
+                hydration_retries.pop(recipe_id, None)
+                continue
+
+            failures = hydration_retries.get(recipe_id, (0, None))[0] + 1
+            delay = min(HYDRATION_RETRY_SECONDS * 2 ** min(failures - 1, 16),
+                        HYDRATION_MAX_RETRY_SECONDS)
+            hydration_retries[recipe_id] = (failures, now + delay)
+
+
+def hydrate_recipes_later(recipe_ids):
+    """Queues hydrate_recipes in the background, so bookmarking never waits
+    on Spoonacular. Recipes it misses are retried by
+    hydrate_bare_recipes_later, or filled in on first view."""
+
+    # Queued recipes aren't picked up again by hydrate_bare_recipes_later
+    retry_at = time.monotonic() + HYDRATION_RETRY_SECONDS
+    with hydration_lock:
+        for recipe_id in recipe_ids:
+            failures = hydration_retries.get(recipe_id, (0, None))[0]
+            hydration_retries[recipe_id] = (failures, retry_at)
+
+    future = hydration_pool.submit(hydrate_recipes, recipe_ids)
+    future.add_done_callback(_log_hydration_error)
+
+    return future
+
+
+def _log_hydration_error(future):
+    """Logs background hydration failures instead of dropping them."""
+
+    if future.exception() is not None:
+        logger.warning("Recipe hydration failed: %r", future.exception())
+
+
+def hydrate_bare_recipes_later():
+    """Queues hydration of up to BULK_CHUNK_SIZE stored recipes that still
+    have no info and aren't backed off, at most every
+    HYDRATION_RETRY_SECONDS. Called when bookmarks are viewed, so a failed
+    hydration doesn't leave a nameless bookmark for good."""
+
+    global hydration_checked_at
+
+    now = time.monotonic()
+    with hydration_lock:
+        if (hydration_checked_at is not None
+                and now - hydration_checked_at < HYDRATION_RETRY_SECONDS):
+            return
+        hydration_checked_at = now
+
+        waiting = [recipe_id for recipe_id, (_, retry_at)
+                   in hydration_retries.items() if retry_at > now]
+
+    query = db.session.query(Recipe.recipe_id).filter(Recipe.payload.is_(None))
+    if waiting:
+        query = query.filter(Recipe.recipe_id.notin_(waiting))
+
+    recipe_ids = [recipe_id for recipe_id,
+                  in query.limit(api_calls.BULK_CHUNK_SIZE)]
+    if recipe_ids:
+        hydrate_recipes_later(recipe_ids)
+
+
+
+
+
+
+def get_recipe_info(recipe_id):
+    """Returns full recipe info, from the DB if the recipe is stored there
+    and from the Spoonacular API otherwise. Stored recipes saved before
+    their full info was kept are filled in on first view."""
+
+    recipe = check_if_recipe_exists(recipe_id)
+
+    if recipe is not None and recipe.payload is not None:
+        return recipe.info
+
+    info_response = api_calls.recipe_info(recipe_id)
+
+    if recipe is not None:
+        if recipe.recipe_name is None:
+            # A bare bookmarked recipe is getting its name and image
+            db.session.execute(BUMP_BOOKMARKERS_VERSION_SQL,
+                               {'recipe_ids': [recipe_id]})
+        fill_recipe(recipe, info_response)
+        ingest_recipe_details({recipe_id: info_response})
+        db.session.commit()
+
+    return info_response
+
+
+def bookmark_recipe(user_id, recipe_id):
+    """Bookmarks recipe_id for user_id in a single statement, adding a bare
+    Recipe row first if the recipe isn't stored yet (it is then hydrated in
+    the background). Safe to call twice at once: the unique constraint on
+    bookmarks means only one row is ever added. Returns True if a bookmark
+    was added, False if it already existed."""
+
+    added = db.session.execute(BOOKMARK_RECIPE_SQL,
+                               {'user_id': user_id,
+                                'recipe_id': recipe_id}).first()
+    if added is not None:
+        db.session.execute(BUMP_BOOKMARK_VERSION_SQL, {'user_id': user_id})
     db.session.commit()
 
-    return new_bookmark
+    if added is not None and added.new_recipe:
+        hydrate_recipes_later([recipe_id])
+
+    return added is not None
+
+
+def update_bookmarks(user_id, add_ids=(), remove_ids=()):
+    """Bookmarks every recipe in add_ids and removes the bookmarks for every
+    recipe in remove_ids, in one transaction with one statement each.
+    Recipes not stored yet are added bare and hydrated in the background
+    with a single bulk API call. Returns a dictionary of recipe_id: status,
+    one of "bookmarked", "already_bookmarked", "removed" or
+    "not_bookmarked"."""
+
+    add_ids = list(dict.fromkeys(add_ids))
+    remove_ids = list(dict.fromkeys(remove_ids))
+
+    statuses = dict.fromkeys(add_ids, 'already_bookmarked')
+    statuses.update(dict.fromkeys(remove_ids, 'not_bookmarked'))
+    new_recipe_ids = []
+
+    if add_ids:
+        for row in db.session.execute(BOOKMARK_RECIPES_SQL,
+                                      {'user_id': user_id,
+                                       'recipe_ids': add_ids}):
+            statuses[row.recipe_id] = 'bookmarked'
+            if row.new_recipe:
+                new_recipe_ids.append(row.recipe_id)
+
+    if remove_ids:
+        for row in db.session.execute(UNBOOKMARK_RECIPES_SQL,
+                                      {'user_id': user_id,
+                                       'recipe_ids': remove_ids}):
+            statuses[row.recipe_id] = 'removed'
+
+    if any(status in ('bookmarked', 'removed')
+           for status in statuses.values()):
+        db.session.execute(BUMP_BOOKMARK_VERSION_SQL, {'user_id': user_id})
+    db.session.commit()
 
+    if new_recipe_ids:
+        hydrate_recipes_later(new_recipe_ids)
 
+    return statuses
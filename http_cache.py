@@ -0,0 +1,105 @@
+""" Conditional requests and Cache-Control policies for Flask routes. """
+
+from functools import wraps
+import hashlib
+
+from flask import current_app, make_response, request, session
+
+from compression import strip_encoding
+
+
+def make_etag(key):
+    """Returns a strong ETag for a cache or version key."""
+
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def conditional(max_age=0, private=True, etag=None):
+    """Decorates a GET route to send an ETag and a Cache-Control policy, and
+    to answer a matching If-None-Match (or If-Modified-Since, when the view
+    sets last_modified) with 304 Not Modified.
+
+    private marks per-user responses that only the browser may store. With
+    max_age=0 the browser must revalidate on every use.
+
+    etag, if given, is called with the view's arguments and returns a key
+    that changes whenever the response would (e.g. a version counter). A
+    matching request then gets its 304 without running the view. Otherwise
+    the ETag is a hash of the response body.
+
+    Responses that aren't 200, are streamed, or changed the session (e.g.
+    showed a flashed message) are passed through untouched."""
+
+    def decorator(view):
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+
+            tag = make_etag(etag(*args, **kwargs)) if etag else None
+
+            matched = matching_etag(tag) if tag is not None else None
+            if matched is not None:
+                return not_modified(matched, max_age, private)
+
+            response = make_response(view(*args, **kwargs))
+
+            if (response.status_code != 200 or response.is_streamed
+                    or session.modified):
+                return response
+
+            if tag is not None:
+                response.set_etag(tag)
+            else:
+                response.add_etag()
+                tag = response.get_etag()[0]
+            set_cache_control(response, max_age, private)
+
+            matched = matching_etag(tag)
+            if matched is not None:
+                return not_modified(matched, max_age, private)
+
+            return response.make_conditional(request)
+
+        return decorated_function
+
+    return decorator
+
+
+def matching_etag(tag):
+    """Returns the If-None-Match entry naming tag, in whichever content
+    coding the client got it, or None if there is none."""
+
+    if request.if_none_match.star_tag:
+        return tag
+
+    for candidate in request.if_none_match:
+        if strip_encoding(candidate) == tag:
+            return candidate
+
+    return None
+
+
+def not_modified(tag, max_age, private):
+    """Returns an empty 304 response revalidating tag."""
+
+    response = current_app.response_class(status=304)
+    response.set_etag(tag)
+    response.vary.add('Accept-Encoding')
+    set_cache_control(response, max_age, private)
+
+    return response
+
+
+def set_cache_control(response, max_age, private):
+    """Sets Cache-Control on response from a route's policy."""
+
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
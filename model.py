@@ -1,10 +1,17 @@
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import TSVECTOR
 # from flask_migrate import Migrate
+from datetime import datetime
+import json
 import os
+import zlib
 
 db = SQLAlchemy()
 
+# Prefix marking a users.password value stored before hashing was added,
+# so only rows tagged by the migration are ever compared as plaintext
+PLAINTEXT_MARKER = 'plaintext$'
 
 
 class User(db.Model):
@@ -18,6 +25,10 @@ class User(db.Model):
     username = db.Column(db.String(64), nullable=False)
     email = db.Column(db.String(64), nullable=False)
     password = db.Column(db.String(1000), nullable=False)
+    # Bumped whenever the user's bookmarks (or the recipes they point to)
+    # change, so cached renderings of them can be keyed by it
+    bookmark_version = db.Column(db.Integer, nullable=False, default=0,
+                                 server_default='0')
 
     def __repr__(self):
         """Provide helpful representation when printed."""
@@ -33,17 +44,56 @@ class Recipe(db.Model):
 
     # Recipe_id the actual Spoonacular recipe_id; not auto-incrementing
     recipe_id = db.Column(db.String(64), nullable=False, primary_key=True)
-    recipe_name = db.Column(db.String(200), nullable=False)
+    # Name, image and instructions are empty until a recipe added by
+    # bookmarking is hydrated from the Spoonacular API
+    recipe_name = db.Column(db.String(200), nullable=True)
     img_url = db.Column(db.String(1000), nullable=True)
-    instructions = db.Column(db.String(10000), nullable=True)
-
-  
+    instructions = db.Column(db.Text, nullable=True)
+
+    # Full Spoonacular recipe info as zlib-compressed JSON, and when it was
+    # fetched. Lets /recipe-info serve stored recipes without an API call.
+    payload = db.Column(db.LargeBinary, nullable=True)
+    fetched_at = db.Column(db.DateTime, nullable=True)
+
+    # Full-text search document: title, ingredient names and instructions,
+    # weighted in that order. Kept up to date by ingest_recipe_details.
+    search_vector = db.Column(TSVECTOR, nullable=True)
+
+    # Facets for filtering searches, copied from the recipe info: diet flags
+    # packed as bits in facets.DIET_FLAGS order, and numeric fields (price
+    # in US cents). Empty until the recipe info is stored.
+    diet_flags = db.Column(db.SmallInteger, nullable=True)
+    ready_in_minutes = db.Column(db.Integer, nullable=True)
+    price_per_serving = db.Column(db.Float, nullable=True)
+    health_score = db.Column(db.Float, nullable=True)
+    servings = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_recipes_search_vector', 'search_vector',
+                 postgresql_using='gin'),
+    )
 
     # Define relationship to users (ASSOCIATION)
     users = db.relationship("User",
                             secondary="bookmarks",
                             backref=db.backref("recipes"))
 
+    @property
+    def info(self):
+        """Full recipe info as stored, or None if it was never stored."""
+
+        if self.payload is None:
+            return None
+
+        return json.loads(zlib.decompress(self.payload).decode('utf-8'))
+
+    @info.setter
+    def info(self, info):
+        """Store full recipe info, compressed, stamped with the time."""
+
+        self.payload = zlib.compress(json.dumps(info).encode('utf-8'))
+        self.fetched_at = datetime.utcnow()
+
     def __repr__(self):
         """Provide helpful representation when printed."""
 
@@ -59,6 +109,14 @@ class Bookmark(db.Model):
     """ Ingredients of particular recipe / Recipes of particular ingredient. """
 
     __tablename__ = "bookmarks"
+    __table_args__ = (
+        # One bookmark per user and recipe; also serves lookups by user
+        db.UniqueConstraint('user_id', 'recipe_id',
+                            name='bookmarks_user_id_recipe_id_key'),
+        db.Index('ix_bookmarks_recipe_id', 'recipe_id'),
+        # Newest-first, paginated bookmark listings per user
+        db.Index('ix_bookmarks_user_id_bookmark_id', 'user_id', 'bookmark_id'),
+    )
 
     bookmark_id = db.Column(db.Integer,
                             autoincrement=True,
@@ -74,11 +132,117 @@ class Bookmark(db.Model):
 
 
 
+class Aisle(db.Model):
+    """ Grocery store aisle an ingredient is found in. """
+
+    __tablename__ = 'aisles'
+
+    aisle_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    name = db.Column(db.String(200), nullable=False, unique=True)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<Aisle aisle_id={} name={}>".format(self.aisle_id, self.name)
+
+
+class Ingredient(db.Model):
+    """ Ingredient used by recipes. """
+
+    __tablename__ = 'ingredients'
+
+    # The Spoonacular ingredient id; not auto-incrementing
+    ingredient_id = db.Column(db.Integer, autoincrement=False,
+                              primary_key=True)
+    # Spoonacular names are lowercase, so lookups by name match exactly
+    name = db.Column(db.String(200), nullable=False, index=True)
+    aisle_id = db.Column(db.Integer, db.ForeignKey('aisles.aisle_id'),
+                         nullable=True, index=True)
+    img_url = db.Column(db.String(1000), nullable=True)
+
+    aisle = db.relationship("Aisle", backref=db.backref("ingredients"))
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<Ingredient ingredient_id={} name={}>".format(
+            self.ingredient_id, self.name)
+
+
+class Cuisine(db.Model):
+    """ Cuisine a recipe belongs to, e.g. italian. """
+
+    __tablename__ = 'cuisines'
+
+    cuisine_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<Cuisine cuisine_id={} name={}>".format(self.cuisine_id,
+                                                       self.name)
+
+
+class RecipeCuisine(db.Model):
+    """ Cuisines of particular recipe / Recipes of particular cuisine. """
+
+    __tablename__ = 'recipe_cuisines'
+
+    recipe_id = db.Column(db.String(64), db.ForeignKey('recipes.recipe_id'),
+                          primary_key=True)
+    # Recipes of a cuisine are looked up by cuisine_id
+    cuisine_id = db.Column(db.Integer, db.ForeignKey('cuisines.cuisine_id'),
+                           primary_key=True, index=True)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<RecipeCuisine recipe_id={} cuisine_id={}>".format(
+            self.recipe_id, self.cuisine_id)
+
+
+class RecipeIngredient(db.Model):
+    """ Ingredients of particular recipe / Recipes of particular ingredient,
+    one row per ingredient of the recipe (its first line, if the list has
+    the ingredient twice). """
+
+    __tablename__ = 'recipe_ingredients'
+    __table_args__ = (
+        # Concurrent ingests of one recipe can't both add its rows
+        db.UniqueConstraint(
+            'recipe_id', 'ingredient_id',
+            name='recipe_ingredients_recipe_id_ingredient_id_key'),
+        # Recipes using an ingredient, without touching the table
+        db.Index('ix_recipe_ingredients_ingredient_id_recipe_id',
+                 'ingredient_id', 'recipe_id'),
+    )
+
+    recipe_ingredient_id = db.Column(db.Integer, autoincrement=True,
+                                     primary_key=True)
+    recipe_id = db.Column(db.String(64), db.ForeignKey('recipes.recipe_id'),
+                          nullable=False, index=True)
+    ingredient_id = db.Column(db.Integer,
+                              db.ForeignKey('ingredients.ingredient_id'),
+                              nullable=False)
+    amount = db.Column(db.Float, nullable=True)
+    unit = db.Column(db.String(64), nullable=True)
+    original_string = db.Column(db.String(1000), nullable=True)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return """<RecipeIngredient recipe_id={} ingredient_id={} amount={}
+                  unit={}>""".format(self.recipe_id, self.ingredient_id,
+                                     self.amount, self.unit)
+
+
+
 def example_data():
     # Add sample users
-    user1 = User(username='krish', email='krish@gmail.com', password='qwert')
-    user2 = User(username='rajan', email='rajan@gmail.com', password='qwert1')
-    user3 = User(username='gauth', email='gauth@gmail.com', password='qwert2')
+    user1 = User(username='krish', email='krish@gmail.com', password=PLAINTEXT_MARKER + 'qwert')
+    user2 = User(username='rajan', email='rajan@gmail.com', password=PLAINTEXT_MARKER + 'qwert1')
+    user3 = User(username='gauth', email='gauth@gmail.com', password=PLAINTEXT_MARKER + 'qwert2')
 
     db.session.add_all([user1, user2, user3])
     db.session.commit()
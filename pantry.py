@@ -0,0 +1,322 @@
+""" "Cook with what I have": ranks recipes by how much of their ingredient
+list a pantry covers.
+
+Recipes get dense positions 0..n-1, and every set of recipes is a Python
+int used as a bitset (bit i set = recipe at position i in the set). Each
+ingredient has a posting bitset of the recipes using it. Per-recipe counts
+are kept bit-sliced: plane i is the bitset of recipes whose count has bit
+i set. That way a query counts, for every recipe at once, how many of its
+ingredients the pantry has, with a handful of whole-bitset operations per
+pantry ingredient and no per-recipe Python loop. """
+
+import re
+import threading
+
+from text_utils import stem_token
+
+# Recipes returned per query, unless asked otherwise
+DEFAULT_MATCHES = 20
+
+# Loads changing more recipes than this rebuild the counts from scratch
+BULK_UPDATE = 256
+
+bit_count = getattr(int, 'bit_count', None)
+
+
+def bitset_from_positions(positions):
+    """Returns the bitset with exactly positions set, built in one pass."""
+
+    positions = list(positions)
+    if not positions:
+        return 0
+
+    data = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        data[position >> 3] |= 1 << (position & 7)
+
+    return int.from_bytes(bytes(data), 'little')
+
+
+def positions_of(bitset, count=None):
+    """Returns the positions set in bitset, lowest first; only the first
+    count of them if count is given."""
+
+    positions = []
+    data = bitset.to_bytes((bitset.bit_length() + 7) // 8, 'little')
+
+    for index, byte in enumerate(data):
+        while byte:
+            if count is not None and len(positions) >= count:
+                return positions
+            low = byte & -byte
+            positions.append(index * 8 + low.bit_length() - 1)
+            byte ^= low
+
+    return positions
+
+
+def popcount(bitset):
+    """Returns how many positions are set in bitset."""
+
+    # int.bit_count is much faster, but only arrived in Python 3.10
+    if bit_count is not None:
+        return bit_count(bitset)
+
+    return bin(bitset).count('1')
+
+
+def sliced_add(planes, bitset):
+    """Adds 1 to the bit-sliced counter planes at every position in bitset,
+    rippling the carry up through the planes."""
+
+    carry = bitset
+    for i, plane in enumerate(planes):
+        if not carry:
+            return
+        planes[i] = plane ^ carry
+        carry &= plane
+
+    if carry:
+        planes.append(carry)
+
+
+def sliced_subtract(minuend, subtrahend):
+    """Returns the planes of minuend - subtrahend, position by position.
+    Every value in subtrahend must be at most the one in minuend."""
+
+    difference = []
+    borrow = 0
+
+    for i in range(max(len(minuend), len(subtrahend))):
+        a = minuend[i] if i < len(minuend) else 0
+        b = subtrahend[i] if i < len(subtrahend) else 0
+        difference.append(a ^ b ^ borrow)
+        borrow = (~a & b) | (~(a ^ b) & borrow)
+
+    return difference
+
+
+def sliced_equal(planes, value, within):
+    """Returns the positions in bitset within whose value in planes is
+    value."""
+
+    if value >> len(planes):
+        return 0
+
+    for i, plane in enumerate(planes):
+        within = within & plane if value >> i & 1 else within & ~plane
+
+    return within
+
+
+def sliced_value(planes, position):
+    """Returns the value in planes at one position."""
+
+    return sum(1 << i for i, plane in enumerate(planes)
+               if plane >> position & 1)
+
+
+def sliced_top(planes, within, count):
+    """Finds the count positions in within with the largest values in
+    planes, walking the planes from the top bit. Returns two bitsets: the
+    positions certainly among them, and the positions tied (all with one
+    value) for the places left over."""
+
+    above = 0
+    tied = within
+
+    for plane in reversed(planes):
+        candidates = above | (tied & plane)
+        found = popcount(candidates)
+        if found > count:
+            tied &= plane
+        elif found < count:
+            above = candidates
+            tied &= ~plane
+        else:
+            return candidates, 0
+
+    return above, tied
+
+
+def sliced_from_values(values):
+    """Returns bit-sliced planes holding values, one per position."""
+
+    planes = []
+    for i in range(max(values or [0]).bit_length()):
+        planes.append(bitset_from_positions(
+            position for position, value in enumerate(values)
+            if value >> i & 1))
+
+    return planes
+
+
+def sliced_set(planes, position, value):
+    """Stores value at one position of the bit-sliced planes."""
+
+    bit = 1 << position
+
+    while len(planes) < value.bit_length():
+        planes.append(0)
+
+    for i, plane in enumerate(planes):
+        planes[i] = plane | bit if value >> i & 1 else plane & ~bit
+
+
+def ingredient_tokens(name):
+    """Splits an ingredient name into lightly stemmed words."""
+
+    return {stem_token(token) for token in re.findall(r'\w+', name.lower())}
+
+
+class PantryIndex(object):
+    """Per-ingredient bitsets over stored recipes, answering pantry queries.
+    Thread-safe; queries see either all of an update or none of it."""
+
+    def __init__(self):
+        self.recipe_ids = []
+        self.positions = {}
+        self.ingredients = []
+        self.postings = {}
+        self.totals = []
+        self.names = {}
+        self.tokens = {}
+        # Highest recipe_ingredients row id loaded, for incremental refresh,
+        # and ids below it not seen yet (row id: time first missed)
+        self.watermark = 0
+        self.gaps = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.recipe_ids)
+
+    def load(self, recipe_ingredients, names=None):
+        """Adds many recipes at once. recipe_ingredients is a dictionary of
+        recipe_id: set of ingredient ids; recipes already indexed get their
+        ingredients replaced. names is a dictionary of ingredient_id:
+        name. Much faster than one recipe at a time for fresh recipes."""
+
+        with self._lock:
+            fresh = {}
+            changed = []
+
+            for recipe_id, ingredient_ids in recipe_ingredients.items():
+                if recipe_id in self.positions:
+                    self._replace(recipe_id, set(ingredient_ids))
+                    changed.append(self.positions[recipe_id])
+                    continue
+
+                position = len(self.recipe_ids)
+                self.recipe_ids.append(recipe_id)
+                self.positions[recipe_id] = position
+                self.ingredients.append(frozenset(ingredient_ids))
+                changed.append(position)
+
+                for ingredient_id in ingredient_ids:
+                    fresh.setdefault(ingredient_id, []).append(position)
+
+            # New postings are built from byte arrays, not bit by bit
+            for ingredient_id, positions in fresh.items():
+                self.postings[ingredient_id] = (
+                    self.postings.get(ingredient_id, 0)
+                    | bitset_from_positions(positions))
+
+            # Small updates patch the totals; big ones rebuild them
+            if len(changed) > BULK_UPDATE:
+                self.totals = sliced_from_values(
+                    [len(ingredients) for ingredients in self.ingredients])
+            else:
+                for position in changed:
+                    sliced_set(self.totals, position,
+                               len(self.ingredients[position]))
+
+            for ingredient_id, name in (names or {}).items():
+                self.names[ingredient_id] = name
+                for token in ingredient_tokens(name):
+                    self.tokens.setdefault(token, set()).add(ingredient_id)
+
+    def _replace(self, recipe_id, ingredient_ids):
+        """Swaps an indexed recipe's ingredients. Call with the lock held;
+        the caller updates totals."""
+
+        position = self.positions[recipe_id]
+        bit = 1 << position
+        old = self.ingredients[position]
+
+        for ingredient_id in old - ingredient_ids:
+            self.postings[ingredient_id] &= ~bit
+        for ingredient_id in ingredient_ids - old:
+            self.postings[ingredient_id] = (
+                self.postings.get(ingredient_id, 0) | bit)
+
+        self.ingredients[position] = frozenset(ingredient_ids)
+
+    def ingredient_ids(self, terms):
+        """Returns the ids of indexed ingredients matching any of terms,
+        each an ingredient id or a name whose words (plurals folded) all
+        appear in the ingredient's name: "tomato" matches "canned diced
+        tomatoes"."""
+
+        matched = set()
+
+        for term in terms:
+            if isinstance(term, int):
+                matched.add(term)
+                continue
+
+            tokens = ingredient_tokens(term)
+            if not tokens:
+                continue
+            matched |= set.intersection(*(self.tokens.get(token, set())
+                                          for token in tokens))
+
+        return matched
+
+    def match(self, ingredient_ids, limit=DEFAULT_MATCHES, max_missing=None):
+        """Ranks recipes using any of ingredient_ids: fewest missing
+        ingredients first, then most ingredients used. Returns up to limit
+        dictionaries with recipe_id, have, missing and total."""
+
+        with self._lock:
+            have = []
+            using = 0
+            for ingredient_id in set(ingredient_ids):
+                posting = self.postings.get(ingredient_id, 0)
+                if posting:
+                    sliced_add(have, posting)
+                    using |= posting
+
+            if not using:
+                return []
+
+            missing = sliced_subtract(self.totals, have)
+            # No recipe misses more than the planes can count
+            most_missing = 2 ** len(missing) - 1
+            if max_missing is not None:
+                most_missing = min(max_missing, most_missing)
+
+            matches = []
+            for missing_count in range(most_missing + 1):
+                level = sliced_equal(missing, missing_count, using)
+                if not level:
+                    continue
+
+                # Within a level, recipes using more of the pantry win
+                needed = limit - len(matches)
+                best, tied = sliced_top(have, level, needed)
+                positions = positions_of(best)
+                positions += positions_of(tied, needed - len(positions))
+                ranked = sorted(((sliced_value(have, position), position)
+                                 for position in positions),
+                                key=lambda item: (-item[0], item[1]))
+
+                for have_count, position in ranked:
+                    matches.append({'recipe_id': self.recipe_ids[position],
+                                    'have': have_count,
+                                    'missing': missing_count,
+                                    'total': have_count + missing_count})
+
+                if len(matches) >= limit:
+                    break
+
+            return matches
@@ -0,0 +1,217 @@
+""" Outbound scheduling for Spoonacular calls: a token bucket sized to our
+plan's quota, priority classes, and a circuit breaker. """
+
+import threading
+import time
+
+# Priority classes, most important first
+INTERACTIVE = 0
+HYDRATION = 1
+PREFETCH = 2
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive',
+                  HYDRATION: 'hydration',
+                  PREFETCH: 'prefetch'}
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling Spoonacular when the circuit breaker is
+    open or no quota frees up in time."""
+
+
+class TokenBucket(object):
+    """Allows rate calls per second on average, in bursts of up to
+    capacity. Not thread-safe on its own; UpstreamScheduler locks it."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self._updated = clock()
+
+    def refill(self):
+        """Adds the tokens earned since the last refill."""
+
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until(self, tokens):
+        """Seconds until the bucket holds tokens, assuming no other use."""
+
+        return max(tokens - self.tokens, 0) / self.rate
+
+
+class CircuitBreaker(object):
+    """Opens after failure_threshold consecutive failures, failing calls
+    fast for reset_timeout seconds. Then lets one trial call through
+    (half-open): success closes it again, failure re-opens it."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Checks if a call may go out now."""
+
+        with self._lock:
+            if self.state == 'open':
+                if self.clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = 'half_open'
+                self._trial_running = False
+
+            if self.state == 'half_open':
+                if self._trial_running:
+                    return False
+                self._trial_running = True
+
+            return True
+
+    def cancel_trial(self):
+        """Gives up a half-open trial call that never went out."""
+
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        """Closes the breaker after a successful call."""
+
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        """Counts a failed call, opening the breaker past the threshold."""
+
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+
+            if (self.state == 'half_open'
+                    or self.failures >= self.failure_threshold):
+                self.state = 'open'
+                self._opened_at = self.clock()
+
+
+class UpstreamScheduler(object):
+    """Admits outbound calls by priority against a shared token bucket.
+
+    A call waits at most max_wait[priority] seconds for a token. Lower
+    priority calls also wait while a more important one is queued, and may
+    only take a token while more than reserve[priority] (a fraction of the
+    bucket) would be left, so interactive traffic keeps some headroom."""
+
+    def __init__(self, rate, capacity, max_wait=None, reserve=None,
+                 breaker=None, clock=time.monotonic):
+        self.bucket = TokenBucket(rate, capacity, clock)
+        self.max_wait = max_wait or {INTERACTIVE: 2, HYDRATION: 5,
+                                     PREFETCH: 0}
+        self.reserve = reserve or {INTERACTIVE: 0, HYDRATION: 0.2,
+                                   PREFETCH: 0.5}
+        self.breaker = breaker or CircuitBreaker(clock=clock)
+        self.clock = clock
+
+        self._cond = threading.Condition()
+        self._waiting = dict.fromkeys(PRIORITY_NAMES, 0)
+        self._stats = {'admitted': dict.fromkeys(PRIORITY_NAMES.values(), 0),
+                       'rejected_quota': dict.fromkeys(
+                           PRIORITY_NAMES.values(), 0),
+                       'rejected_open': 0,
+                       'quota_remaining': None}
+
+    def acquire(self, priority=INTERACTIVE, max_wait=None):
+        """Blocks until a call of this priority may go out. Raises
+        UpstreamUnavailable if the breaker is open or no token frees up
+        within max_wait[priority] seconds (or max_wait, if shorter)."""
+
+        name = PRIORITY_NAMES[priority]
+
+        if not self.breaker.allow():
+            with self._cond:
+                self._stats['rejected_open'] += 1
+            raise UpstreamUnavailable("Spoonacular is failing; not calling "
+                                      "it for a while")
+
+        wait = self.max_wait[priority]
+        if max_wait is not None:
+            wait = max(min(wait, max_wait), 0)
+        deadline = self.clock() + wait
+        floor = 1 + self.reserve[priority] * self.bucket.capacity
+
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    self.bucket.refill()
+                    first_in_line = not any(self._waiting[other]
+                                            for other in PRIORITY_NAMES
+                                            if other < priority)
+
+                    if first_in_line and self.bucket.tokens >= floor:
+                        self.bucket.tokens -= 1
+                        self._stats['admitted'][name] += 1
+                        return
+
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        self._stats['rejected_quota'][name] += 1
+                        self.breaker.cancel_trial()
+                        raise UpstreamUnavailable("Spoonacular quota used "
+                                                  "up; try again shortly")
+
+                    self._cond.wait(min(remaining,
+                                        max(self.bucket.time_until(floor),
+                                            0.01)))
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def cancel(self):
+        """Gives up a call that was let out but never made."""
+
+        self.breaker.cancel_trial()
+
+    def record(self, success, quota_remaining=None):
+        """Reports a finished call to the breaker, along with the quota the
+        upstream says is left, if it said."""
+
+        if success:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+        if quota_remaining is not None:
+            with self._cond:
+                self._stats['quota_remaining'] = quota_remaining
+
+    def stats(self):
+        """Returns quota headroom, queue depth and breaker state."""
+
+        with self._cond:
+            self.bucket.refill()
+            stats = {'tokens': round(self.bucket.tokens, 2),
+                     'rate': self.bucket.rate,
+                     'capacity': self.bucket.capacity,
+                     'queued': {PRIORITY_NAMES[priority]: waiting
+                                for priority, waiting
+                                in self._waiting.items()},
+                     'admitted': dict(self._stats['admitted']),
+                     'rejected_quota': dict(self._stats['rejected_quota']),
+                     'rejected_open': self._stats['rejected_open'],
+                     'quota_remaining': self._stats['quota_remaining'],
+                     'breaker': self.breaker.state,
+                     'consecutive_failures': self.breaker.failures}
+
+        return stats
@@ -6,13 +6,12 @@ from functools import wraps
 
 from jinja2 import StrictUndefined
 
-# Password hashing library
-from passlib.apps import custom_app_context as pwd_context
-
 # Import Flask web framework
 from flask import Flask, render_template, request, flash, redirect, session, g
-from flask import url_for, jsonify
+from flask import url_for, jsonify, Response, stream_with_context, abort
 from flask_debugtoolbar import DebugToolbarExtension
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
 
 # Import model.py table definitions
 from model import connect_to_db, db, User
@@ -20,7 +19,19 @@ from model import connect_to_db, db, User
 import helper_functions
 
 import api_calls
+import assets
+from cache import TTLCache
+from compression import compress_response
+import facets
+from http_cache import conditional
+import hmac
+from itertools import chain
+import json
 import os
+import re
+import requests
+import suggest
+import time
 
 app = Flask(__name__)
 
@@ -29,6 +40,36 @@ app.secret_key = "helloiamsecret"
 
 app.jinja_env.undefined = StrictUndefined
 
+# Compress large HTML and JSON responses
+app.after_request(compress_response)
+
+# Templates link built, content-hashed JS and CSS bundles through this
+app.jinja_env.globals['asset_urls'] = assets.asset_urls
+
+# Seconds browsers may reuse responses before revalidating them. Every page
+# is behind the login and renders the session (e.g. the logout link), so
+# none may be stored by shared caches.
+RECIPE_MAX_AGE = int(os.getenv('RECIPE_MAX_AGE', 3600))
+SEARCH_MAX_AGE = int(os.getenv('SEARCH_MAX_AGE', 300))
+SUGGEST_MAX_AGE = int(os.getenv('SUGGEST_MAX_AGE', 60))
+
+# Bearer token /metrics.json requires; without one set, it is switched off
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Rendered bookmark list and carousel, keyed by user, page and bookmark
+# version. Bookmark writes bump the version, so outdated fragments are never
+# looked up again and just age out.
+fragment_cache = TTLCache(maxsize=int(os.getenv('FRAGMENT_CACHE_SIZE', 1000)),
+                          ttl=float(os.getenv('FRAGMENT_CACHE_TTL', 3600)))
+
+
+
+def is_spoonacular_id(text):
+    """Checks that text is a Spoonacular recipe or ingredient id: ASCII
+    digits only. (str.isdigit also passes characters like "²".)"""
+
+    return re.fullmatch(r'[0-9]+', text) is not None
+
 
 
 @app.before_request
@@ -38,21 +79,36 @@ def pre_process_all_requests():
 
     user_id = session.get('user_id')  # Get user id from session
 
-    # Grab user's info from DB using the id. Save to g.current_user
+    # g.current_user only queries the DB the first time a route uses it;
+    # routes that just need the id use g.user_id
     if user_id:
-        g.current_user = User.query.get(user_id)
+        g.user_id = user_id
+        g.current_user = LocalProxy(load_current_user)
         g.logged_in = True
     else:
+        g.user_id = None
         g.logged_in = False
         g.current_user = None
 
+
+def load_current_user():
+    """Grab user's info from DB using the id in the session, once per
+    request."""
+
+    if '_current_user' not in g:
+        g._current_user = User.query.get(g.user_id)
+
+    return g._current_user
+
 def login_required(f):
     """ Redirects user to login page if trying to access a page that
     requires a logged in user."""
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if g.current_user is None:
+        # Cached check, so logged-in page views usually skip the DB
+        if (g.user_id is None
+                or helper_functions.get_user_identity(g.user_id) is None):
             # Get url that corresponds back to the login form
             return redirect(url_for('display_homepage', next=request.url))
         return f(*args, **kwargs)
@@ -78,10 +134,6 @@ def validate_login_info():
     username = request.form["username"]
     password = request.form["password"]
 
-    # Hash pw
-    hash = pwd_context.hash(password)
-    verified = pwd_context.verify(password, hash)
-
     # Check if user in database
     existing_user = helper_functions.check_if_user_exists(username)
 
@@ -89,10 +141,9 @@ def validate_login_info():
     if not existing_user:
         flash("{} does not exist!".format(username))
         return redirect("/")
-    if existing_user.password != password:
-        if not verified:
-            flash("Incorrect password. Try again.")
-            return redirect("/")
+    if not helper_functions.verify_password(existing_user, password):
+        flash("Incorrect password. Try again.")
+        return redirect("/")
 
     # If successful, add user to session and redirect to dashboard.
     session["user_id"] = existing_user.user_id
@@ -153,42 +204,144 @@ def display_searchbox_and_list():
 
 @app.route("/search.json")
 @login_required
+@conditional(max_age=SEARCH_MAX_AGE)
 
 def process_recipe_search():
     """Processes recipe search, using Spoonacular API to access data."""
 
-    
-    recipe_search = request.args.get("recipe_search")
-
-
-    results_json = api_calls.recipe_search(recipe_search)
+    # One deadline covers the search call and every summary lookup
+    deadline = time.monotonic() + api_calls.SEARCH_DEADLINE
 
-    
-    for recipe in results_json['results']:
-        recipe_id = str(recipe['id'])
-
-        summary_response = api_calls.summary_info(recipe_id)
+    recipe_search = request.args.get("recipe_search")
+    number, offset = api_calls.clamp_page(
+        request.args.get("number_of_results"), request.args.get("offset"))
+
+    # Diet and nutrition filters, e.g. diet=vegan&max_ready_time=30
+    diets, ranges = facets.parse_filters(request.args)
+
+    # Stored recipes answer the search if enough of them match well
+    results_json = helper_functions.search_stored_recipes(
+        recipe_search, number, offset, diets, ranges,
+        request.args.get("facets") == "1")
+
+    if results_json is None:
+        # Search, then fetch all summaries concurrently (or reuse a cached,
+        # already enriched page for an equivalent query)
+        filters, unfiltered = facets.upstream_params(diets, ranges)
+        results_json = api_calls.enriched_recipe_search(recipe_search,
+                                                        deadline, number,
+                                                        offset, filters)
+        if unfiltered:
+            results_json = dict(results_json, unfiltered=unfiltered)
+
+        # Warm the cache for the recipes the user is likely to open next
+        api_calls.prefetch_recipe_info(
+            [recipe['id'] for recipe in results_json['results']],
+            session['user_id'])
+
+    # Searches that found something are worth suggesting to others
+    if results_json['results']:
+        helper_functions.suggester.add_query(recipe_search)
+
+    # Return json to search-result.js ajax success function, trimmed to the
+    # fields it asked for
+    return jsonify(api_calls.project_results(
+        api_calls.with_has_more(results_json, offset),
+        api_calls.parse_fields(request.args.get("fields")),
+        request.args.get("compact") == "1"))
+
+
+
+@app.route("/search.ndjson")
+@login_required
 
-        # Store info returned as json and isolate its "summary" info
-        summary_json = summary_response
-        summary_text = summary_json['summary']
+def stream_recipe_search():
+    """Streams recipe search results as newline-delimited JSON events: the
+    result list as soon as the search returns, then each summary as it
+    arrives. See api_calls.stream_recipe_search for the events."""
 
-        # Append info to other json's recipes
-        recipe['summary'] = summary_text
+    deadline = time.monotonic() + api_calls.SEARCH_DEADLINE
 
-    # Return json to search-result.js ajax success function
-    return jsonify(results_json)
+    recipe_search = request.args.get("recipe_search")
+    number, offset = api_calls.clamp_page(
+        request.args.get("number_of_results"), request.args.get("offset"))
+
+    diets, ranges = facets.parse_filters(request.args)
+    unfiltered = []
+
+    # Stored recipes answer the search if enough of them match well; they
+    # come complete, so need no prefetching either
+    local_results = helper_functions.search_stored_recipes(
+        recipe_search, number, offset, diets, ranges,
+        request.args.get("facets") == "1")
+    if local_results is not None:
+        events = iter([{'event': 'results', 'data': local_results},
+                       {'event': 'done', 'missing': []}])
+    else:
+        filters, unfiltered = facets.upstream_params(diets, ranges)
+        events = api_calls.stream_recipe_search(recipe_search, deadline,
+                                                number, offset, filters)
+
+        # The search itself runs on the first next(); run it before the
+        # 200 is sent, so a failed search still gets its 503
+        events = chain([next(events)], events)
+
+    fields = api_calls.parse_fields(request.args.get("fields"))
+    compact = request.args.get("compact") == "1"
+
+    user_id = session['user_id']
+
+    def generate():
+        recipe_ids = []
+
+        try:
+            for event in events:
+                if event['event'] == 'results':
+                    recipe_ids = [recipe['id']
+                                  for recipe in event['data']['results']]
+                    if recipe_ids:
+                        helper_functions.suggester.add_query(recipe_search)
+                    data = api_calls.with_has_more(event['data'], offset)
+                    # Say which filters Spoonacular couldn't apply
+                    if unfiltered:
+                        data['unfiltered'] = unfiltered
+                    event = dict(event, data=data)
+
+                event = api_calls.project_search_event(event, fields,
+                                                       compact)
+                if event is not None:
+                    yield json.dumps(event) + "\n"
+        except (api_calls.UpstreamUnavailable,
+                requests.RequestException) as error:
+            # Too late for an error status; tell the page in the stream
+            yield json.dumps({'event': 'error', 'error': str(error)}) + "\n"
+            return
+
+        # Warm the cache for the recipes the user is likely to open next
+        if local_results is None:
+            api_calls.prefetch_recipe_info(recipe_ids, user_id)
+
+    # Ask proxies not to buffer the stream
+    return Response(stream_with_context(generate()),
+                    mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no"})
 
 
 
 @app.route("/recipe-info/<recipe_id>")
 @login_required
+@conditional(max_age=RECIPE_MAX_AGE)
 
 def display_recipe_info(recipe_id):
     """ Display detailed recipe info upon clicking on link. """
 
-    # Call recipe info API
-    recipe_info_json = api_calls.recipe_info(recipe_id)
+    # Stored recipes come from the DB; others from the recipe info API
+    try:
+        recipe_info_json = helper_functions.get_recipe_info(recipe_id)
+    except requests.HTTPError as error:
+        if not api_calls.is_not_found(error):
+            raise
+        abort(404)
 
     # Unpack json
     title = recipe_info_json['title']
@@ -212,20 +365,13 @@ def process_recipe_bookmark_button():
     
     recipe_id = request.form["recipe_id"]
 
-    # Check if recipe in DB. If not, add new recipe to DB.
-    current_recipe = helper_functions.check_if_recipe_exists(recipe_id)
-
-    if not current_recipe:
-        current_recipe = helper_functions.add_recipe(recipe_id)
-
-    # Check if user already bookmarked recipe. If not, add to DB.
-    bookmark_exists = (helper_functions
-                       .check_if_bookmark_exists(current_recipe.recipe_id,
-                                                 g.current_user.user_id))
+    # Spoonacular recipe ids are numbers; don't store anything else
+    if not is_spoonacular_id(recipe_id):
+        return "That is not a recipe.", 400
 
-    if not bookmark_exists:
-        helper_functions.add_bookmark(g.current_user.user_id,
-                                      current_recipe.recipe_id)
+    # Add bookmark (and recipe, if new) to DB in one round trip. The recipe
+    # details are fetched afterwards, in the background.
+    if helper_functions.bookmark_recipe(g.user_id, recipe_id):
         # Return success message to bookmark-recipe.js 
         success_message = "This recipe has been bookmarked!"
         return success_message
@@ -237,39 +383,190 @@ def process_recipe_bookmark_button():
 
 
 
+@app.route("/bookmarks.json", methods=["POST"])
+@login_required
+
+def process_batch_bookmarks():
+    """Adds and removes many bookmarks at once. Takes a JSON body like
+    {"add": [recipe ids], "remove": [recipe ids]} and returns the status of
+    each recipe id."""
+
+    batch = request.get_json(silent=True)
+    if (not isinstance(batch, dict)
+            or not isinstance(batch.get("add", []), list)
+            or not isinstance(batch.get("remove", []), list)):
+        return jsonify({"error": 'Send {"add": [...], "remove": [...]}.'}), 400
+
+    add_ids = [str(recipe_id) for recipe_id in batch.get("add", [])]
+    remove_ids = [str(recipe_id) for recipe_id in batch.get("remove", [])]
+
+    if len(add_ids) + len(remove_ids) > helper_functions.MAX_BATCH_BOOKMARKS:
+        return jsonify({"error": "At most {} recipes per batch.".format(
+            helper_functions.MAX_BATCH_BOOKMARKS)}), 400
+
+    # Spoonacular recipe ids are numbers; report anything else as invalid
+    statuses = {recipe_id: "invalid" for recipe_id in add_ids + remove_ids
+                if not is_spoonacular_id(recipe_id)}
+
+    statuses.update(helper_functions.update_bookmarks(
+        g.user_id,
+        [recipe_id for recipe_id in add_ids if is_spoonacular_id(recipe_id)],
+        [recipe_id for recipe_id in remove_ids if is_spoonacular_id(recipe_id)]))
+
+    return jsonify({"statuses": statuses})
+
+
+
+
 @app.route("/favorite")
 @login_required
+@conditional()
 
 def display_profile():
-    """Display user profile of username, email, and bookmarked recipes."""
+    """Display user profile of username, email, and one page of bookmarked
+    recipes."""
+
+    # Username and email come from the identity cache, not the DB
+    identity = helper_functions.get_user_identity(g.user_id)
+
+    after = request.args.get("after", type=int)
+    version = helper_functions.get_bookmark_version(g.user_id)
+    helper_functions.hydrate_bare_recipes_later()
+
+    def render_bookmarks():
+        bookmarked_recipes, next_cursor = (
+            helper_functions.get_bookmarked_recipes(g.user_id, after=after))
+
+        return Markup(render_template("_bookmarks.html",
+                                      bookmarked_recipes=bookmarked_recipes,
+                                      next_cursor=next_cursor))
+
+    bookmarks = fragment_cache.get_or_load(
+        ('bookmarks', g.user_id, version, after), render_bookmarks)
 
     return render_template("user_profile.html",
-                           username=g.current_user.username,
-                           email=g.current_user.email,
-                           bookmarked_recipes=g.current_user.recipes)
+                           username=identity['username'],
+                           email=identity['email'],
+                           bookmarks=bookmarks)
 
 
                            
+def bookmarks_version_key():
+    """Changes whenever the requested page of the user's bookmarks does."""
+
+    # Runs even when the page is unchanged: retry recipes still nameless
+    helper_functions.hydrate_bare_recipes_later()
+
+    return ('bookmarks', g.user_id,
+            helper_functions.get_bookmark_version(g.user_id),
+            request.args.get("after", type=int))
+
+
 @app.route("/bookmark-display.json")
 @login_required
+@conditional(etag=bookmarks_version_key)
 
 def process_bookmark_images():
-    """Get all bookmark images from DB."""
+    """Get one page of bookmarked recipes from DB, with their images. Pass
+    the returned "next" cursor back as "after" for the following page."""
     
 
-    # Extract list of recipes from DB
-    bookmarked_recipes = g.current_user.recipes
+    # Extract page of recipes from DB
+    bookmarked_recipes, next_cursor = helper_functions.get_bookmarked_recipes(
+        g.user_id, after=request.args.get("after", type=int))
 
     # Create dictionary of recipe image links
-    bookmark_images = {'images': []}
+    bookmark_images = {'images': [], 'recipes': [], 'next': next_cursor}
 
     for recipe in bookmarked_recipes:
         bookmark_images['images'].append(recipe.img_url)
-
-    print(bookmark_images)
+        bookmark_images['recipes'].append({'recipe_id': recipe.recipe_id,
+                                           'recipe_name': recipe.recipe_name,
+                                           'img_url': recipe.img_url})
 
     return jsonify(bookmark_images)
 
+
+@app.route("/suggest.json")
+@login_required
+@conditional(max_age=SUGGEST_MAX_AGE)
+
+def suggest_searches():
+    """Suggests searches completing "q", from stored recipe titles,
+    ingredient names and popular searches, correcting typos."""
+
+    helper_functions.refresh_suggestions()
+
+    query = request.args.get("q", "")
+    limit = min(max(request.args.get("limit", 8, type=int), 1),
+                suggest.MAX_SUGGESTIONS)
+
+    return jsonify({'query': query,
+                    'suggestions': helper_functions.suggester.suggest(
+                        query, limit)})
+
+
+@app.route("/pantry.json")
+@login_required
+@conditional()
+
+def match_pantry():
+    """Ranks stored recipes by how much of their ingredient list a pantry
+    covers. Takes a comma-separated list of ingredient names or ids as
+    "ingredients", and optionally "limit" and "max_missing"."""
+
+    ingredients = [int(term) if is_spoonacular_id(term) else term
+                   for term in (term.strip() for term
+                                in request.args.get("ingredients", "")
+                                .split(","))
+                   if term]
+
+    limit = min(max(request.args.get("limit", 20, type=int), 1),
+                helper_functions.MAX_PANTRY_MATCHES)
+
+    max_missing = request.args.get("max_missing", type=int)
+    if max_missing is not None:
+        max_missing = max(max_missing, 0)
+
+    return jsonify({'results': helper_functions.match_pantry(
+        ingredients, limit, max_missing)})
+
+
+@app.route("/static/dist/<path:filename>")
+def serve_built_asset(filename):
+    """Serve a hashed JS or CSS bundle, precompressed where possible and
+    cached by browsers for good."""
+
+    return assets.send_asset(filename)
+
+
+@app.errorhandler(api_calls.UpstreamUnavailable)
+@app.errorhandler(requests.RequestException)
+def handle_upstream_unavailable(error):
+    """Fail with 503 while Spoonacular is down, out of quota or erroring,
+    and no stale copy could stand in."""
+
+    return jsonify({'error': str(error)}), 503
+
+
+@app.route("/metrics.json")
+def display_metrics():
+    """Report this process's Spoonacular call stats, cache counters,
+    quota headroom, queue depth and circuit breaker state. For monitoring
+    only: requests must send "Authorization: Bearer <METRICS_TOKEN>"."""
+
+    if not METRICS_TOKEN:
+        abort(404)
+
+    supplied = request.headers.get("Authorization", "")
+    expected = "Bearer " + METRICS_TOKEN
+    if not hmac.compare_digest(supplied.encode('utf-8'),
+                               expected.encode('utf-8')):
+        abort(403)
+
+    return jsonify(api_calls.stats())
+
+
 if __name__ == "__main__":
    
     app.debug = True
@@ -1,50 +1,180 @@
-function displaySearchResults(results) {
-  $("#recipes").empty();
+function escapeHtml(text) {
+  // titles are plain text; show any < or & in them as typed
+  return $("<div>").text(text || "").html();
+}
+
+function createRecipeDiv(recipe, baseUri) {
+  // create div tag to serve as container for each recipe
+  var beginDiv = "<div class='recipe text-center'>";
+  var endDiv = "</div>";
+
+  // create img
+  var imgUrl = baseUri + recipe["image"];
+  var img = "<img src=" + imgUrl + " class='img-rounded'>" + "<br>";
+
+  // create recipe title
+  var recipeId = String(recipe["id"]);
+
+  var title =
+    "<h3 class='recipe-title' data-recipe-id='" +
+    recipeId +
+    "'> <a href='/recipe-info/" +
+    recipeId +
+    "'>" +
+    escapeHtml(recipe["title"]) +
+    "</a> </h3>";
+
+  // create summary container; filled in when the summary arrives
+  var summary =
+    "<div class='recipe-summary' data-recipe-id='" + recipeId + "'></div>";
+
+  // beside each recipe title, add two buttons: 'bookmark' and 'add to list'
+  var bookmarkButton =
+    "<button type='button' class='favorite btn btn-info' data-recipe-id='" +
+    recipeId +
+    "'> <span class='glyphicon glyphicon-heart'></span> </button>";
+  var addButton =
+    "<button type='button' class='add-to-list btn btn-info' data-recipe-id='" +
+    recipeId +
+    "'> <span class='glyphicon glyphicon-shopping-cart'></span> </button> </br>";
+
+  // add all elements together into recipe div element
+  return beginDiv + title + bookmarkButton + addButton + img + summary + endDiv;
+}
+
+function displaySummary(recipeId, summaryText) {
+  // lookups that missed the deadline come back empty
+  if (summaryText) {
+    $(".recipe-summary[data-recipe-id='" + recipeId + "']").html(
+      "<p>" + summaryText + "</p> <br>"
+    );
+  }
+}
+
+// the search being shown, so "load more" can ask for its next page
+var currentSearch = null;
+
+function displaySearchResults(results, append) {
+  if (!append) {
+    $("#recipes").empty();
+  }
+  $("#load-more").remove();
 
   // get result key from json object, returns list
   var searchResults = results["results"];
 
   for (var i = 0; i < searchResults.length; i++) {
-    // create div tag to serve as container for each recipe
-    var beginDiv = "<div class='recipe text-center'>";
-    var endDiv = "</div>";
-
-    // create img
-    var imgUrl = results["baseUri"] + searchResults[i]["image"];
-    var img = "<img src=" + imgUrl + " class='img-rounded'>" + "<br>";
-
-    // create recipe title
-    var recipeId = String(searchResults[i]["id"]);
-
-    var title =
-      "<h3 class='recipe-title' data-recipe-id='" +
-      recipeId +
-      "'> <a href='/recipe-info/" +
-      recipeId +
-      "'>" +
-      searchResults[i]["title"] +
-      "</a> </h3>";
-
-    // create summary
-    var summary = "<p>" + searchResults[i]["summary"] + "</p> <br>";
-
-    // beside each recipe title, add two buttons: 'bookmark' and 'add to list'
-    var bookmarkButton =
-      "<button type='button' class='favorite btn btn-info' data-recipe-id='" +
-      recipeId +
-      "'> <span class='glyphicon glyphicon-heart'></span> </button>";
-    var addButton =
-      "<button type='button' class='add-to-list btn btn-info' data-recipe-id='" +
-      recipeId +
-      "'> <span class='glyphicon glyphicon-shopping-cart'></span> </button> </br>";
-
-    // add all elements together into recipe div element
+    $("#recipes").append(createRecipeDiv(searchResults[i], results["baseUri"]));
+    displaySummary(searchResults[i]["id"], searchResults[i]["summary"]);
+  } // end loop
+
+  // offer the next page if the server says there is one we can ask for
+  if (results["has_more"]) {
+    currentSearch["offset"] = results["offset"] + searchResults.length;
     $("#recipes").append(
-      beginDiv + title + bookmarkButton + addButton + img + summary + endDiv
+      "<button type='button' id='load-more' class='btn btn-info'>Load more</button>"
     );
-  } // end loop
+  }
 } // end fn
 
+function displaySearchError(append) {
+  // keep what's shown when only a later page failed
+  if (append) {
+    $("#load-more").prop("disabled", false);
+  } else {
+    $("#recipes").html(
+      "<p>Recipe search isn't available right now. Please try again in a minute.</p>"
+    );
+  }
+}
+
+function handleSearchEvent(searchEvent, append) {
+  // first event lists the recipes; later ones fill in their summaries
+  if (searchEvent["event"] === "results") {
+    displaySearchResults(searchEvent["data"], append);
+  } else if (searchEvent["event"] === "summary") {
+    displaySummary(searchEvent["id"], searchEvent["summary"]);
+  }
+}
+
+function streamSearchResults(formInputs, append) {
+  // read newline-delimited json events as they arrive
+  var decoder = new TextDecoder();
+  var buffered = "";
+
+  // whether the recipes are on the page, so an error after them is harmless
+  var shown = false;
+
+  return fetch("/search.ndjson?" + $.param(formInputs), {
+    credentials: "same-origin"
+  }).then(function(response) {
+    if (!response.ok) {
+      throw new Error("search failed with status " + response.status);
+    }
+
+    var reader = response.body.getReader();
+
+    function readChunk(chunk) {
+      if (chunk.done) {
+        if (!shown) {
+          throw new Error("search stream ended without results");
+        }
+        return;
+      }
+
+      buffered += decoder.decode(chunk.value, { stream: true });
+      var lines = buffered.split("\n");
+      buffered = lines.pop();
+
+      for (var i = 0; i < lines.length; i++) {
+        if (!lines[i]) {
+          continue;
+        }
+
+        var searchEvent = JSON.parse(lines[i]);
+        if (searchEvent["event"] === "error") {
+          if (!shown) {
+            throw new Error(searchEvent["error"]);
+          }
+          return;
+        }
+
+        handleSearchEvent(searchEvent, append);
+        if (searchEvent["event"] === "results") {
+          shown = true;
+        }
+      }
+
+      return reader.read().then(readChunk);
+    }
+
+    return reader.read().then(readChunk);
+  });
+}
+
+function requestSearchPage(append) {
+  // copy the search so later pages don't change this request
+  var formInputs = $.extend({}, currentSearch);
+
+  // stream results where the browser supports it; otherwise, or if the
+  // stream fails, wait for all of them
+  if (window.fetch && window.TextDecoder && window.ReadableStream) {
+    streamSearchResults(formInputs, append).catch(function() {
+      requestWholePage(formInputs, append);
+    });
+  } else {
+    requestWholePage(formInputs, append);
+  }
+}
+
+function requestWholePage(formInputs, append) {
+  $.get("/search.json", formInputs, function(results) {
+    displaySearchResults(results, append);
+  }).fail(function() {
+    displaySearchError(append);
+  });
+}
+
 function handleSearchResults(evt) {
   $("#recipes").html(
     "<button class='buttonload'><i class='fa fa-spinner fa-spin'></i> Looking for new recipes...</button>"
@@ -53,14 +183,23 @@ function handleSearchResults(evt) {
   evt.preventDefault();
 
   // package up info from user input
-  var formInputs = {
+  currentSearch = {
     recipe_search: $("#recipe-search").val(),
-    number_of_results: $("#search-quantity").val()
+    number_of_results: $("#search-quantity").val(),
+    offset: 0,
+    // only the fields shown here, with short plain-text summaries
+    compact: 1
   };
 
-  // send info to server
-  $.get("/search.json", formInputs, displaySearchResults);
+  requestSearchPage(false);
+}
+
+function handleLoadMore(evt) {
+  $("#load-more").prop("disabled", true);
+
+  requestSearchPage(true);
 }
 
 // event listener for recipe search box in dashboard.html
 $("#search-result").on("submit", handleSearchResults);
+$(document).on("click", "#load-more", handleLoadMore);
@@ -0,0 +1,46 @@
+// wait this long after the last keystroke before asking for suggestions
+var SUGGEST_DELAY = 150;
+
+var suggestTimer = null;
+var suggestRequest = null;
+
+function displaySuggestions(suggestions) {
+  $("#search-suggestions").empty();
+
+  for (var i = 0; i < suggestions.length; i++) {
+    $("#search-suggestions").append(
+      $("<option>").attr("value", suggestions[i])
+    );
+  }
+}
+
+function requestSuggestions(query) {
+  // a newer keystroke makes the previous request pointless
+  if (suggestRequest) {
+    suggestRequest.abort();
+  }
+
+  suggestRequest = $.getJSON("/suggest.json", { q: query }, function(results) {
+    displaySuggestions(results["suggestions"]);
+  }).always(function() {
+    suggestRequest = null;
+  });
+}
+
+function handleSuggestInput(evt) {
+  var query = $("#recipe-search").val();
+
+  clearTimeout(suggestTimer);
+
+  if (!query.trim()) {
+    displaySuggestions([]);
+    return;
+  }
+
+  suggestTimer = setTimeout(function() {
+    requestSuggestions(query);
+  }, SUGGEST_DELAY);
+}
+
+// event listener for recipe search box in dashboard.html
+$("#recipe-search").on("input", handleSuggestInput);
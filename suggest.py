@@ -0,0 +1,280 @@
+""" Search box suggestions: a prefix trie over recipe titles, ingredient
+names and popular queries, with typo correction over the words in them. """
+
+from bisect import insort
+import re
+import threading
+
+# Suggestions kept per trie node, and so the most one lookup returns
+MAX_SUGGESTIONS = 10
+
+# Phrases are indexed by their first PREFIX_DEPTH characters from each
+# word; longer prefixes are matched by filtering, which bounds the trie
+PREFIX_DEPTH = 12
+
+# Popular queries outweigh catalogue entries. A query is suggested once
+# it has been searched MIN_QUERY_COUNT times, and at most MAX_QUERIES
+# distinct queries are counted.
+QUERY_WEIGHT = 2
+MIN_QUERY_COUNT = 3
+MAX_QUERIES = 10000
+
+
+def words_of(text):
+    """Splits text into lowercase words."""
+
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def edit_distance(a, b, limit):
+    """Returns the Levenshtein distance between a and b, or limit + 1 as
+    soon as it is certain to exceed limit."""
+
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+
+    return previous[-1]
+
+
+def typo_limit(word):
+    """Edits allowed when correcting word: none for very short words."""
+
+    if len(word) <= 3:
+        return 0
+    if len(word) <= 6:
+        return 1
+
+    return 2
+
+
+def bigrams(word):
+    """Returns the letter pairs of word, padded so its first and last
+    letters get pairs of their own, with how often each occurs."""
+
+    padded = '^' + word + '$'
+    counts = {}
+    for i in range(len(padded) - 1):
+        counts[padded[i:i + 2]] = counts.get(padded[i:i + 2], 0) + 1
+
+    return counts
+
+
+class WordIndex(object):
+    """Words indexed by their letter pairs, so the words within a few edits
+    of a misspelling are found without comparing against every word. Each
+    edit changes at most two of a word's pairs, so a word within limit
+    edits of typed shares at least len(typed) + 1 - 2 * limit pairs with
+    it; only the few words that do are compared in full."""
+
+    def __init__(self):
+        self.postings = {}
+        self.size = 0
+
+    def add(self, word):
+        """Adds word. Each word must be added only once."""
+
+        for pair, count in bigrams(word).items():
+            self.postings.setdefault(pair, []).append((word, count))
+        self.size += 1
+
+    def closest(self, word, limit):
+        """Returns the word in the index nearest to word, within limit
+        edits, or None."""
+
+        needed = len(word) + 1 - 2 * limit
+        if needed <= 0:
+            return None
+
+        shared = {}
+        for pair, count in bigrams(word).items():
+            for candidate, candidate_count in self.postings.get(pair, ()):
+                shared[candidate] = (shared.get(candidate, 0)
+                                     + min(count, candidate_count))
+
+        best = None
+        best_distance = limit + 1
+        for candidate, common in shared.items():
+            if common < needed or abs(len(candidate) - len(word)) > limit:
+                continue
+            distance = edit_distance(word, candidate, limit)
+            if distance <= limit and (best is None
+                                      or (distance, candidate)
+                                      < (best_distance, best)):
+                best, best_distance = candidate, distance
+
+        return best
+
+
+class _Node(object):
+    """One trie node: its children, and the best phrases below it as a
+    sorted list of (-score, phrase), highest score first."""
+
+    __slots__ = ('children', 'top')
+
+    def __init__(self):
+        self.children = {}
+        self.top = []
+
+
+class Suggester(object):
+    """Suggests phrases for what's been typed so far. Every phrase can be
+    found from the start of any of its words ("chick" finds "thai chicken
+    curry"), best scored first. Lookups only walk the typed prefix; the
+    best phrases under each node are kept up to date as phrases are added
+    or gain score. Thread-safe."""
+
+    def __init__(self):
+        self.root = _Node()
+        self.scores = {}
+        self.display = {}
+        self.words = WordIndex()
+        self.known_words = set()
+        self.query_counts = {}
+        # Newest Recipe.fetched_at loaded, and when it was checked, for
+        # incremental refresh
+        self.watermark = None
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, text):
+        """Adds text, e.g. a recipe title, as a phrase if it isn't one."""
+
+        key = ' '.join(words_of(text))
+        if not key:
+            return
+
+        with self._lock:
+            if key not in self.scores:
+                self._add(key, text, 1)
+
+    def add_query(self, text):
+        """Counts a search that found recipes. From its MIN_QUERY_COUNT-th
+        search on, the query is a phrase and gains score with each one."""
+
+        key = ' '.join(words_of(text))
+        if not key:
+            return
+
+        with self._lock:
+            count = self.query_counts.get(key)
+            if count is None:
+                if len(self.query_counts) >= MAX_QUERIES:
+                    return
+                count = 0
+            count += 1
+            self.query_counts[key] = count
+
+            if count == MIN_QUERY_COUNT:
+                self._add(key, text, count * QUERY_WEIGHT)
+            elif count > MIN_QUERY_COUNT:
+                self._add(key, text, QUERY_WEIGHT)
+
+    def _add(self, key, text, score):
+        """Adds score to phrase key, shown as text, adding the phrase if
+        needed. Call with the lock held."""
+
+        old_score = self.scores.get(key)
+        self.display.setdefault(key, text.strip())
+        self.scores[key] = (old_score or 0) + score
+
+        keyed = key.split(' ')
+        for start in range(len(keyed)):
+            self._raise(' '.join(keyed[start:]), key, old_score)
+
+        for word in keyed:
+            if word not in self.known_words:
+                self.known_words.add(word)
+                self.words.add(word)
+
+    def _raise(self, path, key, old_score):
+        """Moves key from old_score (None for a new phrase) to its current
+        score in the top list of every node along path. Call with the lock
+        held."""
+
+        entry = (-self.scores[key], key)
+        old_entry = (-old_score, key) if old_score is not None else None
+        node = self.root
+
+        for char in path[:PREFIX_DEPTH]:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = _Node()
+            node = child
+            top = node.top
+
+            if old_entry is not None and old_entry in top:
+                top.remove(old_entry)
+            if len(top) < MAX_SUGGESTIONS or entry < top[-1]:
+                insort(top, entry)
+                del top[MAX_SUGGESTIONS:]
+
+    def suggest(self, text, limit=MAX_SUGGESTIONS):
+        """Returns up to limit phrases for text, correcting typos in its
+        words when the text as typed finds too few."""
+
+        typed = words_of(text)
+        if not typed:
+            return []
+
+        with self._lock:
+            found = self._lookup(' '.join(typed) + self._trailing(text))
+
+            if len(found) < limit:
+                corrected = self._correct(typed)
+                if corrected != typed:
+                    for key in self._lookup(' '.join(corrected)):
+                        if key not in found:
+                            found.append(key)
+
+            return [self.display[key] for key in found[:limit]]
+
+    @staticmethod
+    def _trailing(text):
+        """Keeps a trailing space, so "pot " no longer matches "potato"."""
+
+        return ' ' if text.endswith(' ') else ''
+
+    def _lookup(self, prefix):
+        """Returns the best phrases under prefix. Call with the lock held."""
+
+        node = self.root
+        for char in prefix[:PREFIX_DEPTH]:
+            node = node.children.get(char)
+            if node is None:
+                return []
+
+        if len(prefix) <= PREFIX_DEPTH:
+            return [key for _, key in node.top]
+
+        return [key for _, key in node.top
+                if (' ' + key).find(' ' + prefix.rstrip()) >= 0]
+
+    def _correct(self, typed):
+        """Returns typed with unknown words replaced by the nearest known
+        ones. The last word may still be being typed, so it's kept if it
+        starts some known phrase word. Call with the lock held."""
+
+        corrected = []
+        for position, word in enumerate(typed):
+            last = position == len(typed) - 1
+            if word in self.known_words or (last and self._lookup(word)):
+                corrected.append(word)
+                continue
+
+            closest = self.words.closest(word, typo_limit(word))
+            corrected.append(closest or word)
+
+        return corrected
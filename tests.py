@@ -2,15 +2,38 @@
 from unittest import TestCase
 
 # import example_data function only
-from model import connect_to_db, db, example_data, User, Bookmark
+from model import connect_to_db, db, example_data, User, Recipe, Bookmark
+from model import Ingredient, RecipeCuisine, RecipeIngredient
+from model import PLAINTEXT_MARKER
 
-from server import app
+from server import app, fragment_cache
+import server
+import helper_functions
 from flask import session
 
 # import file with Spoonacular API calls to mock
 import api_calls
+import assets
+import facets
 
 import fake_api_json
+from cache import SingleFlight, TTLCache
+from scheduler import (INTERACTIVE, HYDRATION, PREFETCH, CircuitBreaker,
+                       UpstreamScheduler, UpstreamUnavailable)
+
+from datetime import timedelta
+import gzip
+import json
+from passlib.hash import md5_crypt
+import pantry
+import random
+import requests
+import shutil
+import suggest
+import tempfile
+import text_utils
+import threading
+import time
 
 
 
@@ -48,6 +71,27 @@ class FlaskTestsLogInLogOutRegistration(TestCase):
         result = self.client.get('/')
         self.assertIn(b"Register", result.data)
 
+    def test_password_pool_started_once(self):
+        """Test that concurrent first uses share one pool that doesn't fork
+        this multi-threaded process."""
+
+        if helper_functions.password_pool is not None:
+            helper_functions.password_pool.shutdown()
+        helper_functions.password_pool_pid = None
+        pools = []
+        threads = [threading.Thread(
+            target=lambda: pools.append(helper_functions.get_password_pool()))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(set(map(id, pools))), 1)
+        self.assertNotEqual(helper_functions.PASSWORD_START_METHOD, 'fork')
+        self.assertTrue(helper_functions.verify_password(
+            User.query.get(1), 'qwert'))
+
     def test_correct_login(self):
         """Test log in form with correct info."""
 
@@ -60,6 +104,53 @@ class FlaskTestsLogInLogOutRegistration(TestCase):
             self.assertEqual(session['user_id'], 1)
             self.assertIn(b"krish has successfully logged in.", result.data)
 
+    def test_incorrect_password(self):
+        """Test that log in fails with the wrong password."""
+
+        with self.client as c:
+            result = c.post('/login',
+                            data={'username': 'krish', 'password': 'wrong'},
+                            follow_redirects=True
+                            )
+
+            self.assertNotIn('user_id', session)
+            self.assertIn(b"Incorrect password. Try again.", result.data)
+
+    def test_login_upgrades_stored_password(self):
+        """Test that a plaintext password is replaced by a hash on login."""
+
+        self.client.post('/login',
+                         data={'username': 'krish', 'password': 'qwert'})
+
+        current_user = User.query.filter(User.username == 'krish').first()
+        self.assertFalse(current_user.password.startswith(
+            PLAINTEXT_MARKER))
+        self.assertTrue(helper_functions.verify_password(current_user,
+                                                         'qwert'))
+        self.assertFalse(helper_functions.verify_password(current_user,
+                                                          'qwert1'))
+
+    def test_deprecated_scheme_hash_not_taken_for_plaintext(self):
+        """Test that hashes of a dropped scheme verify and get rehashed,
+        while unmarked values of unknown scheme never match themselves."""
+
+        current_user = User.query.get(1)
+        current_user.password = md5_crypt.hash('qwert')
+        db.session.commit()
+
+        self.assertFalse(helper_functions.verify_password(
+            current_user, current_user.password))
+        self.assertTrue(helper_functions.verify_password(current_user,
+                                                         'qwert'))
+        self.assertEqual(helper_functions.pwd_context.identify(
+            current_user.password), helper_functions.PASSWORD_SCHEMES[0])
+
+        current_user.password = 'qwert'
+        db.session.commit()
+
+        self.assertFalse(helper_functions.verify_password(current_user,
+                                                          'qwert'))
+
    
     def test_logout(self):
         """Test logout route."""
@@ -123,12 +214,140 @@ class FlaskTestsFavorite(TestCase):
             with c.session_transaction() as sess:
                 sess['user_id'] = 1
 
+        helper_functions.identity_cache.clear()
+        fragment_cache.clear()
+
+        # Viewing bookmarks would hydrate the bare example recipes
+        self.original_hydrate_bare_recipes_later = (
+            helper_functions.hydrate_bare_recipes_later)
+        helper_functions.hydrate_bare_recipes_later = lambda: None
+
     def tearDown(self):
         """Do at end of every test."""
 
+        helper_functions.hydrate_bare_recipes_later = (
+            self.original_hydrate_bare_recipes_later)
         db.session.close()
         db.drop_all()
 
+    def test_failed_hydration_retried(self):
+        """Test that a bookmarked recipe Spoonacular couldn't fill in is
+        backed off, then retried when bookmarks are viewed."""
+
+        helper_functions.hydrate_bare_recipes_later = (
+            self.original_hydrate_bare_recipes_later)
+        helper_functions.hydration_retries.clear()
+        helper_functions.hydration_checked_at = None
+        original_recipe_info_bulk = api_calls.recipe_info_bulk
+        found = {}
+        api_calls.recipe_info_bulk = (
+            lambda recipe_ids, priority=None:
+            {recipe_id: fake_api_json.recipe_info(recipe_id)
+             for recipe_id in recipe_ids if recipe_id in found})
+        try:
+            helper_functions.bookmark_recipe(1, '548180')
+            helper_functions.hydration_pool.submit(lambda: None).result(5)
+            self.assertEqual(helper_functions.hydration_retries['548180'][0],
+                             1)
+
+            # Backed off: not retried yet
+            self.client.get('/bookmark-display.json')
+            helper_functions.hydration_pool.submit(lambda: None).result(5)
+            self.assertEqual(helper_functions.hydration_retries['548180'][0],
+                             1)
+
+            found['548180'] = True
+            helper_functions.hydration_retries['548180'] = (1, 0)
+            helper_functions.hydration_checked_at = None
+            self.client.get('/bookmark-display.json')
+            helper_functions.hydration_pool.submit(lambda: None).result(5)
+        finally:
+            api_calls.recipe_info_bulk = original_recipe_info_bulk
+
+        self.assertNotIn('548180', helper_functions.hydration_retries)
+        db.session.expire_all()
+        self.assertEqual(Recipe.query.get('548180').recipe_name,
+                         "Italian Sausage Tortellini Soup")
+
+    def test_bookmarks_fragment_cached_until_bookmarked(self):
+        """Test that the bookmark list is rendered once per bookmark
+        version, with the carousel inline."""
+
+        result = self.client.get('/favorite')
+        self.assertNotIn(b"carousel-image", result.data)
+        self.assertEqual(fragment_cache.stats()['misses'], 1)
+
+        self.client.get('/favorite')
+        self.assertEqual(fragment_cache.stats()['hits'], 1)
+
+        db.session.add(Recipe(recipe_id='101', recipe_name='Dal Makhani',
+                              img_url='dal-makhani-101.jpg'))
+        db.session.commit()
+        helper_functions.bookmark_recipe(1, '101')
+
+        result = self.client.get('/favorite')
+        self.assertIn(b"Dal Makhani", result.data)
+        self.assertIn(b'<img class="carousel-image" src="dal-makhani-101.jpg">',
+                      result.data)
+        self.assertEqual(fragment_cache.stats()['misses'], 2)
+
+    def test_bookmark_images_not_modified_until_bookmarked(self):
+        """Test that the bookmark list ETag follows the bookmark version."""
+
+        result = self.client.get('/bookmark-display.json')
+        self.assertIn('private', result.headers['Cache-Control'])
+        self.assertIn('no-cache', result.headers['Cache-Control'])
+
+        etag = result.headers['ETag']
+        result = self.client.get('/bookmark-display.json',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+
+        helper_functions.bookmark_recipe(1, '227961')
+
+        result = self.client.get('/bookmark-display.json',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result.headers['ETag'], etag)
+
+    def test_identity_cached_until_updated(self):
+        """Test that profile details are cached and refreshed on update."""
+
+        self.client.get('/favorite')
+        self.assertEqual(helper_functions.identity_cache.stats()['hits'], 1)
+
+        user = User.query.get(1)
+        user.email = 'krish@example.com'
+        db.session.commit()
+
+        result = self.client.get('/favorite')
+        self.assertIn(b"krish@example.com", result.data)
+
+    def test_bookmarks_paginated(self):
+        """Test that bookmarks are listed newest first, one page at a time."""
+
+        for recipe_id in ['101', '102', '103']:
+            db.session.add(Recipe(recipe_id=recipe_id,
+                                  recipe_name='Recipe ' + recipe_id))
+            db.session.flush()
+            db.session.add(Bookmark(user_id=1, recipe_id=recipe_id))
+            db.session.flush()
+        db.session.commit()
+
+        first, cursor = helper_functions.get_bookmarked_recipes(1, limit=2)
+        self.assertEqual([recipe.recipe_id for recipe in first],
+                         ['103', '102'])
+
+        second, last_cursor = helper_functions.get_bookmarked_recipes(
+            1, after=cursor, limit=2)
+        self.assertEqual([recipe.recipe_id for recipe in second], ['101'])
+        self.assertIsNone(last_cursor)
+
+        result = self.client.get('/bookmark-display.json?after={}'
+                                 .format(cursor))
+        self.assertEqual([recipe['recipe_id'] for recipe
+                          in json.loads(result.data)['recipes']], ['101'])
+
     def test_correct_page(self):
         """Test that correct page is showing up."""
 
@@ -199,6 +418,1292 @@ class FlaskTestsSearchPage(TestCase):
         result = self.client.get('/dashboard')
         self.assertNotIn(b"help", result.data)
 
+    def test_metrics_need_token(self):
+        """Test that metrics are off without a token and need it to match."""
+
+        original_token = server.METRICS_TOKEN
+        try:
+            server.METRICS_TOKEN = None
+            self.assertEqual(self.client.get('/metrics.json').status_code, 404)
+
+            server.METRICS_TOKEN = 'letmein'
+            result = self.client.get('/metrics.json',
+                                     headers={'Authorization': 'Bearer no'})
+            self.assertEqual(result.status_code, 403)
+
+            result = self.client.get('/metrics.json',
+                                     headers={'Authorization':
+                                              'Bearer letmein'})
+            self.assertIn('scheduler', result.get_json())
+        finally:
+            server.METRICS_TOKEN = original_token
+
+
+
+class FlaskTestsSearchResults(TestCase):
+    """Test search results with mocked Spoonacular API calls."""
+
+    def setUp(self):
+        """Before every test"""
+
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+        # Connect to test database
+        connect_to_db(app, "postgresql:///testdb")
+
+        # Create tables and add sample data
+        db.create_all()
+        example_data()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+        # Mock API calls, keeping originals to restore afterwards. Summaries
+        # come from bulk info calls, so the whole client is swapped for a
+        # fake that never reaches the network.
+        self.original_recipe_search = api_calls.recipe_search
+        self.original_summary_info = api_calls.summary_info
+        self.original_client = api_calls.client
+
+        self.searches = []
+        self.search_filters = []
+
+        def _mock_recipe_search(recipe_search, number=10, offset=0,
+                                filters=None, deadline=None):
+            self.searches.append((recipe_search, number, offset))
+            self.search_filters.append(filters)
+            return fake_api_json.recipe_search(recipe_search, '548180')
+
+        api_calls.recipe_search = _mock_recipe_search
+        api_calls.summary_info = fake_api_json.summary_info
+        api_calls.client = FakeApiClient(
+            fake_api_json.summary_info('548180')['summary'])
+        api_calls.search_cache.clear()
+        api_calls.recipe_cache.clear()
+        helper_functions.facet_index = facets.FacetIndex()
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        api_calls.recipe_search = self.original_recipe_search
+        api_calls.summary_info = self.original_summary_info
+        api_calls.client = self.original_client
+
+        db.session.close()
+        db.drop_all()
+
+    def test_search_includes_summary(self):
+        """Test that each search result has its summary attached."""
+
+        result = self.client.get('/search.json',
+                                 query_string={'recipe_search': 'soup'})
+        recipe = result.get_json()['results'][0]
+
+        self.assertIn("Italian Sausage Tortellini Soup is a", recipe['summary'])
+        self.assertFalse(recipe['summary_missing'])
+
+    def test_compact_search(self):
+        """Test that compact search results only have the rendered fields,
+        with short plain-text summaries, and that fields= projects."""
+
+        result = self.client.get('/search.json',
+                                 query_string={'recipe_search': 'soup',
+                                               'compact': '1'})
+        results = result.get_json()
+        recipe = results['results'][0]
+
+        self.assertEqual(sorted(recipe), ['id', 'image', 'summary', 'title'])
+        self.assertNotIn('<', recipe['summary'])
+        self.assertLessEqual(len(recipe['summary']),
+                             api_calls.SUMMARY_CHARS + 3)
+        self.assertIn('totalResults', results)
+
+        result = self.client.get('/search.json',
+                                 query_string={'recipe_search': 'soup',
+                                               'fields': 'id,title'})
+        self.assertEqual(sorted(result.get_json()['results'][0]),
+                         ['id', 'title'])
+
+    def test_search_gzipped_and_revalidated(self):
+        """Test that large responses are gzipped for clients that accept
+        it, and that the gzipped ETag still revalidates."""
+
+        result = self.client.get('/search.json',
+                                 query_string={'recipe_search': 'soup'},
+                                 headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', result.headers['Vary'])
+        self.assertIn('Italian Sausage',
+                      json.loads(gzip.decompress(result.data))['results'][0]
+                      ['title'])
+
+        etag = result.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+
+        result = self.client.get('/search.json',
+                                 query_string={'recipe_search': 'soup'},
+                                 headers={'Accept-Encoding': 'gzip',
+                                          'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+
+    def test_search_served_from_stored_recipes(self):
+        """Test that searches with enough stored hits skip Spoonacular, and
+        others still go upstream."""
+
+        info = dict(fake_api_json.recipe_info('548180'),
+                    instructions="Stir &lt;script&gt; & <em>sausage</em> "
+                                 "into the tortellini.")
+        recipe = Recipe(recipe_id='548180')
+        helper_functions.fill_recipe(recipe, info)
+        db.session.add(recipe)
+        db.session.flush()
+        helper_functions.ingest_recipe_details({'548180': info})
+        db.session.commit()
+
+        original_min_hits = helper_functions.LOCAL_SEARCH_MIN_HITS
+        helper_functions.LOCAL_SEARCH_MIN_HITS = 1
+        try:
+            result = self.client.get('/search.json',
+                                     query_string={'recipe_search':
+                                                   'tortellini sausage'})
+            results = result.get_json()
+            self.assertEqual(results['source'], 'local')
+            self.assertEqual(results['totalResults'], 1)
+            self.assertEqual(results['results'][0]['id'], 548180)
+
+            # The snippet escapes the stored text and only adds bold
+            self.assertEqual(results['results'][0]['summary'],
+                             "Stir &lt;script&gt; &amp;  <b>sausage</b>  "
+                             "into the <b>tortellini</b>.")
+
+            # Ingredient names are searchable too
+            recipes = helper_functions.search_stored_recipes('bay leaf', 10)
+            self.assertEqual(len(recipes['results']), 1)
+
+            self.client.get('/search.json',
+                            query_string={'recipe_search': 'curry'})
+        finally:
+            helper_functions.LOCAL_SEARCH_MIN_HITS = original_min_hits
+
+        self.assertEqual(self.searches, [('curry', 10, 0)])
+
+    def test_search_filtered_by_facets(self):
+        """Test that stored recipes are filtered and counted by diet and
+        nutrition, and that Spoonacular gets the filters it understands."""
+
+        info = fake_api_json.recipe_info('548180')
+        recipe = Recipe(recipe_id='548180')
+        helper_functions.fill_recipe(recipe, info)
+        db.session.add(recipe)
+        db.session.flush()
+        helper_functions.ingest_recipe_details({'548180': info})
+        db.session.commit()
+        self.assertEqual(recipe.ready_in_minutes, 40)
+
+        original_min_hits = helper_functions.LOCAL_SEARCH_MIN_HITS
+        helper_functions.LOCAL_SEARCH_MIN_HITS = 1
+        try:
+            result = self.client.get('/search.json',
+                                     query_string={'recipe_search':
+                                                   'tortellini',
+                                                   'max_ready_time': '45',
+                                                   'min_servings': '6'})
+            results = result.get_json()
+            self.assertEqual(results['totalResults'], 1)
+            self.assertEqual(results['facets']['diets']['vegan'], 0)
+            self.assertEqual(results['facets']['readyInMinutes'],
+                             [{'max': 15, 'count': 0},
+                              {'max': 30, 'count': 0},
+                              {'max': 45, 'count': 1},
+                              {'max': 60, 'count': 1}])
+
+            result = self.client.get('/search.json',
+                                     query_string={'recipe_search':
+                                                   'tortellini',
+                                                   'diet': 'vegan'})
+            # No stored recipe is vegan, so Spoonacular is asked instead
+            self.assertNotEqual(result.get_json().get('source'), 'local')
+
+            result = self.client.get('/search.json',
+                                     query_string={'recipe_search': 'curry',
+                                                   'diet':
+                                                   'vegan,glutenFree,whole30'})
+        finally:
+            helper_functions.LOCAL_SEARCH_MIN_HITS = original_min_hits
+
+        self.assertEqual(self.search_filters,
+                         [{'diet': 'vegan'},
+                          {'diet': 'vegan', 'intolerances': 'gluten'}])
+        self.assertEqual(result.get_json()['unfiltered'], ['whole30'])
+
+    def test_facets_load_recipes_committed_late(self):
+        """Test that a recipe committing after newer ones were loaded still
+        gets its facets."""
+
+        loaded = Recipe(recipe_id='548180')
+        helper_functions.fill_recipe(loaded,
+                                     fake_api_json.recipe_info('548180'))
+        db.session.add(loaded)
+        db.session.commit()
+        helper_functions.refresh_facet_index()
+
+        # Fetched before the loaded recipe, but committed after it
+        late = Recipe(recipe_id='548181')
+        helper_functions.fill_recipe(late, fake_api_json.recipe_info('548181'))
+        late.fetched_at = loaded.fetched_at - timedelta(seconds=60)
+        db.session.add(late)
+        db.session.commit()
+        helper_functions.refresh_facet_index()
+
+        self.assertIn('548181', helper_functions.facet_index.positions)
+
+    def test_facets_backfilled_from_payload(self):
+        """Test that recipes stored before the facet columns existed get
+        them from their stored info."""
+
+        recipe = Recipe(recipe_id='548180')
+        recipe.info = fake_api_json.recipe_info('548180')
+        db.session.add(recipe)
+        db.session.commit()
+
+        helper_functions.refresh_facet_index()
+
+        self.assertIn('548180', helper_functions.facet_index.positions)
+        self.assertEqual(Recipe.query.get('548180').ready_in_minutes, 40)
+
+    def test_search_stream_events(self):
+        """Test that streamed search sends results, then each summary."""
+
+        result = self.client.get('/search.ndjson',
+                                 query_string={'recipe_search': 'soup'})
+        events = [json.loads(line) for line in result.data.splitlines()]
+
+        self.assertEqual([event['event'] for event in events],
+                         ['results', 'summary', 'done'])
+        self.assertIsNone(events[0]['data']['results'][0]['summary'])
+        self.assertEqual(events[1]['id'], '548180')
+        self.assertEqual(events[2]['missing'], [])
+
+    def test_search_stream_unavailable(self):
+        """Test that a streamed search failing upstream gets a 503, not a
+        cut-off 200 stream."""
+
+        def _unavailable_recipe_search(*args):
+            raise UpstreamUnavailable("circuit breaker open")
+
+        api_calls.recipe_search = _unavailable_recipe_search
+
+        result = self.client.get('/search.ndjson',
+                                 query_string={'recipe_search': 'soup'})
+
+        self.assertEqual(result.status_code, 503)
+        self.assertIn('circuit breaker', result.get_json()['error'])
+
+    def test_search_upstream_error(self):
+        """Test that both search endpoints answer a failed Spoonacular call
+        with a 503."""
+
+        def _failing_recipe_search(*args):
+            raise requests.ConnectionError("connection refused")
+
+        api_calls.recipe_search = _failing_recipe_search
+
+        for path in ['/search.json', '/search.ndjson']:
+            result = self.client.get(path,
+                                     query_string={'recipe_search': 'soup'})
+            self.assertEqual(result.status_code, 503)
+            self.assertIn('connection refused', result.get_json()['error'])
+
+    def test_equivalent_searches_share_cache(self):
+        """Test that equivalent queries only search Spoonacular once."""
+
+        for recipe_search in ['Chicken  Curry', 'chicken curry',
+                              'curry chicken']:
+            result = self.client.get('/search.json',
+                                     query_string={'recipe_search':
+                                                   recipe_search})
+            self.assertEqual(len(result.get_json()['results']), 1)
+
+        self.assertEqual(self.searches, [('chicken curry', 10, 0)])
+
+    def test_pages_clamped_and_cached_separately(self):
+        """Test that page size and offset are limited and each page cached."""
+
+        for offset in ['0', '20', '0']:
+            self.client.get('/search.json',
+                            query_string={'recipe_search': 'soup',
+                                          'number_of_results': '500',
+                                          'offset': offset})
+
+        self.assertEqual(self.searches, [('soup', api_calls.MAX_RESULTS, 0),
+                                         ('soup', api_calls.MAX_RESULTS, 20)])
+        self.assertEqual(api_calls.clamp_page('x', '-5'),
+                         (api_calls.DEFAULT_RESULTS, 0))
+
+    def test_no_more_pages_past_offset_cap(self):
+        """Test that pages say whether a next page can be asked for, which
+        it can't past the offset Spoonacular pages to."""
+
+        for path, offset, has_more in [('/search.json', '0', True),
+                                       ('/search.json', '900', False),
+                                       ('/search.ndjson', '5000', False)]:
+            result = self.client.get(path,
+                                     query_string={'recipe_search': 'soup',
+                                                   'offset': offset,
+                                                   'compact': '1'})
+            if path == '/search.ndjson':
+                page = json.loads(result.data.splitlines()[0])['data']
+            else:
+                page = result.get_json()
+            self.assertEqual(page['has_more'], has_more)
+
+    def test_normalize_query(self):
+        """Test query normalization, with and without stemming."""
+
+        self.assertEqual(text_utils.normalize_query(' Curry,  CHICKEN '),
+                         'chicken curry')
+        self.assertEqual(text_utils.normalize_query('Tomatoes berries',
+                                                    stem=True),
+                         'berry tomato')
+
+    def test_slow_summary_marked_missing(self):
+        """Test that summaries missing the deadline don't fail the search."""
+
+        def _slow_summary_info(recipe_id):
+            time.sleep(0.5)
+            return fake_api_json.summary_info(recipe_id)
+
+        api_calls.summary_info = _slow_summary_info
+        api_calls.client.get_json = lambda *args, **kwargs: []
+        summaries = list(api_calls.iter_summaries(['548180'],
+                                                  time.monotonic() + 0.05))
+
+        self.assertEqual(summaries, [])
+
+
+
+class FlaskTestsRecipeInfo(TestCase):
+    """Test recipe info pages served from the DB or the API."""
+
+    def setUp(self):
+        """Before every test"""
+
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+        # Connect to test database
+        connect_to_db(app, "postgresql:///testdb")
+
+        # Create tables and add sample data
+        db.create_all()
+        example_data()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+        # Mock recipe info API, counting calls
+        self.original_recipe_info = api_calls.recipe_info
+        self.info_calls = []
+
+        def _mock_recipe_info(recipe_id, priority=None):
+            self.info_calls.append(recipe_id)
+            return fake_api_json.recipe_info(recipe_id)
+
+        api_calls.recipe_info = _mock_recipe_info
+
+        # Start from a full quota and a closed breaker
+        self.original_scheduler = api_calls.client.scheduler
+        api_calls.client.scheduler = fresh_scheduler()
+
+        # Row ids restart with the tables, so start the indexes over too
+        helper_functions.pantry_index = pantry.PantryIndex()
+        helper_functions.suggester = suggest.Suggester()
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        api_calls.recipe_info = self.original_recipe_info
+        api_calls.client.scheduler = self.original_scheduler
+
+        db.session.close()
+        db.drop_all()
+
+    def store_recipe(self, recipe_id):
+        """Stores recipe_id the way bookmarking does: a bare row, filled in
+        with its full info on the first view of its page."""
+
+        db.session.add(Recipe(recipe_id=recipe_id))
+        db.session.commit()
+        self.client.get('/recipe-info/' + recipe_id)
+
+    def test_new_recipe_from_api(self):
+        """Test that recipes not in the DB are fetched from the API."""
+
+        result = self.client.get('/recipe-info/548180')
+
+        self.assertIn(b"Italian Sausage Tortellini Soup", result.data)
+        self.assertEqual(self.info_calls, ['548180'])
+
+    def test_unknown_recipe_not_found(self):
+        """Test that a recipe Spoonacular doesn't have is a 404 page."""
+
+        def _missing_recipe_info(recipe_id, priority=None):
+            raise requests.HTTPError(response=FakeResponse(404))
+
+        api_calls.recipe_info = _missing_recipe_info
+
+        result = self.client.get('/recipe-info/999999999')
+
+        self.assertEqual(result.status_code, 404)
+
+    def test_recipe_page_revalidated_by_etag(self):
+        """Test that recipe pages are cacheable by the browser only, since
+        they are behind the login, and that a matching If-None-Match gets
+        a 304 with no body."""
+
+        result = self.client.get('/recipe-info/548180')
+        self.assertIn('private', result.headers['Cache-Control'])
+        self.assertNotIn('public', result.headers['Cache-Control'])
+        self.assertIn('max-age', result.headers['Cache-Control'])
+
+        etag = result.headers['ETag']
+        result = self.client.get('/recipe-info/548180',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.data, b"")
+
+    def test_ingredients_ingested(self):
+        """Test that hydrating a bookmarked recipe stores its ingredients
+        and cuisines once each, and that recipes can be found by
+        ingredient."""
+
+        original_recipe_info_bulk = api_calls.recipe_info_bulk
+        api_calls.recipe_info_bulk = (
+            lambda recipe_ids, priority=None:
+            {recipe_id: fake_api_json.recipe_info(recipe_id)
+             for recipe_id in recipe_ids})
+        try:
+            db.session.add(Recipe(recipe_id='548180'))
+            db.session.commit()
+            helper_functions.hydrate_recipes(['548180'])
+        finally:
+            api_calls.recipe_info_bulk = original_recipe_info_bulk
+
+        self.assertEqual(Recipe.query.get('548180').recipe_name,
+                         "Italian Sausage Tortellini Soup")
+        info = fake_api_json.recipe_info('548180')
+
+        # Ingesting again replaces the recipe's rows instead of adding more,
+        # and an ingredient listed twice gets one row
+        helper_functions.ingest_recipe_details(
+            {'548180': dict(info, extendedIngredients=(
+                info['extendedIngredients']
+                + info['extendedIngredients'][:1]))})
+        db.session.commit()
+
+        ingredient_ids = {item['id'] for item in info['extendedIngredients']}
+        self.assertEqual(Ingredient.query.count(), len(ingredient_ids))
+        self.assertEqual(RecipeIngredient.query.count(), len(ingredient_ids))
+        self.assertEqual(RecipeCuisine.query.count(), len(info['cuisines']))
+        self.assertEqual(Ingredient.query.get(11531).aisle.name,
+                         "Canned and Jarred")
+
+        recipes = helper_functions.recipes_with_ingredient(
+            'Canned Diced Tomatoes')
+        self.assertEqual([recipe.recipe_id for recipe in recipes],
+                         ['548180'])
+        self.assertEqual(helper_functions.recipes_with_ingredient(
+            11531, user_id=1), [])
+
+    def test_suggestions_from_stored_recipes(self):
+        """Test that stored titles and ingredients are suggested."""
+
+        self.store_recipe('548180')
+
+        result = self.client.get('/suggest.json', query_string={'q': 'tortel'})
+        self.assertEqual(set(result.get_json()['suggestions']),
+                         {'Italian Sausage Tortellini Soup',
+                          'cheese tortellini'})
+
+        result = self.client.get('/suggest.json', query_string={'q': 'bay l'})
+        self.assertIn('bay leaf', result.get_json()['suggestions'])
+
+    def test_suggestions_from_recipes_without_ingredients(self):
+        """Test that titles of recipes stored without ingredient rows are
+        suggested too."""
+
+        self.store_recipe('548180')
+        self.client.get('/suggest.json', query_string={'q': 'tortel'})
+
+        recipe = Recipe(recipe_id='548181')
+        info = dict(fake_api_json.recipe_info('548181'), title='Borscht')
+        helper_functions.fill_recipe(recipe, info)
+        db.session.add(recipe)
+        db.session.commit()
+        helper_functions.suggester.refreshed_at = None
+
+        result = self.client.get('/suggest.json', query_string={'q': 'bors'})
+        self.assertEqual(result.get_json()['suggestions'], ['Borscht'])
+
+    def test_pantry_matches_stored_recipes(self):
+        """Test that the pantry endpoint ranks stored recipes by coverage."""
+
+        self.store_recipe('548180')
+
+        result = self.client.get('/pantry.json',
+                                 query_string={'ingredients':
+                                               'tomatoes, bay leaf'})
+        match = result.get_json()['results'][0]
+
+        self.assertEqual(match['id'], '548180')
+        self.assertEqual(match['have'], 2)
+        self.assertEqual(match['have'] + match['missing'], match['total'])
+
+        # Bounds far past any recipe's size are clamped, not looped over
+        result = self.client.get('/pantry.json',
+                                 query_string={'ingredients':
+                                               'tomatoes, bay leaf',
+                                               'max_missing': '1000000000'})
+        self.assertEqual(result.get_json()['results'], [match])
+
+    def test_pantry_loads_rows_committed_late(self):
+        """Test that rows committing after higher row ids were loaded are
+        still picked up."""
+
+        # A row with a higher id than the next ones commits first
+        db.session.add(Ingredient(ingredient_id=1, name='saffron'))
+        db.session.flush()
+        db.session.add(RecipeIngredient(recipe_ingredient_id=50,
+                                        recipe_id='262682', ingredient_id=1))
+        db.session.commit()
+        helper_functions.refresh_pantry_index()
+        self.assertEqual(helper_functions.pantry_index.watermark, 50)
+
+        self.store_recipe('548180')
+
+        result = self.client.get('/pantry.json',
+                                 query_string={'ingredients': 'bay leaf'})
+        self.assertEqual([match['id'] for match
+                          in result.get_json()['results']], ['548180'])
+        self.assertNotIn(1, helper_functions.pantry_index.gaps)
+
+    def test_stored_recipe_from_db(self):
+        """Test that a bookmarked recipe's page needs no API call after its
+        full info has been stored."""
+
+        self.store_recipe('548180')
+        self.info_calls = []
+
+        result = self.client.get('/recipe-info/548180')
+
+        self.assertIn(b"2 cups cheese tortellini", result.data)
+        self.assertEqual(self.info_calls, [])
+
+    def test_old_recipe_filled_in(self):
+        """Test that stored recipes without full info get it on first view."""
+
+        self.client.get('/recipe-info/262682')
+        self.client.get('/recipe-info/262682')
+
+        self.assertEqual(self.info_calls, ['262682'])
+        self.assertIsNotNone(Recipe.query.get('262682').fetched_at)
+
+
+
+class PrefetchTests(TestCase):
+    """Test background prefetch of recipe info after a search."""
+
+    def setUp(self):
+        """Before every test"""
+
+        self.fetched = []
+        self.original_recipe_info_bulk = api_calls.recipe_info_bulk
+        self.original_top_k = api_calls.PREFETCH_TOP_K
+        self.original_budget = api_calls.PREFETCH_BUDGET
+
+        def _mock_recipe_info_bulk(recipe_ids, priority=None):
+            self.fetched.append(recipe_ids)
+
+        api_calls.recipe_info_bulk = _mock_recipe_info_bulk
+        api_calls.PREFETCH_TOP_K = 2
+        api_calls.PREFETCH_BUDGET = 3
+        api_calls.prefetch_budgets.clear()
+        api_calls.recipe_cache.clear()
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        api_calls.recipe_info_bulk = self.original_recipe_info_bulk
+        api_calls.PREFETCH_TOP_K = self.original_top_k
+        api_calls.PREFETCH_BUDGET = self.original_budget
+        api_calls.prefetch_budgets.clear()
+
+    def wait_for_prefetch(self):
+        """Block until queued prefetches have run."""
+
+        api_calls.prefetch_pool.submit(lambda: None).result(5)
+
+    def test_top_results_prefetched(self):
+        """Test that only uncached top results are fetched."""
+
+        api_calls.recipe_cache.set(('information', '1'), {'id': 1})
+        api_calls.prefetch_recipe_info([1, 2, 3], 'user')
+        self.wait_for_prefetch()
+
+        self.assertEqual(self.fetched, [['2']])
+
+    def test_budget_per_user(self):
+        """Test that each user's prefetches stop at their budget."""
+
+        api_calls.prefetch_recipe_info([1, 2], 'user')
+        api_calls.prefetch_recipe_info([3, 4], 'user')
+        api_calls.prefetch_recipe_info([5, 6], 'other user')
+        self.wait_for_prefetch()
+
+        self.assertEqual(self.fetched, [['1', '2'], ['3'], ['5', '6']])
+
+
+
+class FakeResponse(object):
+    """Stand-in for requests.Response in API client tests."""
+
+    def __init__(self, status_code, json_data=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.json_data = json_data
+        self.headers = {}
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(response=self)
+
+    def json(self):
+        return self.json_data
+
+
+class FakeSession(object):
+    """Session that hands out queued responses instead of calling out."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None):
+        self.calls.append((url, params, timeout))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class ApiClientTests(TestCase):
+    """Test the shared Spoonacular client without network access."""
+
+    def setUp(self):
+        """Before every test"""
+
+        self.client = api_calls.ApiClient('https://example.com', {},
+                                          read_timeout=2, backoff=0)
+
+    def use_responses(self, *responses):
+        """Point client at a fake session returning responses in order."""
+
+        self.client.session
+        self.client._session = FakeSession(responses)
+        return self.client._session
+
+    def test_retries_retryable_status(self):
+        """Test that a 503 is retried and the next good response returned."""
+
+        session = self.use_responses(FakeResponse(503),
+                                     FakeResponse(200, {'id': 1}))
+
+        self.assertEqual(self.client.get_json('/recipes'), {'id': 1})
+        self.assertEqual(len(session.calls), 2)
+        self.assertEqual(session.calls[0][2], (3.05, 2))
+
+    def test_does_not_retry_not_found(self):
+        """Test that a 404 fails straight away and is counted as an error."""
+
+        session = self.use_responses(FakeResponse(404))
+
+        with self.assertRaises(requests.HTTPError):
+            self.client.get_json('/recipes', endpoint='recipes')
+
+        self.assertEqual(len(session.calls), 1)
+        self.assertEqual(self.client.stats()['recipes']['errors'], 1)
+
+    def test_priorities_not_coalesced(self):
+        """Test that identical calls only share a flight at one priority."""
+
+        keys = []
+
+        class RecordingFlights(object):
+            def do(self, key, fn):
+                keys.append(key)
+
+        self.client.flights = RecordingFlights()
+        self.client.get_json('/recipes', {'ids': '1'}, priority=PREFETCH)
+        self.client.get_json('/recipes', {'ids': '1'}, priority=INTERACTIVE)
+        self.client.get_json('/recipes', {'ids': '1'}, priority=INTERACTIVE)
+
+        self.assertNotEqual(keys[0], keys[1])
+        self.assertEqual(keys[1], keys[2])
+
+    def test_calls_kept_within_deadline(self):
+        """Test that timeouts are cut to the time left, and that no retry
+        starts once the deadline has passed."""
+
+        session = self.use_responses(FakeResponse(200, {'id': 1}))
+        self.client.get_json('/recipes', deadline=time.monotonic() + 1)
+        self.assertLessEqual(max(session.calls[0][2]), 1)
+
+        class SlowSession(FakeSession):
+            def get(self, url, params=None, timeout=None):
+                time.sleep(0.2)
+                return FakeSession.get(self, url, params, timeout)
+
+        self.client._session = session = SlowSession([FakeResponse(503),
+                                                      FakeResponse(200)])
+        with self.assertRaises(requests.HTTPError):
+            self.client.get_json('/recipes', deadline=time.monotonic() + 0.1)
+        self.assertEqual(len(session.calls), 1)
+
+        with self.assertRaises(requests.Timeout):
+            self.client.get_json('/recipes', deadline=time.monotonic())
+
+    def test_broken_body_ends_breaker_trial(self):
+        """Test that a half-open trial failing with any requests error
+        re-opens the breaker instead of blocking calls for good."""
+
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30,
+                                 clock=lambda: now[0])
+        self.client.scheduler = UpstreamScheduler(
+            rate=100, capacity=100, breaker=breaker, clock=lambda: now[0])
+        breaker.record_failure()
+        now[0] = 31
+
+        self.use_responses(requests.exceptions.ChunkedEncodingError())
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            self.client.get_json('/recipes')
+        self.assertEqual(breaker.state, 'open')
+
+        now[0] = 62
+        self.use_responses(FakeResponse(200, {'id': 1}))
+        self.assertEqual(self.client.get_json('/recipes'), {'id': 1})
+        self.assertEqual(breaker.state, 'closed')
+
+
+
+class ImmediateExecutor(object):
+    """Executor that runs submitted work straight away, for cache tests."""
+
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+class TTLCacheTests(TestCase):
+    """Test the in-process TTL + LRU cache."""
+
+    def setUp(self):
+        """Before every test"""
+
+        self.now = 0
+        self.cache = TTLCache(maxsize=2, ttl=10, stale_ttl=5, negative_ttl=3,
+                              clock=lambda: self.now,
+                              executor=ImmediateExecutor())
+
+    def test_hit_after_miss(self):
+        """Test that the loader only runs on the first lookup."""
+
+        calls = []
+        loader = lambda: calls.append(1) or 'soup'
+
+        self.assertEqual(self.cache.get_or_load('a', loader), 'soup')
+        self.assertEqual(self.cache.get_or_load('a', loader), 'soup')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_least_recently_used_evicted(self):
+        """Test that the least recently used key goes once maxsize is hit."""
+
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_stale_value_served_then_refreshed(self):
+        """Test stale-while-revalidate after the ttl runs out."""
+
+        self.cache.set('a', 'old')
+        self.now = 12
+
+        self.assertEqual(self.cache.get_or_load('a', lambda: 'new'), 'old')
+        self.assertEqual(self.cache.get('a'), 'new')
+
+    def test_not_found_cached(self):
+        """Test that errors marked negative are cached and re-raised."""
+
+        calls = []
+
+        def loader():
+            calls.append(1)
+            raise KeyError('missing')
+
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                self.cache.get_or_load('a', loader, negative=lambda e: True)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.stats()['negative_hits'], 1)
+
+    def test_byte_cap_evicts(self):
+        """Test that entries are evicted to stay under maxbytes."""
+
+        cache = TTLCache(maxsize=10, maxbytes=5, sizeof=len)
+        cache.set('a', 'abc')
+        cache.set('b', 'abc')
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 3)
+
+    def test_disabled_cache_always_loads(self):
+        """Test that a disabled cache never stores anything."""
+
+        self.cache.enabled = False
+        self.cache.set('a', 1)
+
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get_or_load('a', lambda: 2), 2)
+
+
+
+class FakeApiClient(object):
+    """Records bulk information calls and answers them from fake json,
+    with summary (or "Summary <id>") as every recipe's summary."""
+
+    def __init__(self, summary=None):
+        self.calls = []
+        self.summary = summary
+
+    def get_json(self, path, params=None, endpoint=None, priority=None):
+        self.calls.append(params['ids'])
+        return [dict(fake_api_json.recipe_info(recipe_id), id=int(recipe_id),
+                     summary=self.summary or 'Summary {}'.format(recipe_id))
+                for recipe_id in params['ids'].split(',')]
+
+
+def fresh_scheduler():
+    """Returns a scheduler with a full quota and a closed breaker, so one
+    test's failures can't throttle the next."""
+
+    return UpstreamScheduler(rate=5, capacity=10,
+                             breaker=CircuitBreaker(failure_threshold=5,
+                                                    reset_timeout=30))
+
+
+class RecipeInfoBulkTests(TestCase):
+    """Test batching of recipe info through the bulk endpoint."""
+
+    def setUp(self):
+        """Before every test"""
+
+        self.original_client = api_calls.client
+        self.original_chunk_size = api_calls.BULK_CHUNK_SIZE
+        api_calls.client = FakeApiClient()
+        api_calls.BULK_CHUNK_SIZE = 2
+        api_calls.recipe_cache.clear()
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        api_calls.client = self.original_client
+        api_calls.BULK_CHUNK_SIZE = self.original_chunk_size
+        api_calls.recipe_cache.clear()
+
+    def test_ids_fetched_in_chunks(self):
+        """Test that ids are split into chunks of BULK_CHUNK_SIZE."""
+
+        infos = api_calls.recipe_info_bulk(['1', '2', '3'])
+
+        self.assertEqual(sorted(infos), ['1', '2', '3'])
+        self.assertEqual(sorted(api_calls.client.calls), ['1,2', '3'])
+
+    def test_cached_recipes_not_fetched(self):
+        """Test that bulk results are cached and merged with later calls."""
+
+        api_calls.recipe_info_bulk(['1'])
+        summaries = dict(api_calls.iter_summaries(['1', '2'],
+                                                  time.monotonic() + 5))
+
+        self.assertEqual(api_calls.client.calls, ['1', '2'])
+        self.assertEqual(summaries, {'1': 'Summary 1', '2': 'Summary 2'})
+
+
+
+class SchedulerTests(TestCase):
+    """Test quota, priorities and the circuit breaker for upstream calls."""
+
+    def setUp(self):
+        """Before every test"""
+
+        self.now = 0
+        clock = lambda: self.now
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30,
+                                      clock=clock)
+        self.scheduler = UpstreamScheduler(
+            rate=1, capacity=4,
+            max_wait={INTERACTIVE: 0, HYDRATION: 0, PREFETCH: 0},
+            breaker=self.breaker, clock=clock)
+
+    def test_prefetch_leaves_headroom(self):
+        """Test that prefetches stop while interactive calls can go on."""
+
+        self.scheduler.acquire(PREFETCH)
+        self.scheduler.acquire(PREFETCH)
+
+        # 2 tokens left; prefetch needs more than half the bucket spare
+        with self.assertRaises(UpstreamUnavailable):
+            self.scheduler.acquire(PREFETCH)
+        self.scheduler.acquire(INTERACTIVE)
+
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['admitted']['interactive'], 1)
+        self.assertEqual(stats['rejected_quota']['prefetch'], 1)
+
+    def test_quota_refills(self):
+        """Test that the bucket refills at its rate once used up."""
+
+        for _ in range(4):
+            self.scheduler.acquire(INTERACTIVE)
+        with self.assertRaises(UpstreamUnavailable):
+            self.scheduler.acquire(INTERACTIVE)
+
+        self.now = 1
+        self.scheduler.acquire(INTERACTIVE)
+
+    def test_breaker_opens_and_recovers(self):
+        """Test fail-fast while open and a trial call after the timeout."""
+
+        self.scheduler.record(False)
+        self.scheduler.record(False)
+
+        with self.assertRaises(UpstreamUnavailable):
+            self.scheduler.acquire(INTERACTIVE)
+        self.assertEqual(self.scheduler.stats()['breaker'], 'open')
+
+        self.now = 31
+        self.scheduler.acquire(INTERACTIVE)
+        self.scheduler.record(True)
+        self.assertEqual(self.scheduler.stats()['breaker'], 'closed')
+
+    def test_stale_recipe_served_while_failing(self):
+        """Test that an expired cache entry is served if reloading fails."""
+
+        cache = TTLCache(ttl=10, stale_if_error=True, clock=lambda: self.now)
+        cache.set('a', 'old')
+        self.now = 100
+
+        def failing_loader():
+            raise UpstreamUnavailable()
+
+        self.assertEqual(cache.get_or_load('a', failing_loader), 'old')
+
+
+
+class AssetTests(TestCase):
+    """Test the static asset build and how built files are served."""
+
+    def setUp(self):
+        """Build the bundles into a scratch directory."""
+
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+        self.original_dist_dir = assets.DIST_DIR
+        assets.DIST_DIR = tempfile.mkdtemp()
+        assets.manifest = None
+        self.built = assets.build()
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        shutil.rmtree(assets.DIST_DIR)
+        assets.DIST_DIR = self.original_dist_dir
+        assets.manifest = None
+
+    def test_bundles_hashed_and_linked(self):
+        """Test that bundles get content-hashed names that templates use."""
+
+        self.assertRegex(self.built['search.js'],
+                         r'^search\.[0-9a-f]{12}\.js$')
+        self.assertEqual(assets.asset_urls('search.js'),
+                         ['/static/dist/' + self.built['search.js']])
+
+        result = self.client.get('/')
+        self.assertIn(self.built['app.css'].encode('utf-8'), result.data)
+        self.assertEqual(result.data.count(b"/jquery."), 1)
+
+    def test_unbuilt_assets_linked_from_source(self):
+        """Test that without a build the source files are linked."""
+
+        assets.manifest = {}
+        self.assertEqual(assets.asset_urls('app.css'),
+                         ['/static/css/style.css'])
+
+    def test_built_asset_precompressed_and_immutable(self):
+        """Test that built files are served gzipped and cached for good."""
+
+        result = self.client.get('/static/dist/' + self.built['search.js'],
+                                 headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', result.headers['Cache-Control'])
+        self.assertIn(b"handleSearchResults",
+                      gzip.decompress(result.get_data()))
+
+    def test_minify(self):
+        """Test that minifying drops comments and spare whitespace."""
+
+        self.assertEqual(assets.minify_js("  // note\n  var a = 1;\n\n"),
+                         "var a = 1;")
+        self.assertEqual(assets.minify_css("/* c */ a ,b {\n color: red;\n}"),
+                         "a,b{color:red}")
+
+
+class PantryIndexTests(TestCase):
+    """Test pantry matching over ingredient bitsets."""
+
+    def setUp(self):
+        """Index a few recipes by ingredient id."""
+
+        self.index = pantry.PantryIndex()
+        self.index.load({'soup': {1, 2, 3},
+                         'salad': {1, 4},
+                         'toast': {5},
+                         'stew': {1, 2, 3, 6}},
+                        {1: 'tomatoes', 2: 'onion', 3: 'canned diced tomatoes',
+                         4: 'lettuce', 5: 'bread', 6: 'beef'})
+
+    def test_ranked_by_missing_then_used(self):
+        """Test that recipes missing fewest ingredients come first."""
+
+        matches = self.index.match({1, 2, 3})
+
+        self.assertEqual([(match['recipe_id'], match['have'],
+                           match['missing']) for match in matches],
+                         [('soup', 3, 0), ('stew', 3, 1), ('salad', 1, 1)])
+        self.assertEqual(len(self.index.match({1, 2, 3}, limit=1)), 1)
+        self.assertEqual(len(self.index.match({1}, max_missing=1)), 1)
+        self.assertEqual(self.index.match({1}, max_missing=10 ** 12),
+                         self.index.match({1}))
+
+    def test_names_and_updates(self):
+        """Test that names match by word and re-loading a recipe replaces
+        its ingredients."""
+
+        self.assertEqual(self.index.ingredient_ids(['Tomato']), {1, 3})
+
+        self.index.load({'salad': {4}})
+        self.assertEqual([match['recipe_id']
+                          for match in self.index.match({4})], ['salad'])
+        self.assertEqual(self.index.match({1}, limit=5)[-1]['recipe_id'],
+                         'stew')
+
+    def test_bit_sliced_arithmetic(self):
+        """Test the bit-sliced counters against plain integers."""
+
+        values = [5, 0, 3, 7, 1]
+        planes = pantry.sliced_from_values(values)
+        for _ in range(2):
+            pantry.sliced_add(planes, pantry.bitset_from_positions([0, 2]))
+
+        self.assertEqual([pantry.sliced_value(planes, position)
+                          for position in range(5)], [7, 0, 5, 7, 1])
+        self.assertEqual(pantry.positions_of(
+            pantry.sliced_equal(planes, 7, 0b11111)), [0, 3])
+
+
+class FacetIndexTests(TestCase):
+    """Test filtering and counting recipes by diet and nutrition."""
+
+    def setUp(self):
+        """Index made-up recipes with random flags and numbers."""
+
+        rng = random.Random(0)
+        self.recipes = {}
+        for recipe_id in range(400):
+            numbers = {facet: rng.choice([None, rng.randint(0, 120)])
+                       for facet in facets.NUMERIC_FACETS}
+            self.recipes[str(recipe_id)] = (rng.randint(0, 127), numbers)
+
+        self.index = facets.FacetIndex()
+        self.index.load(self.recipes)
+        self.everything = self.index.bitset_of(self.recipes)
+
+    def brute_force(self, diets, ranges):
+        """Returns the recipe ids passing filters, one recipe at a time."""
+
+        matched = set()
+        for recipe_id, (flags, numbers) in self.recipes.items():
+            if any(not flags >> facets.DIET_FLAGS.index(diet) & 1
+                   for diet in diets):
+                continue
+            if any(numbers[facet] is None
+                   or (low is not None and numbers[facet] < low)
+                   or (high is not None and numbers[facet] > high)
+                   for facet, (low, high) in ranges.items()):
+                continue
+            matched.add(recipe_id)
+
+        return matched
+
+    def test_filters_match_brute_force(self):
+        """Test diet and range filters against checking every recipe."""
+
+        for diets, ranges in [((), {}),
+                              (('vegan', 'glutenFree'), {}),
+                              ((), {'readyInMinutes': (None, 30)}),
+                              (('ketogenic',), {'servings': (4, 100),
+                                                'healthScore': (50, None)}),
+                              ((), {'pricePerServing': (0, 0)})]:
+            matched = self.index.filter(self.everything, diets, ranges)
+            self.assertEqual(set(self.index.recipes_in(matched)),
+                             self.brute_force(diets, ranges))
+
+    def test_counts_and_updates(self):
+        """Test facet counts, and that updating one recipe moves it."""
+
+        counts = self.index.counts(self.everything)
+        self.assertEqual(counts['diets']['vegan'],
+                         len(self.brute_force(('vegan',), {})))
+        self.assertEqual(counts['servings'][1]['count'],
+                         len(self.brute_force((), {'servings': (4, None)})))
+
+        self.index.load({'0': (0b10, {'readyInMinutes': 5})})
+        fast = self.index.filter(self.everything, ('vegan',),
+                                 {'readyInMinutes': (None, 5)})
+        self.assertIn('0', self.index.recipes_in(fast))
+        self.assertEqual(len(self.index), 400)
+
+    def test_parse_and_upstream_filters(self):
+        """Test reading filters from a request, and what Spoonacular gets."""
+
+        diets, ranges = facets.parse_filters({'diet': 'vegan,paleo,vegan',
+                                              'max_price': '250.4',
+                                              'min_servings': 'lots',
+                                              'max_ready_time': 'inf',
+                                              'min_health_score': '1e400'})
+        self.assertEqual(diets, ('vegan',))
+        self.assertEqual(ranges, {'pricePerServing': (None, 250)})
+
+        self.assertEqual(facets.upstream_params(('dairyFree', 'vegetarian'),
+                                                {'servings': (2, None)}),
+                         ({'diet': 'vegetarian', 'intolerances': 'dairy'},
+                          ['servings']))
+
+
+class SuggesterTests(TestCase):
+    """Test search box suggestions."""
+
+    def setUp(self):
+        """Add a few titles, ingredients and searches."""
+
+        self.suggester = suggest.Suggester()
+        for phrase in ['Thai Chicken Curry', 'Chicken Noodle Soup',
+                       'Chickpea Salad', 'canned diced tomatoes']:
+            self.suggester.add(phrase)
+        for _ in range(suggest.MIN_QUERY_COUNT):
+            self.suggester.add_query('chickpea salad')
+
+    def test_prefix_of_any_word(self):
+        """Test that any word can start a match, popular searches first."""
+
+        self.assertEqual(self.suggester.suggest('chick'),
+                         ['Chickpea Salad', 'Chicken Noodle Soup',
+                          'Thai Chicken Curry'])
+        self.assertEqual(self.suggester.suggest('Tomat', limit=1),
+                         ['canned diced tomatoes'])
+        self.assertEqual(self.suggester.suggest(''), [])
+
+    def test_typos_corrected(self):
+        """Test that misspelled words find their nearest known word."""
+
+        self.assertEqual(self.suggester.suggest('chiken noo'),
+                         ['Chicken Noodle Soup'])
+        self.assertEqual(self.suggester.suggest('cury'),
+                         ['Thai Chicken Curry'])
+        self.assertEqual(suggest.edit_distance('kitten', 'sitting', 5), 3)
+
+    def test_queries_suggested_after_min_count(self):
+        """Test that a query is only suggested once searched often enough,
+        and that concurrent searches are all counted."""
+
+        for _ in range(suggest.MIN_QUERY_COUNT - 1):
+            self.suggester.add_query('Lentil Soup')
+        self.assertEqual(self.suggester.suggest('lent'), [])
+
+        threads = [threading.Thread(target=lambda: [
+            self.suggester.add_query('Lentil Soup') for _ in range(100)])
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(self.suggester.suggest('lent'), ['Lentil Soup'])
+        self.assertEqual(self.suggester.scores['lentil soup'],
+                         (suggest.MIN_QUERY_COUNT + 399)
+                         * suggest.QUERY_WEIGHT)
+
+
+class SingleFlightTests(TestCase):
+    """Test coalescing of identical concurrent calls."""
+
+    def test_concurrent_callers_share_call(self):
+        """Test that callers arriving mid-call wait for the same result."""
+
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def slow_call():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'soup'
+
+        leader = threading.Thread(
+            target=lambda: results.append(flights.do('key', slow_call)))
+        leader.start()
+        started.wait(5)
+
+        waiter = threading.Thread(
+            target=lambda: results.append(flights.do('key', slow_call)))
+        waiter.start()
+
+        # Let the waiter register before the leader finishes
+        while flights.stats()['waiters'] == 0:
+            time.sleep(0.001)
+        release.set()
+        leader.join(5)
+        waiter.join(5)
+
+        self.assertEqual(results, ['soup', 'soup'])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.stats(), {'leaders': 1, 'waiters': 1,
+                                           'in_flight': 0})
+
 
 
 class FlaskTestsBookmark(TestCase):
@@ -258,6 +1763,82 @@ class FlaskTestsBookmark(TestCase):
             current_bookmark = Bookmark.query.filter((Bookmark.recipe_id == '227961') & (Bookmark.user_id == 1)).first()
             self.assertIsNotNone(current_bookmark)
 
+    def test_non_numeric_recipe_rejected(self):
+        """Test that only ASCII digit recipe ids are bookmarked."""
+
+        result = self.client.post('/bookmark.json',
+                                  data={'recipe_id': '12\u00b2'})
+
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(Recipe.query.count(), 3)
+
+    def test_duplicate_bookmark(self):
+        """Test that bookmarking twice gives an error and one bookmark."""
+
+        for _ in range(2):
+            result = self.client.post('/bookmark.json',
+                                      data={'recipe_id': '262682'})
+
+        self.assertIn(b"You have already bookmarked this recipe.",
+                      result.data)
+        self.assertEqual(Bookmark.query.filter_by(recipe_id='262682',
+                                                  user_id=1).count(), 1)
+
+    def test_new_recipe_hydrated_later(self):
+        """Test that bookmarking an unstored recipe adds it right away and
+        fills in its details in the background."""
+
+        original_recipe_info_bulk = api_calls.recipe_info_bulk
+
+        def _mock_recipe_info_bulk(recipe_ids, priority=None):
+            return {recipe_id: fake_api_json.recipe_info(recipe_id)
+                    for recipe_id in recipe_ids}
+
+        api_calls.recipe_info_bulk = _mock_recipe_info_bulk
+        try:
+            result = self.client.post('/bookmark.json',
+                                      data={'recipe_id': '548180'})
+            helper_functions.hydration_pool.submit(lambda: None).result(5)
+        finally:
+            api_calls.recipe_info_bulk = original_recipe_info_bulk
+
+        self.assertIn(b"This recipe has been bookmarked!", result.data)
+        db.session.expire_all()
+        self.assertEqual(Recipe.query.get('548180').recipe_name,
+                         "Italian Sausage Tortellini Soup")
+
+    def test_batch_bookmarks(self):
+        """Test adding and removing many bookmarks in one request."""
+
+        original_hydrate_recipes_later = helper_functions.hydrate_recipes_later
+        hydrated = []
+        helper_functions.hydrate_recipes_later = hydrated.append
+        try:
+            self.client.post('/bookmark.json', data={'recipe_id': '602708'})
+            result = self.client.post(
+                '/bookmarks.json',
+                json={'add': ['262682', '548180', '262682', 'soup'],
+                      'remove': ['602708', '227961']})
+        finally:
+            helper_functions.hydrate_recipes_later = (
+                original_hydrate_recipes_later)
+
+        self.assertEqual(result.get_json()['statuses'],
+                         {'262682': 'bookmarked', '548180': 'bookmarked',
+                          'soup': 'invalid', '602708': 'removed',
+                          '227961': 'not_bookmarked'})
+        self.assertEqual(hydrated, [['548180']])
+        self.assertEqual(Bookmark.query.filter_by(user_id=1).count(), 2)
+
+    def test_batch_bookmarks_malformed(self):
+        """Test that batch bodies that aren't lists of ids are rejected."""
+
+        for body in [{'add': '123'}, ['262682'], {'remove': {'1': 2}}]:
+            result = self.client.post('/bookmarks.json', json=body)
+            self.assertEqual(result.status_code, 400)
+
+        self.assertEqual(Bookmark.query.filter_by(user_id=1).count(), 0)
+
     # def test_existing_bookmark(self):
     #     """ Test if error message appears with an already-bookmarked recipe. """
 
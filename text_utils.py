@@ -0,0 +1,31 @@
+""" Text helpers shared by search and the local indexes: query
+normalization and a light plural stemmer. """
+
+import re
+
+
+def normalize_query(recipe_search, stem=False):
+    """Normalizes a search so equivalent queries share one cache entry and
+    one upstream call: case-folded, punctuation and extra whitespace
+    dropped, tokens de-duplicated and sorted, and optionally stemmed."""
+
+    tokens = re.findall(r'\w+', (recipe_search or '').casefold())
+    if stem:
+        tokens = [stem_token(token) for token in tokens]
+
+    return ' '.join(sorted(set(tokens)))
+
+
+def stem_token(token):
+    """Light plural stemmer, e.g. tomatoes -> tomato, berries -> berry."""
+
+    if len(token) <= 3:
+        return token
+    if token.endswith('ies'):
+        return token[:-3] + 'y'
+    if token.endswith(('oes', 'ches', 'shes', 'sses', 'xes')):
+        return token[:-2]
+    if token.endswith('s') and not token.endswith(('ss', 'us', 'is')):
+        return token[:-1]
+
+    return token